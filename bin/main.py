@@ -7,11 +7,15 @@ import os
 sys.path.append(os.path.split(os.path.abspath(os.path.dirname(__file__)))[0])
 
 from xmuorder_server import config
-from xmuorder_server.database import Mysql
-from xmuorder_server.routers import sms, xmu, statistics, printer, update
+from xmuorder_server.database import Mysql, AsyncMysql
+from xmuorder_server.routers import sms, xmu, statistics, printer, update, monitor
 from xmuorder_server.logger import Logger
 from xmuorder_server.scheduler import Scheduler
+from xmuorder_server.schema import Schema
 from xmuorder_server.weixin.weixin import WeiXin
+from xmuorder_server.weixin.database import AsyncDatabase
+from xmuorder_server.weixin.mirror import OrderMirror
+from xmuorder_server.weixin.rollup import SalesRollup
 
 app = FastAPI()
 
@@ -28,9 +32,24 @@ async def __init():
 
     #   Mysql连接初始化
     Mysql.init()
+    #   Mysql异步连接初始化（路由使用）
+    await AsyncMysql.init()
+
+    #   数据库结构迁移及热点查询检查（也可通过 bin/migrate.py 执行）
+    Schema.init()
+    if config.GlobalSettings.get().database_migrate_on_startup:
+        Schema.run()
 
     #   微信模块初始化
     WeiXin.init()
+    #   后台提前刷新access_token
+    WeiXin.start()
+    #   微信云数据库异步客户端（长连接）
+    AsyncDatabase.init()
+    #   云数据库订单镜像
+    OrderMirror.init()
+    #   餐厅销售日汇总
+    SalesRollup.init()
 
     #   刷新数据库 路由
     app.include_router(update.router, prefix="/update")
@@ -42,11 +61,23 @@ async def __init():
     app.include_router(statistics.router, prefix="/statistics")
     #   云打印机模块 路由
     app.include_router(printer.router, prefix="/printer")
+    #   运行状态监控 路由
+    app.include_router(monitor.router, prefix="/monitor")
 
     #   scheduler初始化, router模块需要的任务在模块__init中添加
     Scheduler.init()
 
 
+@app.on_event("shutdown")
+async def __close():
+    #   关闭Mysql异步连接池
+    await AsyncMysql.close()
+    #   停止access_token后台刷新
+    await WeiXin.stop()
+    #   关闭微信云数据库客户端
+    await AsyncDatabase.close()
+
+
 @app.get('/')
 async def hello_world():
     return 'hello world'
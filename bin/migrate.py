@@ -0,0 +1,49 @@
+"""
+数据库结构迁移 命令行工具
+python migrate.py           执行迁移并检查热点查询
+python migrate.py --check   只检查热点查询的执行计划
+"""
+import argparse
+
+import pymysql
+
+# 添加项目路径进入环境变量，防止找不到模块
+import sys
+import os
+
+sys.path.append(os.path.split(os.path.abspath(os.path.dirname(__file__)))[0])
+
+from xmuorder_server import config
+from xmuorder_server.common import XMUORDERException
+from xmuorder_server.database import Mysql
+from xmuorder_server.logger import Logger
+from xmuorder_server.schema import Schema
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='XMU智能点餐 数据库结构迁移')
+    parser.add_argument('--check', action='store_true', help='只检查热点查询的执行计划，不执行迁移')
+    parser.add_argument('--env', default='../.env', help='配置文件路径')
+    args = parser.parse_args()
+
+    Logger.init(os.path.abspath(os.path.join(__file__, '../log/日志.log')))
+    config.GlobalSettings.init(_env_file=args.env)
+    Mysql.init()
+    Schema.init()
+
+    try:
+        if args.check:
+            Schema.check_hot_queries()
+        else:
+            Schema.run()
+    except XMUORDERException as e:
+        print(e, file=sys.stderr)
+        return 1
+    except pymysql.MySQLError as e:
+        print(f'数据库错误-{e}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
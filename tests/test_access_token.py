@@ -0,0 +1,74 @@
+"""
+access_token 刷新测试
+微信接口请求替换为本地函数，按顺序返回token
+运行：python -m pytest tests
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from xmuorder_server.logger import Logger
+from xmuorder_server.weixin import weixin
+from xmuorder_server.weixin.token_store import MemoryTokenStore
+from xmuorder_server.weixin.weixin import WeiXin
+
+test_logger = Logger('微信测试')
+
+
+@pytest.fixture
+def token_env(monkeypatch):
+    """
+    替换微信接口请求，返回 (请求得到的token列表, 设置请求耗时的函数)
+    """
+    issued = []
+    delay = {'value': 0.0}
+
+    async def request_access_token():
+        await asyncio.sleep(delay['value'])
+        token = f'token-{len(issued) + 1}'
+        issued.append(token)
+        WeiXin._WeiXin__access_token = token
+        WeiXin.expiration = datetime.now() + timedelta(hours=2)
+        return token
+
+    monkeypatch.setattr(weixin, 'logger', test_logger, raising=False)
+    monkeypatch.setattr(WeiXin, 'store', MemoryTokenStore())
+    monkeypatch.setattr(WeiXin, 'expiration', datetime.fromtimestamp(0))
+    monkeypatch.setattr(WeiXin, '_WeiXin__request_access_token', staticmethod(request_access_token))
+    return issued, lambda value: delay.__setitem__('value', value)
+
+
+def test_concurrent_refresh_single_flight(token_env):
+    issued, set_delay = token_env
+    set_delay(0.05)
+
+    async def run():
+        return await asyncio.gather(*[WeiXin.async_get_access_token() for _ in range(10)])
+
+    assert asyncio.run(run()) == ['token-1'] * 10
+    assert issued == ['token-1']
+
+
+def test_stale_caller_does_not_reuse_rejected_token(token_env):
+    """
+    stale调用方加入了在token被判定无效之前开始的刷新（返回的仍是被拒绝的token），需再刷新一次
+    """
+    issued, set_delay = token_env
+
+    async def run():
+        first = await WeiXin.async_get_access_token()
+        #   后台提前刷新：共享存储中的token未过期，直接返回，不请求微信接口
+        set_delay(0.05)
+        background = asyncio.ensure_future(WeiXin.refresh_access_token(ahead=0))
+        await asyncio.sleep(0)
+        #   微信判定first无效，此时后台刷新已在进行中
+        refreshed = await WeiXin.refresh_access_token(stale=first)
+        return first, await background, refreshed
+
+    first, background, refreshed = asyncio.run(run())
+
+    assert first == 'token-1'
+    assert background == 'token-1'
+    assert refreshed == 'token-2'
+    assert issued == ['token-1', 'token-2']
@@ -0,0 +1,166 @@
+"""
+云数据库导出批量导入测试
+导出任务、任务状态查询及文件下载接口使用本地替身(httpx.MockTransport)，mysql写入记录到列表
+运行：python -m pytest tests
+"""
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from xmuorder_server.common import XMUORDERException
+from xmuorder_server.logger import Logger
+from xmuorder_server.weixin import database
+from xmuorder_server.weixin.database import AsyncDatabase, BulkIngest
+from xmuorder_server.weixin.weixin import WeiXin
+
+FILE_URL = 'https://export.example.com/orders.json'
+test_logger = Logger('导出测试')
+
+
+class ExportStub:
+    """
+    导出接口替身：按statuses依次返回任务状态，下载返回lines
+    """
+
+    def __init__(self, statuses: list[str], lines: list[str] = (), download_status: int = 200):
+        self.statuses = list(statuses)
+        self.lines = list(lines)
+        self.download_status = download_status
+        self.export_body = None
+        self.polls = 0
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith('/databasemigrateexport'):
+            self.export_body = json.loads(request.content)
+            return httpx.Response(200, json={'errcode': 0, 'errmsg': 'ok', 'job_id': 7})
+        if request.url.path.endswith('/databasemigratequeryinfo'):
+            status = self.statuses[min(self.polls, len(self.statuses) - 1)]
+            self.polls += 1
+            return httpx.Response(200, json={
+                'errcode': 0, 'errmsg': 'ok', 'status': status, 'record_success': len(self.lines),
+                'record_fail': 0, 'err_msg': '导出失败' if status == 'fail' else '', 'file_url': FILE_URL
+            })
+        if str(request.url) == FILE_URL:
+            return httpx.Response(self.download_status, content='\n'.join(self.lines).encode())
+        return httpx.Response(404)
+
+
+class FakeConn:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def stub_env(monkeypatch):
+    """
+    替换access_token、HTTP客户端及mysql写入，返回 (安装替身的函数, 写入的批次列表)
+    """
+
+    async def get_access_token():
+        return 'token'
+
+    monkeypatch.setattr(database, 'logger', test_logger, raising=False)
+    monkeypatch.setattr(WeiXin, 'app_env', 'env', raising=False)
+    monkeypatch.setattr(WeiXin, 'async_get_access_token', staticmethod(get_access_token))
+    monkeypatch.setattr(AsyncDatabase, 'export_poll_interval', 0.01)
+    monkeypatch.setattr(AsyncDatabase, 'export_timeout', 5)
+    monkeypatch.setattr(AsyncDatabase, 'breaker', database.CircuitBreaker('测试'))
+
+    batches = []
+
+    def execute_many(conn, sql, rows):
+        batches.append(list(rows))
+        return len(rows)
+
+    monkeypatch.setattr(database.Mysql, 'connect', staticmethod(lambda: FakeConn()))
+    monkeypatch.setattr(database.Mysql, 'execute_many', staticmethod(execute_many))
+
+    def install(stub: ExportStub):
+        monkeypatch.setattr(AsyncDatabase, 'client', httpx.AsyncClient(
+            base_url='https://api.weixin.qq.com/tcb/', transport=httpx.MockTransport(stub.handler)))
+
+    return install, batches
+
+
+def test_export_polls_until_success(stub_env):
+    install, _ = stub_env
+    stub = ExportStub(['waiting', 'reading', 'success'])
+    install(stub)
+
+    url = asyncio.run(AsyncDatabase.export('orders', 'where({"a": 1}).get()'))
+
+    assert url == FILE_URL
+    assert stub.polls == 3
+    assert stub.export_body['query'] == 'db.collection("orders").where({"a": 1}).get()'
+    assert stub.export_body['file_path'].startswith('export/orders_')
+    assert stub.export_body['file_type'] == 1
+
+
+def test_export_fail(stub_env):
+    install, _ = stub_env
+    install(ExportStub(['waiting', 'fail']))
+
+    with pytest.raises(XMUORDERException, match='导出失败'):
+        asyncio.run(AsyncDatabase.export('orders', 'get()'))
+
+
+def test_export_timeout(stub_env, monkeypatch):
+    install, _ = stub_env
+    stub = ExportStub(['reading'])
+    install(stub)
+    monkeypatch.setattr(AsyncDatabase, 'export_timeout', 0.05)
+
+    with pytest.raises(XMUORDERException, match='超时'):
+        asyncio.run(AsyncDatabase.export('orders', 'get()'))
+    assert stub.polls > 1
+
+
+def test_download_lines_skips_blank_lines(stub_env):
+    install, _ = stub_env
+    install(ExportStub(['success'], ['{"a": 1}', '', '   ', '{"a": 2}', '']))
+
+    async def collect():
+        return [x async for x in AsyncDatabase.download_lines(FILE_URL)]
+
+    assert asyncio.run(collect()) == ['{"a": 1}', '{"a": 2}']
+
+
+def test_download_lines_non_200(stub_env):
+    install, _ = stub_env
+    install(ExportStub(['success'], ['{"a": 1}'], download_status=403))
+
+    async def collect():
+        return [x async for x in AsyncDatabase.download_lines(FILE_URL)]
+
+    with pytest.raises(XMUORDERException, match='403'):
+        asyncio.run(collect())
+
+
+def test_ingest_batches(stub_env):
+    install, batches = stub_env
+    lines = [json.dumps({'no': str(i), 'fee': {'$numberInt': str(i * 100)}}) for i in range(5)]
+    #   缺少主键的记录被to_row跳过
+    lines.insert(2, json.dumps({'fee': {'$numberInt': '1'}}))
+    install(ExportStub(['success'], lines))
+
+    def to_row(record: dict):
+        if 'no' not in record:
+            return None
+        return {'no': record['no'], 'fee': record['fee']}
+
+    report = asyncio.run(BulkIngest.ingest('orders', 'get()', 'insert ...', to_row, batch_size=2))
+
+    assert report == {'scanned': 6, 'written': 5, 'skipped': 1}
+    #   最后一批不满batch_size也写入
+    assert [len(x) for x in batches] == [2, 2, 1]
+    assert [row['no'] for batch in batches for row in batch] == ['0', '1', '2', '3', '4']
+    #   Extended JSON已解码
+    assert batches[2][0]['fee'] == 400
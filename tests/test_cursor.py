@@ -0,0 +1,111 @@
+"""
+云数据库游标测试
+聚合接口使用本地替身(httpx.MockTransport)，按skip返回分页数据，可指定某页失败
+运行：python -m pytest tests
+"""
+import asyncio
+import json
+import re
+
+import httpx
+import pytest
+
+from xmuorder_server.common import XMUORDERException
+from xmuorder_server.logger import Logger
+from xmuorder_server.weixin import database
+from xmuorder_server.weixin.breaker import CircuitBreaker
+from xmuorder_server.weixin.database import AsyncDatabase, TransientRequestError
+from xmuorder_server.weixin.weixin import WeiXin
+
+test_logger = Logger('游标测试')
+
+
+class AggregateStub:
+    """
+    聚合接口替身：records按skip/limit分页返回；failures为 {skip: [失败响应, ...]}，依次返回后才返回数据
+    """
+
+    def __init__(self, records: list[dict], failures: dict = None):
+        self.records = records
+        self.failures = failures or {}
+        self.requests = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        query = json.loads(request.content)['query']
+        skip = int(re.search(r'\.skip\((\d+)\)', query).group(1))
+        limit = int(re.search(r'\.limit\((\d+)\)', query).group(1))
+        self.requests.append(skip)
+        if self.failures.get(skip):
+            return self.failures[skip].pop(0)
+        page = self.records[skip:skip + limit]
+        return httpx.Response(200, json={'errcode': 0, 'errmsg': 'ok', 'data': [json.dumps(x) for x in page]})
+
+
+@pytest.fixture
+def install(monkeypatch):
+    """
+    替换access_token及HTTP客户端，请求不重试、不对冲，返回安装替身的函数
+    """
+
+    async def get_access_token():
+        return 'token'
+
+    monkeypatch.setattr(database, 'logger', test_logger, raising=False)
+    monkeypatch.setattr(WeiXin, 'app_env', 'env', raising=False)
+    monkeypatch.setattr(WeiXin, 'async_get_access_token', staticmethod(get_access_token))
+    monkeypatch.setattr(AsyncDatabase, 'max_retries', 0)
+    monkeypatch.setattr(AsyncDatabase, 'hedge', False)
+    monkeypatch.setattr(AsyncDatabase, 'page_retries', 1)
+    monkeypatch.setattr(AsyncDatabase, 'page_retry_delay', 0.01)
+    monkeypatch.setattr(AsyncDatabase, 'page_concurrency', 1)
+    monkeypatch.setattr(AsyncDatabase, 'breaker', CircuitBreaker('测试', failure_threshold=100))
+
+    def install_stub(stub: AggregateStub):
+        monkeypatch.setattr(AsyncDatabase, 'client', httpx.AsyncClient(
+            base_url='https://api.weixin.qq.com/tcb/', transport=httpx.MockTransport(stub.handler)))
+
+    return install_stub
+
+
+def collect(page_size: int = 2) -> list:
+    async def run():
+        return [x async for x in AsyncDatabase.cursor('orders', 'aggregate().match({})', page_size=page_size)]
+
+    return asyncio.run(run())
+
+
+def test_cursor_reads_all_pages(install):
+    stub = AggregateStub([{'i': i} for i in range(5)])
+    install(stub)
+
+    assert collect() == [{'i': i} for i in range(5)]
+    assert stub.requests == [0, 2, 4]
+
+
+def test_cursor_retries_only_the_failed_page(install):
+    stub = AggregateStub([{'i': i} for i in range(5)], failures={2: [httpx.Response(503)]})
+    install(stub)
+
+    assert collect() == [{'i': i} for i in range(5)]
+    #   第二页重试一次，已读取的第一页不重新读取
+    assert stub.requests == [0, 2, 2, 4]
+
+
+def test_cursor_gives_up_after_page_retries(install):
+    stub = AggregateStub([{'i': i} for i in range(5)], failures={2: [httpx.Response(503)] * 2})
+    install(stub)
+
+    with pytest.raises(TransientRequestError):
+        collect()
+    assert stub.requests == [0, 2, 2]
+
+
+def test_cursor_does_not_retry_errcode(install):
+    error = httpx.Response(200, json={'errcode': -502001, 'errmsg': '查询语句错误'})
+    stub = AggregateStub([{'i': i} for i in range(5)], failures={2: [error]})
+    install(stub)
+
+    with pytest.raises(XMUORDERException) as info:
+        collect()
+    assert not isinstance(info.value, TransientRequestError)
+    assert stub.requests == [0, 2]
@@ -0,0 +1,180 @@
+"""
+订单镜像测试
+mysql替换为内存中的检查点及写入记录，云数据库游标、导出任务替换为本地列表
+运行：python -m pytest tests
+"""
+import asyncio
+import json
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from xmuorder_server.logger import Logger
+from xmuorder_server.routers import statistics
+from xmuorder_server.routers.statistics import OrderStatistics
+from xmuorder_server.weixin import mirror
+from xmuorder_server.weixin.database import SyncCheckpoint
+from xmuorder_server.weixin.mirror import Mirror, OrderMirror
+
+test_logger = Logger('订单镜像测试')
+
+
+class FakeConnection:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def commit(self):
+        pass
+
+
+def order(out_trade_no: str, confirm_time: str) -> dict:
+    return {'orderInfo': {'outTradeNo': out_trade_no, 'timeInfo': {'confirmTime': confirm_time}}}
+
+
+@pytest.fixture
+def mirror_env(monkeypatch):
+    """
+    替换mysql及云数据库读取，返回 (检查点, 写入的行, 云端记录列表)
+    """
+    checkpoints, rows, records = {}, {}, []
+
+    def execute_many(conn, sql, batch):
+        for row in batch:
+            rows[row['outTradeNo']] = row
+        return len(batch)
+
+    def execute_fetchone(conn, sql, **params):
+        times = [x['confirmTime'] for x in rows.values()]
+        return (min(times) if times else None,)
+
+    async def cursor(collection_name, query, page_size=100):
+        for record in records:
+            yield record
+
+    async def ingest(collection_name, query, sql, to_row, batch_size=2000):
+        match = re.search(r'where\(.*?(\d{14})', query)
+        since = match.group(1) if match else ''
+        batch = [to_row(x) for x in records if x['orderInfo']['timeInfo']['confirmTime'] >= since]
+        execute_many(None, sql, batch)
+        return {'scanned': len(batch), 'written': len(batch), 'skipped': 0}
+
+    monkeypatch.setattr(mirror, 'logger', test_logger, raising=False)
+    monkeypatch.setattr(mirror.Mysql, 'connect', staticmethod(lambda: FakeConnection()))
+    monkeypatch.setattr(mirror.Mysql, 'execute_many', staticmethod(execute_many))
+    monkeypatch.setattr(mirror.Mysql, 'execute_fetchone', staticmethod(execute_fetchone))
+    monkeypatch.setattr(SyncCheckpoint, 'get', staticmethod(lambda conn, name: checkpoints.get(name)))
+    monkeypatch.setattr(SyncCheckpoint, 'set', staticmethod(lambda conn, name, mark: checkpoints.__setitem__(name, mark)))
+    monkeypatch.setattr(mirror.AsyncDatabase, 'cursor', staticmethod(cursor))
+    monkeypatch.setattr(mirror.BulkIngest, 'ingest', staticmethod(ingest))
+    monkeypatch.setattr(OrderMirror, 'read', True)
+    monkeypatch.setattr(OrderMirror, 'max_lag', 600)
+    return checkpoints, rows, records
+
+
+def new_mirror() -> Mirror:
+    """
+    同名镜像的新实例，相当于另一个进程中的镜像
+    """
+    return Mirror(name='orders', collection_name='orders', table='order_mirror', key_column='outTradeNo',
+                  cursor_field='orderInfo.timeInfo.confirmTime',
+                  columns={'outTradeNo': 'orderInfo.outTradeNo', 'confirmTime': 'orderInfo.timeInfo.confirmTime'},
+                  cursor_format='%Y%m%d%H%M%S', lookback=1800)
+
+
+def test_usable_in_process_without_sync(mirror_env, monkeypatch):
+    _, _, records = mirror_env
+    records.extend([order('a', '20220401120000'), order('b', '20220402120000')])
+    reader = new_mirror()
+    monkeypatch.setattr(OrderMirror, 'mirror', reader, raising=False)
+
+    async def run():
+        before = await OrderMirror.usable('202204010000')
+        await new_mirror().sync()
+        #   本进程缓存的状态过期后读取其他进程写入的同步时间
+        reader.state_ttl = 0
+        return before, await OrderMirror.usable('202204010000')
+
+    assert asyncio.run(run()) == (False, True)
+
+
+def test_backfill_after_checkpoint_records_lower_bound(mirror_env, monkeypatch):
+    checkpoints, _, records = mirror_env
+    records.extend([order('a', '20220401120000'), order('b', '20220601120000')])
+    checkpoints['mirror:orders'] = '20220101120000'
+    checkpoints['mirror:orders:from'] = '20220101000000'
+    writer = new_mirror()
+    monkeypatch.setattr(OrderMirror, 'mirror', writer, raising=False)
+
+    async def run():
+        report = await writer.backfill('20220501000000')
+        await writer.sync()
+        return report, await OrderMirror.usable('202204010000'), await OrderMirror.usable('202205010000')
+
+    report, before_since, after_since = asyncio.run(run())
+
+    #   原检查点与回填起点之间的记录未写入，下界为回填起点
+    assert report['checkpoint'] == '20220601120000'
+    assert checkpoints['mirror:orders:from'] == '20220501000000'
+    assert (before_since, after_since) == (False, True)
+
+
+def test_backfill_before_checkpoint_extends_lower_bound(mirror_env):
+    checkpoints, _, records = mirror_env
+    records.extend([order('a', '20220401120000'), order('b', '20220601120000')])
+    checkpoints['mirror:orders'] = '20220601120000'
+    checkpoints['mirror:orders:from'] = '20220501000000'
+
+    asyncio.run(new_mirror().backfill('20220301000000'))
+
+    assert checkpoints['mirror:orders:from'] == '20220301000000'
+
+
+def test_legacy_lower_bound_from_table(mirror_env):
+    checkpoints, rows, _ = mirror_env
+    checkpoints['mirror:orders'] = '20220601120000'
+    rows['a'] = {'outTradeNo': 'a', 'confirmTime': '20220401120000'}
+
+    assert asyncio.run(new_mirror().covers('20220401120000'))
+    assert checkpoints['mirror:orders:from'] == '20220401120000'
+
+
+def test_shop_records_closed_when_calculation_fails(monkeypatch):
+    events = []
+
+    class FakeAsyncConnection:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            events.append('release')
+
+    async def connect():
+        return FakeAsyncConnection()
+
+    async def execute_stream(conn, sql, chunk_size=1000, **params):
+        try:
+            yield [(json.dumps([{'typeName': '主食', 'num': 1, 'price': '1.5'}]),), ('[{}]',), ('[]',)]
+        finally:
+            events.append('close')
+
+    async def usable(begin_time=None):
+        return True
+
+    monkeypatch.setattr(statistics, 'logger', test_logger, raising=False)
+    monkeypatch.setattr(statistics.GlobalSettings, 'get', staticmethod(lambda: SimpleNamespace()))
+    monkeypatch.setattr(mirror.AsyncMysql, 'connect', staticmethod(connect))
+    monkeypatch.setattr(mirror.AsyncMysql, 'execute_stream', staticmethod(execute_stream))
+    monkeypatch.setattr(OrderMirror, 'usable', staticmethod(usable))
+
+    async def run():
+        try:
+            await OrderStatistics.cal_range('c1', '20220401', '20220401')
+        except Exception:
+            #   异常抛出时游标已关闭、连接已归还，不等待垃圾回收
+            return list(events)
+
+    assert asyncio.run(run()) == ['close', 'release']
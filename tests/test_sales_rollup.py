@@ -0,0 +1,75 @@
+"""
+销售日汇总测试
+统计日期范围按已汇总的范围拆分，汇总表查询及实时计算记录到列表
+运行：python -m pytest tests
+"""
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+from xmuorder_server.logger import Logger
+from xmuorder_server.routers import statistics
+from xmuorder_server.routers.statistics import OrderStatistics, ShopStatisticsModel
+from xmuorder_server.weixin.rollup import SalesRollup
+
+ROLLED = ('20220401', '20220630')
+test_logger = Logger('统计测试')
+
+
+def test_split_inside_rolled_range():
+    assert SalesRollup.split('20220410', '20220420', ROLLED) == (('20220410', '20220420'), [])
+
+
+def test_split_before_backfill_window():
+    #   起始日期早于首次汇总的第一天，之前的日期实时计算
+    assert SalesRollup.split('20220101', '20220630', ROLLED) == (
+        ('20220401', '20220630'), [('20220101', '20220331')])
+
+
+def test_split_around_rolled_range():
+    assert SalesRollup.split('20220301', '20220705', ROLLED) == (
+        ('20220401', '20220630'), [('20220301', '20220331'), ('20220701', '20220705')])
+
+
+def test_split_outside_rolled_range():
+    assert SalesRollup.split('20220101', '20220331', ROLLED) == (None, [('20220101', '20220331')])
+    assert SalesRollup.split('20220701', '20220705', ROLLED) == (None, [('20220701', '20220705')])
+    assert SalesRollup.split('20220101', '20220105', None) == (None, [('20220101', '20220105')])
+
+
+@pytest.fixture
+def shop_env(monkeypatch):
+    """
+    替换汇总表查询及实时计算，返回 (汇总表查询的范围, 实时计算的范围)
+    """
+    rollup_calls, live_calls = [], []
+
+    async def rolled_range():
+        return ROLLED
+
+    async def query(cid, begin_date, end_date):
+        rollup_calls.append((begin_date, end_date))
+        return {'主食': {'income': Decimal('10.00'), 'salesAmount': 2}}
+
+    async def cal_range(cid, begin_date, end_date):
+        live_calls.append((begin_date, end_date))
+        return {'主食': {'income': Decimal('1.50'), 'salesAmount': 1}}
+
+    monkeypatch.setattr(statistics, 'logger', test_logger, raising=False)
+    monkeypatch.setattr(SalesRollup, 'enabled', True)
+    monkeypatch.setattr(SalesRollup, 'rolled_range', staticmethod(rolled_range))
+    monkeypatch.setattr(SalesRollup, 'query', staticmethod(query))
+    monkeypatch.setattr(OrderStatistics, 'cal_range', staticmethod(cal_range))
+    return rollup_calls, live_calls
+
+
+def test_shop_info_before_backfill_window(shop_env):
+    rollup_calls, live_calls = shop_env
+    data = ShopStatisticsModel(cID='c1', begin_date='20220101', end_date='20220630')
+
+    out = asyncio.run(statistics.shop_info(data, verify=True))
+
+    assert rollup_calls == [('20220401', '20220630')]
+    assert live_calls == [('20220101', '20220331')]
+    assert out['data'] == [{'typeName': '主食', 'income': Decimal('11.50'), 'salesAmount': 3}]
@@ -0,0 +1,157 @@
+"""
+access_token 共享存储测试
+同一路径的多个FileTokenStore实例模拟同一主机上的多个进程
+运行：python -m pytest tests
+"""
+import threading
+import time
+
+import pytest
+
+from xmuorder_server.weixin.token_store import TokenStore, FileTokenStore
+
+
+def make_token(i: int) -> str:
+    #   长度随i变化，读到新旧两次写入拼接的结果时无法与过期时间对应
+    return f'token-{i}-' * (i % 7 + 1)
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'access_token')
+
+
+def test_token_store_is_abstract():
+    with pytest.raises(TypeError):
+        TokenStore()
+
+    class ReadOnlyStore(TokenStore):
+        def read(self):
+            return None
+
+    with pytest.raises(TypeError):
+        ReadOnlyStore()
+
+
+def test_file_store_shared_between_instances(store_path):
+    writer, reader = FileTokenStore(store_path), FileTokenStore(store_path)
+    try:
+        assert reader.read() is None
+        writer.write('abc', 100.0)
+        assert reader.read() == ('abc', 100.0)
+        writer.write('a-much-longer-token', 200.0)
+        assert reader.read() == ('a-much-longer-token', 200.0)
+    finally:
+        writer.close()
+        reader.close()
+
+
+def test_file_store_refresh_lock_is_exclusive(store_path):
+    a, b = FileTokenStore(store_path), FileTokenStore(store_path)
+    try:
+        assert a.acquire(timeout=1)
+        assert not b.acquire(timeout=0.1)
+        a.release()
+        assert b.acquire(timeout=1)
+        b.release()
+    finally:
+        a.close()
+        b.close()
+
+
+def test_file_store_read_retries_on_torn_read(store_path):
+    """
+    读取token期间发生写入（序号改变），需重读，不能返回新旧拼接的结果
+    """
+    writer, reader = FileTokenStore(store_path), FileTokenStore(store_path)
+    writer.write('old', 1.0)
+
+    class WriteDuringRead:
+        """
+        第一次读取头部后立即写入新token，模拟读取过程中另一个进程写入
+        """
+
+        def __init__(self):
+            self.calls = 0
+
+        def unpack_from(self, buffer, offset=0):
+            res = FileTokenStore.HEADER.unpack_from(buffer, offset)
+            self.calls += 1
+            if self.calls == 1:
+                writer.write('new-token', 2.0)
+            return res
+
+        @property
+        def size(self):
+            return FileTokenStore.HEADER.size
+
+    hook = WriteDuringRead()
+    reader.HEADER = hook
+    try:
+        assert reader.read() == ('new-token', 2.0)
+        #   第一次读取被丢弃后重读：头部共读取4次
+        assert hook.calls == 4
+    finally:
+        writer.close()
+        reader.close()
+
+
+def test_file_store_read_waits_for_writer(store_path):
+    """
+    序号为奇数（正在写入）时不返回数据，写入完成后读到完整结果
+    """
+    writer, reader = FileTokenStore(store_path), FileTokenStore(store_path)
+    writer.write('old', 1.0)
+    mm = writer._FileTokenStore__mmap
+    seq = FileTokenStore.HEADER.unpack_from(mm, 0)[0]
+    FileTokenStore.HEADER.pack_into(mm, 0, seq + 1, 1.0, 3)
+    try:
+        reader.READ_RETRY = 5
+        assert reader.read() is None
+        FileTokenStore.HEADER.pack_into(mm, 0, seq + 2, 1.0, 3)
+        assert reader.read() == ('old', 1.0)
+    finally:
+        writer.close()
+        reader.close()
+
+
+def test_file_store_concurrent_readers(store_path):
+    """
+    一个写入线程不断写入，多个读取线程读到的token始终与过期时间对应
+    """
+    writer = FileTokenStore(store_path)
+    readers = [FileTokenStore(store_path) for _ in range(4)]
+    writer.write(make_token(0), 0.0)
+    stop = threading.Event()
+    errors, reads = [], [0] * len(readers)
+
+    def write_loop():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            writer.write(make_token(i), float(i))
+
+    def read_loop(index: int, store: FileTokenStore):
+        while not stop.is_set():
+            res = store.read()
+            if res is None:
+                continue
+            token, expires_at = res
+            if token != make_token(int(expires_at)):
+                errors.append(res)
+            reads[index] += 1
+
+    threads = [threading.Thread(target=write_loop)]
+    threads += [threading.Thread(target=read_loop, args=(i, x)) for i, x in enumerate(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)
+    stop.set()
+    for t in threads:
+        t.join()
+    writer.close()
+    for x in readers:
+        x.close()
+
+    assert errors == []
+    assert all(x > 0 for x in reads)
@@ -1,4 +1,5 @@
-from typing import Optional
+import math
+from typing import Optional, Sequence
 
 
 class ErrorInfo:
@@ -69,3 +70,16 @@ class WithMsgException(Exception):
     def __init__(self, msg: str, data=None):
         self.msg = msg
         self.data = data
+
+
+def percentile(data: Sequence[float], p: float) -> float:
+    """
+    计算百分位数（最近秩法），data为空时返回0
+    :param data: 数据
+    :param p: 百分位 0~100
+    """
+    if not data:
+        return 0.0
+    ordered = sorted(data)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
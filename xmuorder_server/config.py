@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseSettings
 
 
@@ -7,11 +9,55 @@ class Settings(BaseSettings):
     database_user: str
     database_password: str
     database_name: str
+    database_replica_host: Optional[str] = None  # 从库地址，配置后查询走从库
+    database_replica_port: int = 3306
+    database_replica_user: Optional[str] = None  # 不配置则与主库相同
+    database_replica_password: Optional[str] = None  # 不配置则与主库相同
+    database_pool_min: int = 2  # 连接池最少连接数
+    database_pool_max: int = 10  # 连接池最多连接数
+    database_pool_adaptive: bool = False  # 是否根据等待时间在[min, max]之间自动调整连接数
+    database_pool_grow_wait_ms: float = 50  # 自适应模式下，等待时间p90超过此值则扩容
+    database_pool_adjust_interval: float = 10  # 自适应模式下，调整连接数的最小间隔(秒)
+    database_batch_pool_max: int = 2  # 多语句连接池(execute_batch专用)最多连接数，其他连接池不允许多语句
+    database_slow_query_ms: float = 200  # 慢查询日志阈值(ms)
+    database_cache_ttl: float = 60  # 查询缓存过期时间(秒)
+    database_cache_size: int = 1024  # 查询缓存最多条数
+    database_migrate_on_startup: bool = False  # 启动时执行数据库结构迁移及热点查询检查
     secret_id: str
     secret_key: str
     app_id: str
     app_secret: str
     app_env: str
+    weixin_token_store: str = 'memory'  # access_token共享存储 memory: 进程内; file: 文件锁+mmap，同一主机多进程共享
+    weixin_http_max_connections: int = 20  # 微信接口HTTP连接池最大连接数
+    weixin_http_max_keepalive: int = 10  # 微信接口HTTP连接池最多保持的空闲连接数
+    weixin_http_keepalive_expiry: float = 30  # 空闲连接保持时间(秒)
+    weixin_http_timeout: float = 10  # 微信接口请求超时(秒)
+    weixin_http_connect_timeout: float = 5  # 微信接口建立连接超时(秒)
+    weixin_retries: int = 2  # 微信接口网络错误、系统繁忙时的重试次数
+    weixin_breaker_threshold: int = 5  # 微信接口连续失败次数达到此值后熔断
+    weixin_breaker_recovery: float = 30  # 熔断后多久放行试探请求(秒)
+    weixin_hedge: bool = False  # 是否对云数据库只读请求(count/query/aggregate)进行对冲
+    weixin_hedge_percentile: float = 95  # 超过近期耗时的该分位仍未返回则再发一次
+    weixin_hedge_budget: float = 0.05  # 对冲产生的额外请求不超过只读请求总数的比例
+    weixin_page_concurrency: int = 5  # 微信云数据库并发分页请求数上限
+    weixin_page_retries: int = 1  # 游标单页在请求重试后仍临时失败（网络错误、5xx、系统繁忙、熔断中）时整页重试的次数
+    weixin_batch_size: int = 20  # 订单查询合并：一批最多合并的订单数
+    weixin_batch_wait_ms: float = 5  # 订单查询合并：最多等待时间(ms)
+    weixin_http2: bool = False  # 是否使用HTTP/2（需安装h2）
+    weixin_export_poll_interval: float = 2  # 云数据库导出任务查询状态间隔(秒)
+    weixin_export_timeout: float = 600  # 云数据库导出任务最长等待时间(秒)
+    weixin_token_store_path: Optional[str] = None  # file存储路径，默认为临时目录下 xmuorder_access_token_{app_id}
+    statistics_server_aggregate: bool = True  # 商店统计在云端按类别聚合（失败时回退到本地计算）
+    statistics_verify_aggregate: bool = False  # 同时进行本地计算并比较结果，不一致时记录日志并使用本地结果
+    statistics_rollup_enabled: bool = False  # 商店统计使用销售日汇总表(sales_rollup)，每日定时汇总前一天
+    statistics_rollup_days: int = 90  # 首次汇总时回溯的天数
+    orders_mirror_enabled: bool = False  # 是否定时将云数据库orders集合增量同步到本地order_mirror表
+    orders_mirror_interval: float = 60  # 订单镜像同步间隔(秒)
+    orders_mirror_lookback: int = 1800  # 每次同步从检查点往前回溯的秒数，用于更新近期状态变化的订单
+    orders_mirror_reconcile_days: int = 3  # 每次同步后重新读取最近几天内尚未完成（未成功、外卖未送达）的订单
+    orders_mirror_read: bool = False  # 统计、打印订单查询是否读取本地镜像（镜像延迟过大时仍请求云数据库）
+    orders_mirror_max_lag: float = 600  # 镜像延迟超过此值(秒)时不读取镜像
     printer_user: str
     printer_key: str
 
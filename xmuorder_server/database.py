@@ -1,7 +1,18 @@
+import asyncio
+import re
+import threading
+import time
+from collections import deque, OrderedDict
+from functools import lru_cache
+from typing import Optional
+
+import aiomysql
 import pymysql
 from dbutils.pooled_db import PooledDB
+from pymysql.constants import CLIENT
 import atexit
 
+from .common import percentile
 from .config import GlobalSettings
 from .logger import Logger
 
@@ -13,8 +24,384 @@ from .logger import Logger
 logger: Logger
 
 
+class PoolMonitor:
+    """
+    连接池监控
+    记录取连接等待时间、连接占用时间、使用中/等待中连接数、连接耗尽次数
+    自适应模式下，根据等待时间在[min_size, max_size]之间调整允许同时取出的连接数(limit)
+    """
+    WINDOW_SIZE = 500  # 等待/占用时间的统计窗口大小
+
+    def __init__(self, name: str, min_size: int, max_size: int, adaptive: bool = False,
+                 grow_wait_ms: float = 50, adjust_interval: float = 10):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.adaptive = adaptive
+        self.grow_wait_ms = grow_wait_ms
+        self.adjust_interval = adjust_interval
+        #   非自适应模式下 limit 固定为 max_size
+        self.limit = min_size if adaptive else max_size
+
+        self.in_use = 0  # 使用中的连接数
+        self.waiting = 0  # 等待取连接的数量
+        self.checkouts = 0  # 累计取连接次数
+        self.exhausted = 0  # 累计连接耗尽（需要等待）次数
+        self.grow_times = 0  # 累计扩容次数
+        self.shrink_times = 0  # 累计缩容次数
+        self.wait_ms = deque(maxlen=self.WINDOW_SIZE)
+        self.hold_ms = deque(maxlen=self.WINDOW_SIZE)
+
+        #   当前调整周期内的统计
+        self._period_wait_ms = []
+        self._period_exhausted = 0
+        self._period_peak = 0
+        self._last_adjust = time.monotonic()
+        self._lock = threading.Lock()
+
+    def is_exhausted(self) -> bool:
+        return self.in_use >= self.limit
+
+    def on_wait(self):
+        """
+        取连接时连接已耗尽，开始等待
+        """
+        with self._lock:
+            self.exhausted += 1
+            self._period_exhausted += 1
+            self.waiting += 1
+
+    def on_wait_end(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def on_checkout(self, wait_sec: float):
+        """
+        成功取出连接
+        :param wait_sec: 等待时间(秒)
+        """
+        with self._lock:
+            self.checkouts += 1
+            self.wait_ms.append(wait_sec * 1000)
+            self._period_wait_ms.append(wait_sec * 1000)
+            self._period_peak = max(self._period_peak, self.in_use)
+
+    def on_release(self, hold_sec: float):
+        """
+        连接已归还
+        :param hold_sec: 占用时间(秒)
+        """
+        with self._lock:
+            self.hold_ms.append(hold_sec * 1000)
+        self.adjust()
+
+    def adjust(self) -> None:
+        """
+        自适应模式下调整limit，每个调整周期最多调整一次
+        1. 周期内出现连接耗尽且等待时间p90超过阈值：扩容
+        2. 周期内无连接耗尽且峰值使用数小于limit-1：缩容
+        """
+        if not self.adaptive:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_adjust < self.adjust_interval:
+                return
+            wait_p90 = percentile(self._period_wait_ms, 90)
+            if self._period_exhausted > 0 and wait_p90 >= self.grow_wait_ms and self.limit < self.max_size:
+                self.limit += 1
+                self.grow_times += 1
+                logger.info(f'[{self.name}]连接池扩容 limit={self.limit} 等待p90={wait_p90:.1f}ms')
+            elif self._period_exhausted == 0 and self._period_peak < self.limit - 1 and self.limit > self.min_size:
+                self.limit -= 1
+                self.shrink_times += 1
+                logger.info(f'[{self.name}]连接池缩容 limit={self.limit} 峰值使用数={self._period_peak}')
+
+            self._period_wait_ms = []
+            self._period_exhausted = 0
+            self._period_peak = self.in_use
+            self._last_adjust = now
+
+    def stats(self, idle: int = None) -> dict:
+        """
+        返回连接池统计信息
+        :param idle: 空闲连接数（由连接池提供）
+        """
+        with self._lock:
+            wait_ms = list(self.wait_ms)
+            hold_ms = list(self.hold_ms)
+            return {
+                'name': self.name,
+                'adaptive': self.adaptive,
+                'limit': self.limit,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'in_use': self.in_use,
+                'idle': idle,
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'exhausted': self.exhausted,
+                'grow_times': self.grow_times,
+                'shrink_times': self.shrink_times,
+                'wait_ms': PoolMonitor.__summary(wait_ms),
+                'hold_ms': PoolMonitor.__summary(hold_ms),
+            }
+
+    @staticmethod
+    def __summary(data: list) -> dict:
+        return {
+            'avg': round(sum(data) / len(data), 3) if data else 0.0,
+            'p50': round(percentile(data, 50), 3),
+            'p99': round(percentile(data, 99), 3),
+            'max': round(max(data), 3) if data else 0.0
+        }
+
+
+class QueryProfiler:
+    """
+    SQL性能分析
+    将sql规范化为指纹，按指纹统计执行次数、总耗时、p50/p99耗时、行数，并记录慢查询
+    """
+    WINDOW_SIZE = 500  # 每个指纹保留的耗时样本数
+    slow_ms: float = 200  # 慢查询阈值(ms)
+    __records: dict = {}  # {指纹: 统计信息}
+    __lock = threading.Lock()
+
+    @classmethod
+    def init(cls, slow_ms: float):
+        cls.slow_ms = slow_ms
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def fingerprint(sql: str) -> str:
+        """
+        sql规范化：去除注释，字符串、数字、占位符替换为?，合并in列表，压缩空白
+        :param sql: sql语句
+        :return: 指纹
+        """
+        fp = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", '?', sql)
+        fp = re.sub(r'/\*.*?\*/|(?:#|-- )[^\n]*', ' ', fp, flags=re.S)
+        fp = re.sub(r'%\(\w+\)s|%s', '?', fp)
+        fp = re.sub(r'\b\d+(?:\.\d+)?\b', '?', fp)
+        fp = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?+)', fp)
+        fp = re.sub(r'\s+', ' ', fp).strip().rstrip(';').strip()
+        return fp.lower()
+
+    @classmethod
+    def record(cls, sql: str, elapsed: float, rows: int = 0):
+        """
+        记录一次sql执行
+        :param sql: sql语句
+        :param elapsed: 耗时(秒)
+        :param rows: 返回（或影响）的行数
+        """
+        fp = cls.fingerprint(sql)
+        elapsed_ms = elapsed * 1000
+        rows = max(rows or 0, 0)
+        with cls.__lock:
+            if fp not in cls.__records:
+                cls.__records[fp] = {
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'rows': 0,
+                    'samples': deque(maxlen=cls.WINDOW_SIZE)
+                }
+            record = cls.__records[fp]
+            record['count'] += 1
+            record['total_ms'] += elapsed_ms
+            record['rows'] += rows
+            record['samples'].append(elapsed_ms)
+
+        if elapsed_ms >= cls.slow_ms:
+            #   仅记录指纹，不记录参数（可能包含手机号等隐私信息）
+            logger.warning(f'慢查询 {elapsed_ms:.1f}ms rows={rows} -{fp}')
+
+    @classmethod
+    def stats(cls, top: int = None) -> list[dict]:
+        """
+        按总耗时降序返回各指纹的统计信息
+        :param top: 只返回前top条，None表示全部
+        """
+        with cls.__lock:
+            items = [(fp, dict(record, samples=list(record['samples']))) for fp, record in cls.__records.items()]
+
+        out = [{
+            'fingerprint': fp,
+            'count': record['count'],
+            'total_ms': round(record['total_ms'], 3),
+            'avg_ms': round(record['total_ms'] / record['count'], 3),
+            'p50_ms': round(percentile(record['samples'], 50), 3),
+            'p99_ms': round(percentile(record['samples'], 99), 3),
+            'rows': record['rows']
+        } for fp, record in items]
+        out.sort(key=lambda x: x['total_ms'], reverse=True)
+        return out if top is None else out[:top]
+
+    @classmethod
+    def reset(cls):
+        with cls.__lock:
+            cls.__records.clear()
+
+
+class QueryCache:
+    """
+    查询结果缓存（进程内），TTL过期 + LRU淘汰
+    key为sql及参数；通过execute_only/execute_batch写入某张表时，该表相关的缓存全部失效
+    适用于变化少、读取频繁的小表查询，如 printer、phone、canteen
+    """
+    ttl: float = 60  # 默认过期时间(秒)
+    max_size: int = 1024  # 最多缓存条数，超出按LRU淘汰
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    __data: OrderedDict = OrderedDict()  # {key: (过期时间, 结果, 涉及的表)}
+    __table_keys: dict = {}  # {表名: {key, ...}}
+    __generation: dict = {}  # {表名: 失效次数}，防止失效前发起的查询把旧结果写回缓存
+    __lock = threading.Lock()
+    MISS = object()
+
+    @classmethod
+    def init(cls, ttl: float, max_size: int):
+        cls.ttl = ttl
+        cls.max_size = max_size
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def read_tables(sql: str) -> tuple:
+        """
+        解析查询语句涉及的表
+        """
+        return tuple(set(re.findall(r'\b(?:from|join) `?(\w+)`?', QueryProfiler.fingerprint(sql))))
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def write_tables(sql: str) -> tuple:
+        """
+        解析写入语句涉及的表（排除 ON DUPLICATE KEY UPDATE）
+        """
+        return tuple(set(re.findall(r'\b(?:insert (?:ignore )?into|replace into|(?<!key )update|delete from) `?(\w+)`?',
+                                    QueryProfiler.fingerprint(sql))))
+
+    @staticmethod
+    def key(sql: str, params: dict) -> str:
+        return f'{sql}|{sorted(params.items())!r}'
+
+    @classmethod
+    def generation(cls, sql: str) -> tuple:
+        with cls.__lock:
+            return tuple(cls.__generation.get(table, 0) for table in cls.read_tables(sql))
+
+    @classmethod
+    def get(cls, key: str):
+        """
+        获取缓存，不存在或已过期返回 QueryCache.MISS
+        """
+        with cls.__lock:
+            item = cls.__data.get(key)
+            if item is None or item[0] < time.monotonic():
+                cls.misses += 1
+                return cls.MISS
+            cls.__data.move_to_end(key)
+            cls.hits += 1
+            return item[1]
+
+    @classmethod
+    def set(cls, key: str, sql: str, value, generation: tuple, ttl: float = None):
+        """
+        写入缓存
+        :param key: 缓存key
+        :param sql: 查询语句（用于解析涉及的表）
+        :param value: 查询结果
+        :param generation: 查询前通过generation()获取，查询期间表被写入则不缓存
+        :param ttl: 过期时间(秒)，None则使用默认值
+        """
+        tables = cls.read_tables(sql)
+        with cls.__lock:
+            if generation != tuple(cls.__generation.get(table, 0) for table in tables):
+                return
+            cls.__data[key] = (time.monotonic() + (cls.ttl if ttl is None else ttl), value, tables)
+            cls.__data.move_to_end(key)
+            for table in tables:
+                cls.__table_keys.setdefault(table, set()).add(key)
+            while len(cls.__data) > cls.max_size:
+                old_key, (_, _, old_tables) = cls.__data.popitem(last=False)
+                for table in old_tables:
+                    cls.__table_keys.get(table, set()).discard(old_key)
+                cls.evictions += 1
+
+    @classmethod
+    def invalidate(cls, table: str):
+        """
+        使某张表相关的缓存全部失效
+        """
+        with cls.__lock:
+            cls.__generation[table] = cls.__generation.get(table, 0) + 1
+            for key in cls.__table_keys.pop(table, set()):
+                item = cls.__data.pop(key, None)
+                if item is not None:
+                    cls.invalidations += 1
+                    for other in item[2]:
+                        if other != table:
+                            cls.__table_keys.get(other, set()).discard(key)
+
+    @classmethod
+    def invalidate_sql(cls, sql: str):
+        """
+        根据写入语句使相关表的缓存失效
+        """
+        for table in cls.write_tables(sql):
+            cls.invalidate(table)
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls.__lock:
+            total = cls.hits + cls.misses
+            return {
+                'size': len(cls.__data),
+                'max_size': cls.max_size,
+                'ttl': cls.ttl,
+                'hits': cls.hits,
+                'misses': cls.misses,
+                'hit_rate': round(cls.hits / total, 4) if total else 0.0,
+                'evictions': cls.evictions,
+                'invalidations': cls.invalidations
+            }
+
+
+class _MonitoredConnection:
+    """
+    PooledDB连接代理，close(归还连接)时通知连接池监控
+    """
+
+    def __init__(self, conn, on_close: callable):
+        self._conn = conn
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._on_close is None:
+            return
+        on_close, self._on_close = self._on_close, None
+        try:
+            self._conn.close()
+        finally:
+            on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class Mysql:
     pool: PooledDB  # 数据库连接池
+    batch_pool: PooledDB  # 多语句连接池，只用于execute_batch
+    monitor: PoolMonitor  # 连接池监控
+    __cond: threading.Condition  # 等待可用连接
 
     @classmethod
     def init(cls):
@@ -24,11 +411,23 @@ class Mysql:
         #   读取密钥环境等
         global_setting = GlobalSettings.get()
 
+        cls.monitor = PoolMonitor(
+            name='Mysql',
+            min_size=global_setting.database_pool_min,
+            max_size=global_setting.database_pool_max,
+            adaptive=global_setting.database_pool_adaptive,
+            grow_wait_ms=global_setting.database_pool_grow_wait_ms,
+            adjust_interval=global_setting.database_pool_adjust_interval
+        )
+        cls.__cond = threading.Condition()
+        QueryProfiler.init(slow_ms=global_setting.database_slow_query_ms)
+        QueryCache.init(ttl=global_setting.database_cache_ttl, max_size=global_setting.database_cache_size)
+
         cls.pool = PooledDB(
             creator=pymysql,  # 使用链接数据库的模块
-            maxconnections=10,  # 连接池允许的最大连接数，0和None表示不限制连接数
-            mincached=2,  # 初始化时，链接池中至少创建的空闲的链接，0表示不创建
-            maxcached=5,  # 链接池中最多闲置的链接，0和None不限制
+            maxconnections=global_setting.database_pool_max,  # 连接池允许的最大连接数，0和None表示不限制连接数
+            mincached=global_setting.database_pool_min,  # 初始化时，链接池中至少创建的空闲的链接，0表示不创建
+            maxcached=min(5, global_setting.database_pool_max),  # 链接池中最多闲置的链接，0和None不限制
             maxshared=3,
             # 链接池中最多共享的链接数量，0和None表示全部共享。
             # PS: 无用，因为pymysql和MySQLdb等模块的 threadsafety都为1，永远是所有链接都共享。
@@ -43,6 +442,23 @@ class Mysql:
             database=global_setting.database_name,
             charset='utf8'
         )
+        #   多语句只在execute_batch专用的连接上开启，普通连接即使存在注入也无法追加执行第二条语句
+        cls.batch_pool = PooledDB(
+            creator=pymysql,
+            maxconnections=global_setting.database_batch_pool_max,
+            mincached=0,
+            maxcached=global_setting.database_batch_pool_max,
+            blocking=True,
+            maxusage=1000,
+            ping=2,
+            host=global_setting.database_host,
+            port=global_setting.database_port,
+            user=global_setting.database_user,
+            password=global_setting.database_password,
+            database=global_setting.database_name,
+            charset='utf8',
+            client_flag=CLIENT.MULTI_STATEMENTS  # 允许一次请求发送多条sql（execute_batch）
+        )
         logger.info('Mysql连接池已开启')
         #   注册句柄，程序退出时自动断开Mysql连接
         atexit.register(lambda: Mysql.close())
@@ -50,11 +466,57 @@ class Mysql:
     @classmethod
     def close(cls):
         cls.pool.close()
+        cls.batch_pool.close()
         logger.info('Mysql连接已断开')
 
     @classmethod
     def connect(cls) -> pymysql.connections.Connection:
-        return cls.pool.connection()
+        """
+        从连接池获取连接，连接耗尽时阻塞等待，close()时归还
+        """
+        start = time.perf_counter()
+        with cls.__cond:
+            if cls.monitor.is_exhausted():
+                cls.monitor.on_wait()
+                try:
+                    while cls.monitor.is_exhausted():
+                        cls.__cond.wait()
+                finally:
+                    cls.monitor.on_wait_end()
+            cls.monitor.in_use += 1
+
+        try:
+            conn = cls.pool.connection()
+        except Exception:
+            cls.__release_slot()
+            raise
+        checkout = time.perf_counter()
+        cls.monitor.on_checkout(checkout - start)
+        return _MonitoredConnection(conn, lambda: cls.__release_slot(checkout))
+
+    @classmethod
+    def connect_batch(cls) -> pymysql.connections.Connection:
+        """
+        从多语句连接池获取连接（execute_batch专用），连接耗尽时阻塞等待，close()时归还
+        """
+        return cls.batch_pool.connection()
+
+    @classmethod
+    def __release_slot(cls, checkout: float = None):
+        #   先记录（可能触发扩容），再唤醒等待者
+        if checkout is not None:
+            cls.monitor.on_release(time.perf_counter() - checkout)
+        with cls.__cond:
+            cls.monitor.in_use -= 1
+            cls.__cond.notify_all()
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        连接池统计信息
+        """
+        #   PooledDB未提供空闲连接数的公开接口
+        return cls.monitor.stats(idle=len(getattr(cls.pool, '_idle_cache', [])))
 
     @staticmethod
     def get_cursor(conn: pymysql.connections.Connection) -> pymysql.cursors.Cursor:
@@ -75,8 +537,11 @@ class Mysql:
         :return: 一条结果 无需取[0]
         """
         with Mysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
             cur.execute(sql, params)
-            return cur.fetchone()
+            res = cur.fetchone()
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=0 if res is None else 1)
+            return res
 
     @staticmethod
     def execute_fetchmany(conn: pymysql.connections.Connection, sql: str, count: int, **params):
@@ -89,8 +554,11 @@ class Mysql:
         :return: count条结果
         """
         with Mysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
             cur.execute(sql, params)
-            return cur.fetchmany(count)
+            res = cur.fetchmany(count)
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=len(res))
+            return res
 
     @staticmethod
     def execute_fetchall(conn: pymysql.connections.Connection, sql: str, **params):
@@ -102,17 +570,678 @@ class Mysql:
         :return: 全部结果
         """
         with Mysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
             cur.execute(sql, params)
-            return cur.fetchall()
+            res = cur.fetchall()
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=len(res))
+            return res
 
     @staticmethod
-    def execute_only(conn: pymysql.connections.Connection, sql: str, **params) -> None:
+    def execute_only(conn: pymysql.connections.Connection, sql: str, **params) -> int:
         """
-        静态方法：封装conn执行sql后返回全部结果。通过params实现预编议，防止注入。
+        静态方法：封装conn执行sql，不返回结果。通过params实现预编议，防止注入。
         :param conn: 连接
         :param sql: sql语句
         :param params: sql中占位符对应字典
-        :return: 全部结果
+        :return: 影响行数
         """
         with Mysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
             cur.execute(sql, params)
+            rowcount = cur.rowcount
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=rowcount)
+        QueryCache.invalidate_sql(sql)
+        return rowcount
+
+    @staticmethod
+    def execute_many(conn: pymysql.connections.Connection, sql: str, params_list: list[dict]) -> int:
+        """
+        静态方法：封装cur.executemany，insert语句会合并为一条多行insert
+        注意 ON DUPLICATE KEY UPDATE 后需用 values(name) 代替 %(name)s
+        :param conn: 连接
+        :param sql: sql语句
+        :param params_list: 每行的占位符字典
+        :return: 影响行数
+        """
+        if not params_list:
+            return 0
+        with Mysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
+            cur.executemany(sql, params_list)
+            rowcount = cur.rowcount
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=rowcount)
+        QueryCache.invalidate_sql(sql)
+        return rowcount
+
+    @staticmethod
+    def cached_fetchone(conn: pymysql.connections.Connection, sql: str, ttl: float = None, **params):
+        """
+        静态方法：带缓存的execute_fetchone（读穿透），适用于变化少、读取频繁的小表查询
+        :param conn: 连接
+        :param sql: sql语句
+        :param ttl: 缓存过期时间(秒)，None则使用默认值
+        :param params: sql中占位符对应字典
+        :return: 一条结果 无需取[0]
+        """
+        key = QueryCache.key(f'fetchone|{sql}', params)
+        res = QueryCache.get(key)
+        if res is QueryCache.MISS:
+            generation = QueryCache.generation(sql)
+            res = Mysql.execute_fetchone(conn, sql, **params)
+            QueryCache.set(key, sql, res, generation, ttl)
+        return res
+
+    @staticmethod
+    def cached_fetchall(conn: pymysql.connections.Connection, sql: str, ttl: float = None, **params):
+        """
+        静态方法：带缓存的execute_fetchall（读穿透），适用于变化少、读取频繁的小表查询
+        :param conn: 连接
+        :param sql: sql语句
+        :param ttl: 缓存过期时间(秒)，None则使用默认值
+        :param params: sql中占位符对应字典
+        :return: 全部结果
+        """
+        key = QueryCache.key(f'fetchall|{sql}', params)
+        res = QueryCache.get(key)
+        if res is QueryCache.MISS:
+            generation = QueryCache.generation(sql)
+            res = Mysql.execute_fetchall(conn, sql, **params)
+            QueryCache.set(key, sql, res, generation, ttl)
+        return res
+
+    @staticmethod
+    def build_batch(cur, statements: list[tuple[str, dict]], commit: bool) -> tuple[str, str]:
+        """
+        静态方法：将多条sql及参数合并为一条多语句sql
+        :param cur: 游标（用于参数转义）
+        :param statements: [(sql, params), ...]
+        :param commit: 是否在语句前后添加开启、提交事务
+        :return: (合并后的sql, 用于性能分析的sql模板)
+        """
+        parts = [cur.mogrify(sql.strip().rstrip(';'), params) for sql, params in statements]
+        if commit:
+            parts = ['START TRANSACTION', *parts, 'COMMIT']
+        #   每条语句后换行再加分号，防止语句末尾的注释吞掉分号
+        multi_sql = ''.join(f'{part}\n;\n' for part in parts)
+        template = ';\n'.join(sql.strip().rstrip(';') for sql, _ in statements)
+        return multi_sql, template
+
+    @staticmethod
+    def execute_batch(conn: pymysql.connections.Connection, statements: list[tuple[str, dict]],
+                      commit: bool = True) -> list:
+        """
+        静态方法：多条sql合并为一次请求发送，只需一次网络往返。通过params实现预编议，防止注入。
+        commit=True时在同一请求中开启并提交事务，任一语句失败则回滚；commit=False时由调用方提交
+        :param conn: 连接，需由Mysql.connect_batch获取（其他连接不允许多语句）
+        :param statements: [(sql, params), ...] params为sql中占位符对应字典
+        :param commit: 是否在同一请求中提交事务
+        :return: 每条sql的结果，查询语句为全部结果，其他语句为影响行数
+        """
+        with Mysql.get_cursor(conn) as cur:
+            multi_sql, template = Mysql.build_batch(cur, statements, commit)
+            results = []
+            start = time.perf_counter()
+            try:
+                cur.execute(multi_sql)
+                while True:
+                    results.append(cur.fetchall() if cur.description else cur.rowcount)
+                    if not cur.nextset():
+                        break
+            except Exception:
+                conn.rollback()
+                raise
+            if commit:
+                results = results[1:-1]
+            for sql, _ in statements:
+                QueryCache.invalidate_sql(sql)
+            QueryProfiler.record(template, time.perf_counter() - start,
+                                 rows=sum(x if isinstance(x, int) else len(x) for x in results))
+            return results
+
+    @staticmethod
+    def execute_stream(conn: pymysql.connections.Connection, sql: str, chunk_size: int = 1000, **params):
+        """
+        静态方法：使用服务端游标(SSCursor)执行sql，逐批读取结果，内存占用与结果集大小无关。通过params实现预编议，防止注入。
+        注意：遍历结束（或生成器关闭）前，该连接不能执行其他sql
+        :param conn: 连接
+        :param sql: sql语句
+        :param chunk_size: 每批结果数
+        :param params: sql中占位符对应字典
+        :return: 生成器，每次返回不超过chunk_size条结果
+        """
+        cost = 0.0
+        rows = 0
+        with conn.cursor(pymysql.cursors.SSCursor) as cur:
+            try:
+                start = time.perf_counter()
+                cur.execute(sql, params)
+                cost += time.perf_counter() - start
+                while True:
+                    start = time.perf_counter()
+                    chunk = cur.fetchmany(chunk_size)
+                    cost += time.perf_counter() - start
+                    if not chunk:
+                        break
+                    rows += len(chunk)
+                    yield chunk
+            finally:
+                #   只统计数据库读取耗时，不包括调用方处理每批数据的耗时
+                QueryProfiler.record(sql, cost, rows=rows)
+
+
+class AsyncPool:
+    """
+    aiomysql连接池封装，附带连接池监控（等待时间、占用时间、耗尽次数、自适应连接数）
+    """
+    pool: aiomysql.Pool  # 异步数据库连接池
+    monitor: PoolMonitor  # 连接池监控
+
+    def __init__(self, name: str):
+        self.name = name
+        self.__cond = asyncio.Condition()  # 等待可用连接
+        self.__checkout_time = {}  # 连接取出时间 {id(conn): perf_counter}
+
+    async def open(self, host: str, port: int, user: str, password: str, db: str, autocommit: bool = False,
+                   min_size: int = None, max_size: int = None, multi_statements: bool = False):
+        """
+        创建连接池，连接数等配置读取自GlobalSettings
+        :param min_size: 最少连接数，为None则使用database_pool_min
+        :param max_size: 最多连接数，为None则使用database_pool_max
+        :param multi_statements: 是否允许一次请求发送多条sql（只用于execute_batch专用的连接池）
+        """
+        global_setting = GlobalSettings.get()
+        min_size = global_setting.database_pool_min if min_size is None else min_size
+        max_size = global_setting.database_pool_max if max_size is None else max_size
+        self.monitor = PoolMonitor(
+            name=self.name,
+            min_size=min_size,
+            max_size=max_size,
+            #   多语句连接池很小，固定为max_size
+            adaptive=global_setting.database_pool_adaptive and not multi_statements,
+            grow_wait_ms=global_setting.database_pool_grow_wait_ms,
+            adjust_interval=global_setting.database_pool_adjust_interval
+        )
+        self.pool = await aiomysql.create_pool(
+            minsize=min_size,  # 初始化时，链接池中至少创建的空闲的链接
+            maxsize=max_size,  # 连接池允许的最大连接数
+            pool_recycle=3600,  # 空闲超过该秒数的连接在取出时重建，避免被服务端断开
+            autocommit=autocommit,
+            host=host,
+            port=port,
+            user=user,
+            password=password,
+            db=db,
+            charset='utf8',
+            client_flag=CLIENT.MULTI_STATEMENTS if multi_statements else 0  # 是否允许一次请求发送多条sql
+        )
+        logger.info(f'[{self.name}]Mysql异步连接池已开启')
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+        logger.info(f'[{self.name}]Mysql异步连接池已关闭')
+
+    async def acquire(self) -> aiomysql.Connection:
+        """
+        从连接池获取连接，连接耗尽时异步等待，使用完毕后需调用release归还
+        """
+        start = time.perf_counter()
+        async with self.__cond:
+            if self.monitor.is_exhausted():
+                self.monitor.on_wait()
+                try:
+                    await self.__cond.wait_for(lambda: not self.monitor.is_exhausted())
+                finally:
+                    self.monitor.on_wait_end()
+            self.monitor.in_use += 1
+
+        try:
+            conn = await self.pool.acquire()
+        except BaseException:
+            #   包括等待建立连接时被取消(CancelledError)，否则占用的名额永远不会归还
+            await asyncio.shield(self.__release_slot())
+            raise
+        checkout = time.perf_counter()
+        self.__checkout_time[id(conn)] = checkout
+        self.monitor.on_checkout(checkout - start)
+        return conn
+
+    async def release(self, conn: aiomysql.Connection) -> None:
+        """
+        归还连接到连接池，未提交的事务会被回滚（与PooledDB行为一致）
+        :param conn: 连接
+        """
+        try:
+            if not conn.closed and conn.get_transaction_status():
+                await conn.rollback()
+        except Exception as e:
+            logger.warning(f'[{self.name}]归还连接时回滚失败-{e}')
+            conn.close()
+
+        #   自适应缩容后，关闭超出limit的连接，使实际连接数随之减少
+        if self.monitor.adaptive and not conn.closed and self.pool.size > self.monitor.limit:
+            conn.close()
+        self.pool.release(conn)
+        await self.__release_slot(self.__checkout_time.pop(id(conn), None))
+
+    async def __release_slot(self, checkout: float = None):
+        #   先记录（可能触发扩容），再唤醒等待者
+        if checkout is not None:
+            self.monitor.on_release(time.perf_counter() - checkout)
+        async with self.__cond:
+            self.monitor.in_use -= 1
+            self.__cond.notify_all()
+
+    def stats(self) -> dict:
+        """
+        连接池统计信息
+        """
+        return self.monitor.stats(idle=self.pool.freesize)
+
+
+class RoutingConnection:
+    """
+    读写分离连接，主库、从库连接均在首次使用时才从连接池获取
+    1. 查询语句(execute_fetch*)使用从库连接（未配置从库时使用主库）
+    2. 写入语句(execute_only/execute_many)及显式事务(begin)使用主库连接
+    3. 写入后、或use_primary=True时（读自己的写入），后续查询也使用主库
+    4. execute_batch使用主库的多语句专用连接(AsyncMysql.batch)，与2中的主库连接不在同一事务，提交、回滚时一并处理
+    可用 async with conn: 包裹一段数据库操作，退出时自动提交/回滚并归还连接
+    """
+
+    def __init__(self, use_primary: bool = False):
+        self.use_primary = use_primary
+        self.__primary: Optional[aiomysql.Connection] = None
+        self.__replica: Optional[aiomysql.Connection] = None
+        self.__batch: Optional[aiomysql.Connection] = None
+
+    async def get(self, readonly: bool = True) -> aiomysql.Connection:
+        """
+        获取实际执行sql的连接
+        :param readonly: 是否为只读语句
+        """
+        if readonly and not self.use_primary and AsyncMysql.replica is not None:
+            if self.__replica is None:
+                self.__replica = await AsyncMysql.replica.acquire()
+            return self.__replica
+
+        if not readonly:
+            self.use_primary = True
+        if self.__primary is None:
+            self.__primary = await AsyncMysql.primary.acquire()
+        return self.__primary
+
+    async def get_primary(self) -> aiomysql.Connection:
+        """
+        获取主库连接，不改变后续查询的路由（用于缓存未命中时的回源查询）
+        """
+        if self.__primary is None:
+            self.__primary = await AsyncMysql.primary.acquire()
+        return self.__primary
+
+    async def get_batch(self) -> aiomysql.Connection:
+        """
+        获取多语句专用连接（execute_batch），此后所有查询使用主库
+        """
+        self.use_primary = True
+        if self.__batch is None:
+            self.__batch = await AsyncMysql.batch.acquire()
+        return self.__batch
+
+    async def begin(self):
+        """
+        显式开启事务，此后所有语句使用主库
+        """
+        self.use_primary = True
+        await (await self.get(readonly=False)).begin()
+
+    async def commit(self):
+        if self.__primary is not None:
+            await self.__primary.commit()
+        if self.__batch is not None:
+            await self.__batch.commit()
+
+    async def rollback(self):
+        if self.__primary is not None:
+            await self.__primary.rollback()
+        if self.__batch is not None:
+            await self.__batch.rollback()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """
+        async with 退出时：无异常则提交，有异常则回滚，随后立即归还连接
+        之后再次执行sql时会重新从连接池获取连接
+        """
+        try:
+            if exc_type is None:
+                await self.commit()
+            else:
+                await self.rollback()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        归还已获取的连接，未提交的事务会被回滚
+        """
+        primary, self.__primary = self.__primary, None
+        replica, self.__replica = self.__replica, None
+        batch, self.__batch = self.__batch, None
+        if replica is not None:
+            await AsyncMysql.replica.release(replica)
+        if batch is not None:
+            await AsyncMysql.batch.release(batch)
+        if primary is not None:
+            await AsyncMysql.primary.release(primary)
+
+
+class AsyncMysql:
+    """
+    异步数据库连接池（aiomysql），接口与Mysql保持一致
+    路由中使用，避免慢查询阻塞整个事件循环
+    配置从库(database_replica_host)后读写分离：查询走从库，写入及事务走主库
+    """
+    primary: AsyncPool  # 主库连接池
+    batch: AsyncPool  # 主库多语句连接池，只用于execute_batch
+    replica: Optional[AsyncPool] = None  # 从库连接池，未配置则为None
+
+    @classmethod
+    async def init(cls):
+        """
+        初始化异步连接池，需在Mysql.init之后调用（共用当前模块日志）
+        """
+        #   读取密钥环境等
+        global_setting = GlobalSettings.get()
+
+        cls.primary = AsyncPool('AsyncMysql')
+        await cls.primary.open(
+            host=global_setting.database_host,
+            port=global_setting.database_port,
+            user=global_setting.database_user,
+            password=global_setting.database_password,
+            db=global_setting.database_name
+        )
+        #   多语句只在execute_batch专用的连接上开启，普通连接即使存在注入也无法追加执行第二条语句
+        cls.batch = AsyncPool('AsyncMysql-batch')
+        await cls.batch.open(
+            host=global_setting.database_host,
+            port=global_setting.database_port,
+            user=global_setting.database_user,
+            password=global_setting.database_password,
+            db=global_setting.database_name,
+            min_size=0,
+            max_size=global_setting.database_batch_pool_max,
+            multi_statements=True
+        )
+
+        if global_setting.database_replica_host:
+            cls.replica = AsyncPool('AsyncMysql-replica')
+            #   从库只读，自动提交避免归还连接时额外的回滚
+            await cls.replica.open(
+                host=global_setting.database_replica_host,
+                port=global_setting.database_replica_port,
+                user=global_setting.database_replica_user or global_setting.database_user,
+                password=global_setting.database_replica_password or global_setting.database_password,
+                db=global_setting.database_name,
+                autocommit=True
+            )
+
+    @classmethod
+    async def close(cls):
+        await cls.primary.close()
+        await cls.batch.close()
+        if cls.replica is not None:
+            await cls.replica.close()
+
+    @classmethod
+    async def connect(cls, primary: bool = False) -> RoutingConnection:
+        """
+        获取读写分离连接（实际连接在首次执行sql时获取），使用完毕后需调用release归还
+        :param primary: 是否所有语句都使用主库（读自己的写入）
+        """
+        return RoutingConnection(use_primary=primary)
+
+    @classmethod
+    async def release(cls, conn: RoutingConnection) -> None:
+        """
+        归还连接到连接池，未提交的事务会被回滚（与PooledDB行为一致）
+        :param conn: 连接
+        """
+        await conn.close()
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        连接池统计信息
+        """
+        return {
+            'primary': cls.primary.stats(),
+            'batch': cls.batch.stats(),
+            'replica': cls.replica.stats() if cls.replica is not None else None
+        }
+
+    @staticmethod
+    async def resolve(conn, readonly: bool = True) -> aiomysql.Connection:
+        """
+        静态方法：获取实际执行sql的连接
+        :param conn: RoutingConnection 或 aiomysql连接
+        :param readonly: 是否为只读语句
+        """
+        if isinstance(conn, RoutingConnection):
+            return await conn.get(readonly=readonly)
+        return conn
+
+    @staticmethod
+    def get_cursor(conn: aiomysql.Connection) -> aiomysql.Cursor:
+        """
+        静态方法：封装获取连接的游标
+        :param conn: 连接
+        :return: 游标
+        """
+        return conn.cursor()
+
+    @staticmethod
+    async def execute_fetchone(conn: RoutingConnection, sql: str, **params):
+        """
+        静态方法：封装conn执行sql后返回一条结果。通过params实现预编议，防止注入。
+        :param conn: 连接
+        :param sql: sql语句
+        :param params: sql中占位符对应字典
+        :return: 一条结果 无需取[0]
+        """
+        conn = await AsyncMysql.resolve(conn, readonly=True)
+        async with AsyncMysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
+            await cur.execute(sql, params)
+            res = await cur.fetchone()
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=0 if res is None else 1)
+            return res
+
+    @staticmethod
+    async def execute_fetchmany(conn: RoutingConnection, sql: str, count: int, **params):
+        """
+        静态方法：封装conn执行sql后返回count条结果。通过params实现预编议，防止注入。
+        :param conn: 连接
+        :param sql: sql语句
+        :param count: 返回结果数
+        :param params: sql中占位符对应字典
+        :return: count条结果
+        """
+        conn = await AsyncMysql.resolve(conn, readonly=True)
+        async with AsyncMysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
+            await cur.execute(sql, params)
+            res = await cur.fetchmany(count)
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=len(res))
+            return res
+
+    @staticmethod
+    async def execute_fetchall(conn: RoutingConnection, sql: str, **params):
+        """
+        静态方法：封装conn执行sql后返回全部结果。通过params实现预编议，防止注入。
+        :param conn: 连接
+        :param sql: sql语句
+        :param params: sql中占位符对应字典
+        :return: 全部结果
+        """
+        conn = await AsyncMysql.resolve(conn, readonly=True)
+        async with AsyncMysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
+            await cur.execute(sql, params)
+            res = await cur.fetchall()
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=len(res))
+            return res
+
+    @staticmethod
+    async def execute_only(conn: RoutingConnection, sql: str, **params) -> int:
+        """
+        静态方法：封装conn执行sql，不返回结果。通过params实现预编议，防止注入。
+        :param conn: 连接
+        :param sql: sql语句
+        :param params: sql中占位符对应字典
+        :return: 影响行数
+        """
+        conn = await AsyncMysql.resolve(conn, readonly=False)
+        async with AsyncMysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
+            await cur.execute(sql, params)
+            rowcount = cur.rowcount
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=rowcount)
+        QueryCache.invalidate_sql(sql)
+        return rowcount
+
+    @staticmethod
+    async def execute_many(conn: RoutingConnection, sql: str, params_list: list[dict]) -> int:
+        """
+        静态方法：封装cur.executemany，insert语句会合并为一条多行insert
+        :param conn: 连接
+        :param sql: sql语句
+        :param params_list: 每行的占位符字典
+        :return: 影响行数
+        """
+        if not params_list:
+            return 0
+        conn = await AsyncMysql.resolve(conn, readonly=False)
+        async with AsyncMysql.get_cursor(conn) as cur:
+            start = time.perf_counter()
+            await cur.executemany(sql, params_list)
+            rowcount = cur.rowcount
+            QueryProfiler.record(sql, time.perf_counter() - start, rows=rowcount)
+        QueryCache.invalidate_sql(sql)
+        return rowcount
+
+    @staticmethod
+    async def cached_fetchone(conn: RoutingConnection, sql: str, ttl: float = None, **params):
+        """
+        静态方法：带缓存的execute_fetchone（读穿透），适用于变化少、读取频繁的小表查询
+        :param conn: 连接
+        :param sql: sql语句
+        :param ttl: 缓存过期时间(秒)，None则使用默认值
+        :param params: sql中占位符对应字典
+        :return: 一条结果 无需取[0]
+        """
+        #   读自己的写入时不使用缓存（缓存结果可能来自从库）
+        if isinstance(conn, RoutingConnection) and conn.use_primary:
+            return await AsyncMysql.execute_fetchone(conn, sql, **params)
+
+        key = QueryCache.key(f'fetchone|{sql}', params)
+        res = QueryCache.get(key)
+        if res is QueryCache.MISS:
+            generation = QueryCache.generation(sql)
+            #   未命中时从主库回源：从库可能尚未同步刚写入的数据，旧结果会被缓存整个TTL
+            source = await conn.get_primary() if isinstance(conn, RoutingConnection) else conn
+            res = await AsyncMysql.execute_fetchone(source, sql, **params)
+            QueryCache.set(key, sql, res, generation, ttl)
+        return res
+
+    @staticmethod
+    async def cached_fetchall(conn: RoutingConnection, sql: str, ttl: float = None, **params):
+        """
+        静态方法：带缓存的execute_fetchall（读穿透），适用于变化少、读取频繁的小表查询
+        :param conn: 连接
+        :param sql: sql语句
+        :param ttl: 缓存过期时间(秒)，None则使用默认值
+        :param params: sql中占位符对应字典
+        :return: 全部结果
+        """
+        #   读自己的写入时不使用缓存（缓存结果可能来自从库）
+        if isinstance(conn, RoutingConnection) and conn.use_primary:
+            return await AsyncMysql.execute_fetchall(conn, sql, **params)
+
+        key = QueryCache.key(f'fetchall|{sql}', params)
+        res = QueryCache.get(key)
+        if res is QueryCache.MISS:
+            generation = QueryCache.generation(sql)
+            #   未命中时从主库回源：从库可能尚未同步刚写入的数据，旧结果会被缓存整个TTL
+            source = await conn.get_primary() if isinstance(conn, RoutingConnection) else conn
+            res = await AsyncMysql.execute_fetchall(source, sql, **params)
+            QueryCache.set(key, sql, res, generation, ttl)
+        return res
+
+    @staticmethod
+    async def execute_batch(conn: RoutingConnection, statements: list[tuple[str, dict]],
+                            commit: bool = True) -> list:
+        """
+        静态方法：多条sql合并为一次请求发送，只需一次网络往返。通过params实现预编议，防止注入。
+        commit=True时在同一请求中开启并提交事务，任一语句失败则回滚；commit=False时由调用方提交
+        :param conn: 连接，RoutingConnection使用其多语句专用连接；aiomysql连接需取自AsyncMysql.batch
+        :param statements: [(sql, params), ...] params为sql中占位符对应字典
+        :param commit: 是否在同一请求中提交事务
+        :return: 每条sql的结果，查询语句为全部结果，其他语句为影响行数
+        """
+        if isinstance(conn, RoutingConnection):
+            conn = await conn.get_batch()
+        async with AsyncMysql.get_cursor(conn) as cur:
+            multi_sql, template = Mysql.build_batch(cur, statements, commit)
+            results = []
+            start = time.perf_counter()
+            try:
+                await cur.execute(multi_sql)
+                while True:
+                    results.append(await cur.fetchall() if cur.description else cur.rowcount)
+                    if not await cur.nextset():
+                        break
+            except Exception:
+                await conn.rollback()
+                raise
+            if commit:
+                results = results[1:-1]
+            for sql, _ in statements:
+                QueryCache.invalidate_sql(sql)
+            QueryProfiler.record(template, time.perf_counter() - start,
+                                 rows=sum(x if isinstance(x, int) else len(x) for x in results))
+            return results
+
+    @staticmethod
+    async def execute_stream(conn: RoutingConnection, sql: str, chunk_size: int = 1000, **params):
+        """
+        静态方法：使用服务端游标(SSCursor)执行sql，逐批读取结果，内存占用与结果集大小无关。通过params实现预编议，防止注入。
+        注意：遍历结束（或生成器关闭）前，该连接不能执行其他sql；提前退出遍历时建议配合contextlib.aclosing使用
+        :param conn: 连接
+        :param sql: sql语句
+        :param chunk_size: 每批结果数
+        :param params: sql中占位符对应字典
+        :return: 异步生成器(async for)，每次返回不超过chunk_size条结果
+        """
+        cost = 0.0
+        rows = 0
+        conn = await AsyncMysql.resolve(conn, readonly=True)
+        async with conn.cursor(aiomysql.SSCursor) as cur:
+            try:
+                start = time.perf_counter()
+                await cur.execute(sql, params)
+                cost += time.perf_counter() - start
+                while True:
+                    start = time.perf_counter()
+                    chunk = await cur.fetchmany(chunk_size)
+                    cost += time.perf_counter() - start
+                    if not chunk:
+                        break
+                    rows += len(chunk)
+                    yield chunk
+            finally:
+                #   只统计数据库读取耗时，不包括调用方处理每批数据的耗时
+                QueryProfiler.record(sql, cost, rows=rows)
@@ -1,5 +1,6 @@
 from fastapi import HTTPException
 from xmuorder_server import security
+from xmuorder_server.database import AsyncMysql
 
 
 def code_verify_depend(code_verify: security.CodeVerifyModel):
@@ -18,3 +19,29 @@ def code_verify_aes_depend(info: security.CodeVerifyModel):
     if not security.code_verify_aes(info.code, info.ts):
         raise HTTPException(status_code=400, detail="code invalid")
     return True
+
+
+async def mysql_depend():
+    """
+    请求级数据库连接（读写分离，实际连接在首次执行sql时才获取）
+    必须在 async with conn: 中执行数据库操作：退出时提交（异常则回滚）并立即归还连接，这是唯一的提交方式，
+    提交失败时异常在返回响应之前抛出；同时避免等待微信、飞鹅云等外部请求时占用连接池
+    请求结束时仍未归还的连接（未使用 async with）直接归还，未提交的事务被回滚，不会提交：
+    yield之后的代码在响应发送之后才执行，此时提交失败客户端也无从得知
+    """
+    conn = await AsyncMysql.connect()
+    try:
+        yield conn
+    finally:
+        await AsyncMysql.release(conn)
+
+
+async def mysql_primary_depend():
+    """
+    同mysql_depend，但所有语句都使用主库（读自己的写入）
+    """
+    conn = await AsyncMysql.connect(primary=True)
+    try:
+        yield conn
+    finally:
+        await AsyncMysql.release(conn)
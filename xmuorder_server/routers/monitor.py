@@ -0,0 +1,87 @@
+"""
+运行状态监控相关
+"""
+from typing import Optional
+
+from fastapi import APIRouter, Depends
+from pydantic import BaseModel
+
+from . import printer
+from .. import dependencies
+from ..common import SuccessInfo
+from ..config import GlobalSettings
+from ..database import Mysql, AsyncMysql, QueryProfiler, QueryCache
+from ..logger import Logger
+from ..weixin.database import AsyncDatabase
+from ..weixin.mirror import OrderMirror
+from ..weixin.weixin import WeiXin
+
+router = APIRouter()
+logger: Logger
+
+
+class QueryStatsModel(BaseModel):
+    """
+    sql统计接口模板
+    """
+    top: Optional[int] = 20  # 按总耗时返回前top条
+
+
+@router.on_event("startup")
+async def __init():
+    #   获取默认日志
+    global logger
+    logger = Logger('监控模块')
+
+
+@router.post("/pool")
+async def pool_stats(verify=Depends(dependencies.code_verify_aes_depend)):
+    """
+    获取Mysql连接池统计信息（等待时间、占用时间、使用中/空闲连接数、耗尽次数）
+    """
+    return SuccessInfo(msg='get pool stats success', data={
+        'sync': Mysql.stats(),
+        'async': AsyncMysql.stats()
+    }).to_dict()
+
+
+@router.post("/query")
+async def query_stats(data: QueryStatsModel, verify=Depends(dependencies.code_verify_aes_depend)):
+    """
+    获取按sql指纹统计的执行次数、总耗时、p50/p99耗时、行数
+    """
+    return SuccessInfo(msg='get query stats success', data={
+        'slow_ms': QueryProfiler.slow_ms,
+        'queries': QueryProfiler.stats(top=data.top)
+    }).to_dict()
+
+
+@router.post("/cache")
+async def cache_stats(verify=Depends(dependencies.code_verify_aes_depend)):
+    """
+    获取查询缓存统计信息（命中、未命中、淘汰、失效次数）
+    """
+    return SuccessInfo(msg='get cache stats success', data=QueryCache.stats()).to_dict()
+
+
+@router.post("/weixin")
+async def weixin_stats(verify=Depends(dependencies.code_verify_aes_depend)):
+    """
+    获取微信接口熔断器状态、重试次数及订单查询合并统计
+    """
+    return SuccessInfo(msg='get weixin stats success', data={
+        'access_token': WeiXin.stats(),
+        'database': AsyncDatabase.stats(),
+        'order_loader': printer.order_loader.stats()
+    }).to_dict()
+
+
+@router.post("/mirror")
+async def mirror_stats(verify=Depends(dependencies.code_verify_aes_depend)):
+    """
+    获取订单镜像同步状态（检查点、覆盖范围下界、上次同步时间、镜像延迟、上次同步读取/写入数、错误信息）
+    """
+    return SuccessInfo(msg='get mirror stats success', data={
+        'orders': {**await OrderMirror.mirror.stats(), 'enabled': GlobalSettings.get().orders_mirror_enabled,
+                   'read': OrderMirror.read}
+    }).to_dict()
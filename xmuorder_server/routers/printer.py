@@ -1,5 +1,4 @@
 import asyncio
-import json
 import time
 from datetime import datetime
 from enum import unique, Enum
@@ -14,20 +13,31 @@ from pydantic import BaseModel
 from .. import dependencies
 from ..common import WithMsgException, SuccessInfo
 from ..config import GlobalSettings
-from ..database import Mysql
+from ..database import AsyncMysql, RoutingConnection
 from ..logger import Logger
-from ..weixin.database import Database
+from ..weixin.database import BatchLoader
+from ..weixin.mirror import OrderMirror
 
 router = APIRouter()
 logger: Logger
+#   订单查询合并（高峰期并发的打印请求合并为一次查询）
+order_loader: BatchLoader
 
 
 @router.on_event("startup")
 async def __init():
-    global logger
+    global logger, order_loader
     logger = Logger('云打印机模块')
     Printer.init()
 
+    #   只取打印需要的字段
+    global_setting = GlobalSettings.get()
+    order_loader = BatchLoader('orders', 'orderInfo.outTradeNo', fields=(
+        'goodsInfo.shopInfo.cID', 'goodsInfo.shopInfo.name', 'deliverInfo.isDelivery',
+        'userInfo.name', 'userInfo.phone', 'getFoodInfo.place', 'orderInfo.timeInfo.confirmTime',
+        'goodsInfo.record.food', 'goodsInfo.record.price', 'goodsInfo.record.num'
+    ), max_batch=global_setting.weixin_batch_size, max_wait_ms=global_setting.weixin_batch_wait_ms)
+
 
 class AddPrinterModel(BaseModel):
     sn: str  # 打印机编号
@@ -56,14 +66,15 @@ class PrintOrderNoticeModel(BaseModel):
 
 
 @router.post("/addPrinter")
-async def add_printer_to_canteen(data: AddPrinterModel, verify=Depends(dependencies.code_verify_aes_depend)):
+async def add_printer_to_canteen(data: AddPrinterModel, verify=Depends(dependencies.code_verify_aes_depend),
+                                 conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     """
     添加餐厅打印机
     """
-    conn = Mysql.connect()
     try:
         sql = 'select name from canteen where cID = %(cID)s limit 1;'
-        name_res = Mysql.execute_fetchone(conn, sql, cID=data.cID)
+        async with conn:
+            name_res = await AsyncMysql.cached_fetchone(conn, sql, cID=data.cID)
         if name_res is None:
             raise WithMsgException('餐厅信息不存在')
         canteen_name = name_res[0]
@@ -78,8 +89,8 @@ async def add_printer_to_canteen(data: AddPrinterModel, verify=Depends(dependenc
                 insert into printer (sn, cID, `key`)
                 VALUES (%(sn)s, %(cID)s, %(key)s)
             '''
-            Mysql.execute_only(conn, sql, sn=data.sn, cID=data.cID, key=data.key)
-            conn.commit()
+            async with conn:
+                await AsyncMysql.execute_only(conn, sql, sn=data.sn, cID=data.cID, key=data.key)
             logger.success(f'{canteen_name}添加打印机成功 -sn={data.sn}')
             return SuccessInfo(msg='添加成功').to_dict()
         else:
@@ -92,8 +103,8 @@ async def add_printer_to_canteen(data: AddPrinterModel, verify=Depends(dependenc
                 ON DUPLICATE KEY UPDATE
                     cID=%(cID)s, `key`=%(key)s
                 '''
-                Mysql.execute_only(conn, sql, sn=data.sn, cID=data.cID, key=data.key)
-                conn.commit()
+                async with conn:
+                    await AsyncMysql.execute_only(conn, sql, sn=data.sn, cID=data.cID, key=data.key)
                 logger.success(f'{canteen_name}添加已绑定打印机 -sn={data.sn}')
                 return SuccessInfo(msg='打印机已添加').to_dict()
 
@@ -105,16 +116,15 @@ async def add_printer_to_canteen(data: AddPrinterModel, verify=Depends(dependenc
     except Exception as e:
         logger.debug(f'添加打印机失败-{e}')
         raise HTTPException(status_code=400, detail='添加打印机失败')
-    finally:
-        conn.close()
 
 
 @router.post("/getPrinterState")
-async def get_printer_state_by_cid(data: PrinterCIDModel, verify=Depends(dependencies.code_verify_aes_depend)):
-    conn = Mysql.connect()
+async def get_printer_state_by_cid(data: PrinterCIDModel, verify=Depends(dependencies.code_verify_aes_depend),
+                                   conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     try:
         sql = 'select sn from printer where cID = %(cID)s;'
-        res = Mysql.execute_fetchall(conn, sql, cID=data.cID)
+        async with conn:
+            res = await AsyncMysql.cached_fetchall(conn, sql, cID=data.cID)
 
         if not len(res):
             return {
@@ -136,17 +146,19 @@ async def get_printer_state_by_cid(data: PrinterCIDModel, verify=Depends(depende
     except Exception as e:
         logger.debug(f'获取餐厅打印机状态失败 cID-{data.cID} -{e}')
         raise HTTPException(status_code=400, detail='获取餐厅打印机状态失败')
-    finally:
-        conn.close()
 
 
 @router.post("/printAcceptOrder")
-async def print_accept_order_by_cid(data: PrintAcceptOrderModel, verify=Depends(dependencies.code_verify_aes_depend)):
-    conn = Mysql.connect()
+async def print_accept_order_by_cid(data: PrintAcceptOrderModel, verify=Depends(dependencies.code_verify_aes_depend),
+                                    conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     try:
         #   获取订单
-        res = Database.query('orders', f"where({{'orderInfo.outTradeNo':'{data.outTradeNo}'}}).limit(1).get()")
-        order_json = json.loads(res['data'][0])
+        #   镜像可用时先读取本地订单镜像，新订单尚未同步则查询云数据库
+        order_json = await OrderMirror.get_order(data.outTradeNo) if await OrderMirror.usable() else None
+        if order_json is None:
+            order_json = await order_loader.load(data.outTradeNo)
+        if order_json is None:
+            raise WithMsgException('订单不存在')
 
         cid = order_json['goodsInfo']['shopInfo']['cID']
         shop_name = order_json['goodsInfo']['shopInfo']['name']
@@ -177,14 +189,12 @@ async def print_accept_order_by_cid(data: PrintAcceptOrderModel, verify=Depends(
     except Exception as e:
         logger.debug(f'打印接单小票失败 outTradeNo-{data.outTradeNo} -{e}')
         raise HTTPException(status_code=400, detail='获取餐厅打印机状态失败')
-    finally:
-        conn.close()
 
 
 @router.post("/printOrderNotice")
 async def print_new_order_notice_by_cid(data: PrintOrderNoticeModel,
-                                        verify=Depends(dependencies.code_verify_aes_depend)):
-    conn = Mysql.connect()
+                                        verify=Depends(dependencies.code_verify_aes_depend),
+                                        conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     notice_dict = {
         'new': ('打印新订单提醒', Printer.print_new_order_notice),
         'cancel': ('打印取消订单提醒', Printer.print_cancel_order_notice),
@@ -199,21 +209,20 @@ async def print_new_order_notice_by_cid(data: PrintOrderNoticeModel,
     except Exception as e:
         logger.debug(f'{notice_dict[data.notice_type][0]}失败 cID-{data.cID} -{e}')
         raise HTTPException(status_code=400, detail=f'{notice_dict[data.notice_type][0]}失败')
-    finally:
-        conn.close()
 
 
-async def __print_by_cid(_conn, _cid: str, _print_fn: callable, **kwargs):
+async def __print_by_cid(_conn: RoutingConnection, _cid: str, _print_fn: callable, **kwargs):
     """
     打印到餐厅的所有打印机
-    :param _conn: mysql 连接
+    :param _conn: mysql 连接（查询打印机后即归还，不在请求打印机接口期间占用）
     :param _cid: 餐厅id
     :param _print_fn: 打印函数
     :param kwargs: 打印函数的参数 (不需要sn)
     :return:
     """
     sql = 'select sn from printer where cID = %(cID)s;'
-    res = Mysql.execute_fetchall(_conn, sql, cID=_cid)
+    async with _conn:
+        res = await AsyncMysql.cached_fetchall(_conn, sql, cID=_cid)
 
     if not len(res):
         return {
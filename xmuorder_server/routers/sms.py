@@ -14,7 +14,7 @@ from tencentcloud.sms.v20210111 import sms_client, models
 from .. import dependencies
 from ..common import SuccessInfo, XMUORDERException
 from ..config import GlobalSettings
-from ..database import Mysql
+from ..database import AsyncMysql, RoutingConnection
 from ..logger import Logger
 from ..scheduler import Scheduler, Task
 
@@ -74,36 +74,37 @@ async def __init():
 
 
 @router.post("/sendCanteenNotice")
-async def send_canteen_notice(data: SendSmsModel, verify=Depends(dependencies.code_verify_aes_depend)):
-    conn = Mysql.connect()
+async def send_canteen_notice(data: SendSmsModel, verify=Depends(dependencies.code_verify_aes_depend),
+                              conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     try:
-        cid_list = [f"'{x}'" for x in data.cID_list]
-        for x in cid_list:
-            if x.find(' ') > -1:
-                raise XMUORDERException("cID列表异常")
-
-        #   过滤出需要发送的电话号码
-        #   1. cID符合    2. 距离上次发送订单提醒超过30min
-        sql = f'''
+        if len(data.cID_list) == 0:
+            raise XMUORDERException("cID列表为空")
+        cid_list = tuple(data.cID_list)
+
+        #   1. 过滤出需要发送的电话号码：cID符合，且距离上次发送订单提醒超过30min
+        #   2. 更新这些餐厅的 lastSendMsgTime
+        #   两条语句合并为一次请求（一次网络往返）
+        sql1 = '''
         select c.cID, p.phone, c.lastSendMsgTime
         from canteen c
                  left join phone p on c.cID = p.cID
-        where c.cID in {f"({','.join(cid_list)})"}
+        where c.cID in %(cid_list)s
             and TIMESTAMPDIFF(minute, c.lastSendMsgTime, NOW()) > 30;
         '''
-
-        res = Mysql.execute_fetchall(conn, sql=sql)
+        sql2 = '''
+        update canteen set lastSendMsgTime = NOW()
+        where cID in %(cid_list)s
+            and TIMESTAMPDIFF(minute, lastSendMsgTime, NOW()) > 30;
+        '''
+        async with conn:
+            res, _ = await AsyncMysql.execute_batch(conn, [
+                (sql1, {'cid_list': cid_list}),
+                (sql2, {'cid_list': cid_list})
+            ])
         phone_list = set([line[1] for line in res if line[1] is not None])
         if len(phone_list) == 0:
             raise XMUORDERException('匹配的phone列表为空')
 
-        #   更新 lastSendMsgTime
-        sql = f'''
-        update canteen set lastSendMsgTime = NOW()
-        where cID in {f"({','.join(cid_list)})"};
-        '''
-        Mysql.execute_only(conn, sql)
-
         #   发送短信
         res = send_message(list(phone_list), time1=data.time1, time2=data.time2)
         return SuccessInfo(msg='Sms request success',
@@ -112,16 +113,14 @@ async def send_canteen_notice(data: SendSmsModel, verify=Depends(dependencies.co
     except Exception as e:
         logger.debug(f'发送商家通知短信失败-{e}')
         raise HTTPException(status_code=400, detail="订单通知短信发送失败")
-    finally:
-        conn.close()
 
 
 @router.post("/phoneVerificationCode")
-async def phone_verification_code(data: SmsVerificationCodeModel, verify=Depends(dependencies.code_verify_aes_depend)):
+async def phone_verification_code(data: SmsVerificationCodeModel, verify=Depends(dependencies.code_verify_aes_depend),
+                                  conn: RoutingConnection = Depends(dependencies.mysql_primary_depend)):
     """
     发送验证码
     """
-    conn = Mysql.connect()
     try:
         # 再次简单核验电话号码，防止注入等问题
         if re.match(r'^\+86[1][34578][0-9]{9}$', data.phone) is None:
@@ -130,40 +129,55 @@ async def phone_verification_code(data: SmsVerificationCodeModel, verify=Depends
         # 验证码
         code = str(random.randint(100000, 999999))
 
-        sql = '''
-        select phone, code, expiration, lastSendTime, sendTimes
-        from phone_verification where phone=%(phone)s;
-        '''
-        res = Mysql.execute_fetchone(conn, sql, phone=data.phone)
-        if res is None:
-            sql = '''
-            insert into phone_verification (phone, code, expiration, lastSendTime, sendTimes)
-            VALUES (%(phone)s, %(code)s, DATE_ADD(now(), interval 5 minute), now(), 0)
-            '''
-        else:
-            if res[4] >= 5:
-                raise XMUORDERException('此号码已达到今日发送验证码次数上限')
-
-            # 2min内发送过验证码则退出
-            sec = (datetime.now() - res[3]).seconds
-            if sec < 2 * 60:
-                raise XMUORDERException('此号码短信发送过于频繁，请稍后再试')
-
-            # 5min后验证码过期
+        #   先提交发送记录并归还连接，发送短信期间不占用连接、不持有行锁
+        async with conn:
+            #   发送次数按日期记录：日期变化时在本次更新中重置，无需每日全表更新
+            #   条件判断与更新在同一语句内完成：当日未达上限且2min内未发送过才更新，5min后验证码过期
+            #   注意 sendTimes 须在 sendDate 之前赋值，才能用旧的 sendDate 判断
             sql = '''
             UPDATE phone_verification
-                set phone=%(phone)s, code=%(code)s, sendTimes=sendTimes+1,
+                set code=%(code)s,
                 expiration=DATE_ADD(now(), interval 5 minute),
+                sendTimes=IF(sendDate = CURDATE(), sendTimes + 1, 0),
+                sendDate=CURDATE(),
                 lastSendTime=NOW()
             where
-                phone=%(phone)s;
+                phone=%(phone)s
+                and (sendDate <> CURDATE() or sendTimes < 5)
+                and lastSendTime <= DATE_SUB(NOW(), interval 2 minute);
             '''
-
-        Mysql.execute_only(conn, sql, phone=data.phone, code=code)
+            if await AsyncMysql.execute_only(conn, sql, phone=data.phone, code=code) == 0:
+                #   无记录则插入；已有记录说明不满足发送条件，插入被忽略
+                sql = '''
+                insert ignore into phone_verification (phone, code, expiration, lastSendTime, sendTimes, sendDate)
+                VALUES (%(phone)s, %(code)s, DATE_ADD(now(), interval 5 minute), now(), 0, CURDATE())
+                '''
+                if await AsyncMysql.execute_only(conn, sql, phone=data.phone, code=code) == 0:
+                    sql = '''
+                    select sendDate = CURDATE() and sendTimes >= 5
+                    from phone_verification where phone=%(phone)s;
+                    '''
+                    res = await AsyncMysql.execute_fetchone(conn, sql, phone=data.phone)
+                    if res is not None and res[0]:
+                        raise XMUORDERException('此号码已达到今日发送验证码次数上限')
+                    raise XMUORDERException('此号码短信发送过于频繁，请稍后再试')
 
         # 发送验证码短信
-        res = send_verification_code(data.phone, code)
-        conn.commit()
+        try:
+            res = send_verification_code(data.phone, code)
+        except Exception:
+            #   发送失败：补偿本次记录，不计入发送次数，允许立即重试，验证码作废
+            #   以code为条件，只撤销本次请求的记录
+            sql = '''
+            UPDATE phone_verification
+                set sendTimes=GREATEST(sendTimes - 1, 0),
+                lastSendTime='2000-01-01 00:00:00',
+                expiration=NOW()
+            where phone=%(phone)s and code=%(code)s and sendDate = CURDATE();
+            '''
+            async with conn:
+                await AsyncMysql.execute_only(conn, sql, phone=data.phone, code=code)
+            raise
 
         # return SuccessInfo(msg='Verification code request success',
         #                    data={'SendStatusSet': res}).to_dict()
@@ -177,102 +191,102 @@ async def phone_verification_code(data: SmsVerificationCodeModel, verify=Depends
     except Exception as e:
         logger.debug(f'发送验证码短信失败-phone:{data.phone}\t{e}')
         raise HTTPException(status_code=400, detail="发送短信验证码失败")
-    finally:
-        conn.close()
 
 
 @router.post("/removeCanteenBindPhone")
 async def remove_canteen_bind_phone_list(data: RemoveCanteenBindPhoneModel,
-                                         verify=Depends(dependencies.code_verify_aes_depend)):
+                                         verify=Depends(dependencies.code_verify_aes_depend),
+                                         conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     """
     移除餐厅绑定的某个手机号
     """
-    conn = Mysql.connect()
     try:
         sql = '''
         delete from phone where cID=%(cID)s and phone=%(phone)s;
         '''
-        Mysql.execute_only(conn, sql, cID=data.cID, phone=data.phone)
+        async with conn:
+            await AsyncMysql.execute_only(conn, sql, cID=data.cID, phone=data.phone)
         logger.success(f'移除餐厅绑定的手机号成功\t phone-{data.phone} cID-{data.cID}')
         return SuccessInfo(msg='remove phone from canteen success')
 
     except Exception as e:
         logger.debug(f'移除餐厅绑定的手机号失败\t phone-{data.phone} cID-{data.cID}\t{e}')
         raise HTTPException(status_code=400, detail="remove phone from canteen failed")
-    finally:
-        conn.close()
 
 
 @router.post("/getCanteenBindPhone")
 async def get_canteen_bind_phone_list(data: GetCanteenBindPhoneModel,
-                                      verify=Depends(dependencies.code_verify_aes_depend)):
+                                      verify=Depends(dependencies.code_verify_aes_depend),
+                                      conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     """
     获取餐厅绑定的手机号
     """
-    conn = Mysql.connect()
     try:
         sql = '''
         select phone from phone where cID=%(cID)s;
         '''
-        res = Mysql.execute_fetchall(conn, sql, cID=data.cID)
+        async with conn:
+            res = await AsyncMysql.cached_fetchall(conn, sql, cID=data.cID)
         return SuccessInfo(msg='get phone list success',
                            data={'phone': (x[0] for x in res)}).to_dict()
 
     except Exception as e:
         logger.debug(f'获取餐厅绑定的手机号失败-cID={data.cID}\t{e}')
         raise HTTPException(status_code=400, detail="get phones of canteen failed")
-    finally:
-        conn.close()
 
 
 @router.post("/bindCanteen")
-async def bind_canteen_sms(data: BindCanteenSmsModel, verify=Depends(dependencies.code_verify_aes_depend)):
-    conn = Mysql.connect()
+async def bind_canteen_sms(data: BindCanteenSmsModel, verify=Depends(dependencies.code_verify_aes_depend),
+                           conn: RoutingConnection = Depends(dependencies.mysql_primary_depend)):
     try:
         # 再次简单核验电话号码，防止注入等问题
         if re.match(r'^\+86[1][34578][0-9]{9}$', data.phone) is None:
             raise XMUORDERException(['此号码不是正确的手机号码', data.phone])
 
-        sql = 'select phone from phone where cID=%(cID)s;'
-        res = Mysql.execute_fetchall(conn, sql, cID=data.cID)
-        if len(res) >= 3:
-            raise XMUORDERException(['餐厅可绑定号码数已达上限', data.cID])
-        for x in res:
-            if x[0] == data.phone:
-                raise XMUORDERException(['此号码已绑定', data.phone])
-
-        sql = '''
-        select phone, code, expiration from phone_verification
-        where phone=%(phone)s; 
-        '''
-        res: tuple[str, str, datetime] = Mysql.execute_fetchone(conn, sql, phone=data.phone)
-        # 无号码记录
-        if res is None:
-            raise XMUORDERException(['此号码未发送验证码', data.phone])
-
-        # 验证码过期
-        if datetime.now() > res[2]:
-            raise XMUORDERException(['验证码已过期', data.phone])
-
-        # 验证码错误
-        if res[1] != data.sms_code:
-            raise XMUORDERException(['验证码错误', data.phone])
+        async with conn:
+            sql = 'select phone from phone where cID=%(cID)s;'
+            res = await AsyncMysql.cached_fetchall(conn, sql, cID=data.cID)
+            if len(res) >= 3:
+                raise XMUORDERException(['餐厅可绑定号码数已达上限', data.cID])
+            for x in res:
+                if x[0] == data.phone:
+                    raise XMUORDERException(['此号码已绑定', data.phone])
 
-        sql1 = '''
-        # 更新、或添加此号码所在餐厅
-        insert into canteen (cID, name)
-            VALUES (%(cID)s, %(name)s)
-        ON DUPLICATE KEY UPDATE
-            name=%(name)s;
-        '''
-        sql2 = '''# 插入phone表
-        insert into phone (cID, phone)
-        values (%(cID)s, %(phone)s)
-        '''
+            sql = '''
+            select phone, code, expiration from phone_verification
+            where phone=%(phone)s; 
+            '''
+            res: tuple[str, str, datetime] = await AsyncMysql.execute_fetchone(conn, sql, phone=data.phone)
+            # 无号码记录
+            if res is None:
+                raise XMUORDERException(['此号码未发送验证码', data.phone])
+
+            # 验证码过期
+            if datetime.now() > res[2]:
+                raise XMUORDERException(['验证码已过期', data.phone])
+
+            # 验证码错误
+            if res[1] != data.sms_code:
+                raise XMUORDERException(['验证码错误', data.phone])
+
+            sql1 = '''
+            # 更新、或添加此号码所在餐厅；改写同步写入的名称时清空摘要，下次同步恢复为云数据库中的名称
+            insert into canteen (cID, name)
+                VALUES (%(cID)s, %(name)s)
+            ON DUPLICATE KEY UPDATE
+                syncHash=if(syncHash is null or name = %(name)s, syncHash, ''),
+                name=%(name)s;
+            '''
+            sql2 = '''# 插入phone表
+            insert into phone (cID, phone)
+            values (%(cID)s, %(phone)s)
+            '''
 
-        Mysql.execute_only(conn, sql1, cID=data.cID, name=data.cName)
-        Mysql.execute_only(conn, sql2, cID=data.cID, phone=data.phone)
-        conn.commit()
+            #   合并为一次请求，在同一事务中执行并提交
+            await AsyncMysql.execute_batch(conn, [
+                (sql1, {'cID': data.cID, 'name': data.cName}),
+                (sql2, {'cID': data.cID, 'phone': data.phone})
+            ])
 
         logger.success(f'绑定餐厅短信通知成功-phone:{data.phone}')
         return SuccessInfo(msg='Bind sms notification success',
@@ -284,8 +298,6 @@ async def bind_canteen_sms(data: BindCanteenSmsModel, verify=Depends(dependencie
     except Exception as e:
         logger.debug(f'餐厅绑定手机号失败 {e}')
         raise HTTPException(status_code=400, detail="餐厅绑定手机号失败")
-    finally:
-        conn.close()
 
 
 def send_tencent_sms(appid: str, sign_name: str, template_id: str,
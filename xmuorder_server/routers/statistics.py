@@ -2,12 +2,17 @@ from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 
 from .. import dependencies
+from ..config import GlobalSettings
 from ..logger import Logger
-from ..weixin.database import Database
+from ..weixin.database import AsyncDatabase, Cursor, ExtJson
+from ..weixin.mirror import OrderMirror
+from ..weixin.rollup import SalesRollup
+from ..weixin.query import Aggregate, _, S
 from ..common import XMUORDERException, WithMsgException
 
-from decimal import Decimal
-import json
+from contextlib import aclosing
+from decimal import Decimal, ROUND_HALF_UP
+from typing import AsyncIterable
 
 router = APIRouter()
 logger: Logger
@@ -54,8 +59,15 @@ async def shop_info(data: ShopStatisticsModel, verify=Depends(dependencies.code_
             'endTime': data.end_date + '2400'
         }
 
-        order_data = OrderStatistics.get_order_data(cid=data.cID, begin_date=data.begin_date, end_date=data.end_date)
-        cal_dict = OrderStatistics.cal_by_class(order_data)
+        #   已汇总的日期读取销售日汇总表（一次索引查询），汇总范围以外的日期（当天、首次汇总之前等）实时计算
+        rolled = await SalesRollup.rolled_range() if SalesRollup.enabled else None
+        rollup_range, live_ranges = SalesRollup.split(data.begin_date, data.end_date, rolled)
+        cal_dict = {}
+        if rollup_range is not None:
+            cal_dict = await SalesRollup.query(cid=data.cID, begin_date=rollup_range[0], end_date=rollup_range[1])
+        for begin_date, end_date in live_ranges:
+            live_dict = await OrderStatistics.cal_range(cid=data.cID, begin_date=begin_date, end_date=end_date)
+            cal_dict = OrderStatistics.merge(cal_dict, live_dict)
         out['data'] = [{'typeName': k, **v} for k, v in cal_dict.items()]
 
         return out
@@ -83,14 +95,18 @@ async def rider_info(data: RiderStatisticsModel, verify=Depends(dependencies.cod
             'endTime': data.end_date + '2400'
         }
 
-        rider_data = RiderStatistics.get_rider_data(rider_id=data.rider_id, begin_date=data.begin_date,
-                                                    end_date=data.end_date)
+        #   镜像可用时读取本地订单镜像
+        if await OrderMirror.usable(out['beginTime']):
+            rider_data = await OrderMirror.rider_groups(rider_id=data.rider_id, begin_time=out['beginTime'],
+                                                        end_time=out['endTime'])
+        else:
+            rider_data = await RiderStatistics.get_rider_data(rider_id=data.rider_id, begin_date=data.begin_date,
+                                                              end_date=data.end_date)
         out_data = []
-        for x in rider_data['data']:
-            group = json.loads(x)
+        for group in rider_data:
             out_data.append({'shopName': group['_id'],
-                             'totalFee': int(float(tuple(group['totalFee'].values())[0])) / 100,
-                             'count': int(tuple(group['count'].values())[0])})
+                             'totalFee': int(group['totalFee']) / 100,
+                             'count': group['count']})
         out['data'] = out_data
         return out
     except WithMsgException as e:
@@ -108,24 +124,22 @@ class RiderStatistics:
     """
 
     @staticmethod
-    def get_rider_data(rider_id: str, begin_date: str, end_date: str) -> dict:
+    async def get_rider_data(rider_id: str, begin_date: str, end_date: str) -> list[dict]:
         """
         获取骑手配送统计信息
         """
-        query = f'''
-            aggregate().match({{'orderInfo.orderState': 'SUCCESS', 'deliverInfo.isDelivered': true,
-            'deliverInfo.id':'{rider_id}',
-            'orderInfo.timeInfo.confirmTime':_.and(_.gte('{begin_date + '0000'}'), _.lte('{end_date + '2400'}'))
-        }})'''
+        query = Aggregate().match({
+            'orderInfo.orderState': 'SUCCESS', 'deliverInfo.isDelivered': True,
+            'deliverInfo.id': rider_id,
+            'orderInfo.timeInfo.confirmTime': _.and_(_.gte(begin_date + '0000'), _.lte(end_date + '2400'))
+        }).replace_root({
+            'shop': '$goodsInfo.shopInfo.name', 'deliverFee': '$payInfo.feeInfo.deliverFee'
+        }).group({
+            '_id': '$shop', 'totalFee': S.sum('$deliverFee'), 'count': S.sum(1)
+        }).end()
+        res = await AsyncDatabase.aggregate('orders', query)
 
-        query += '''
-            .replaceRoot({newRoot: {rider_id: '$deliverInfo.id', shop: '$goodsInfo.shopInfo.name',
-              feeInfo: '$payInfo.feeInfo', _count: 1}})
-            .group({_id: '$shop', totalFee: $.sum('$feeInfo.deliverFee'), count: $.sum('$_count')}).end()
-        '''
-        res = Database.aggregate('orders', query)
-
-        return res
+        return ExtJson.loads_page(res['data'])
 
 
 class OrderStatistics:
@@ -133,58 +147,128 @@ class OrderStatistics:
     订单统计，营业额、销量
     """
 
+    #   金额比较及云端聚合结果的精度
+    CENT = Decimal('0.01')
+
     @staticmethod
-    def get_order_data(cid: str, begin_date: str, end_date: str) -> list[str]:
+    def __match(cid: str, begin_date: str, end_date: str) -> Aggregate:
         """
-        获取商家统计订单数据库内容，同步分页循环获取，返回list[json]
+        商家统计订单的筛选条件，只取计算需要的字段
         """
-
-        #   分页
-        count_query = f'''
-        where({{
+        return Aggregate().match({
             'orderInfo.orderState': 'SUCCESS', 'payInfo.tradeState': 'SUCCESS',
-            'goodsInfo.shopInfo.cID':'{cid}',
-            'orderInfo.timeInfo.confirmTime': _.and(_.gte('{begin_date + '0000'}'), _.lt('{end_date + '2400'}'))
-        }}).count()
-        '''
-        total_count = Database.count('orders', count_query)['count']
-        page_size = 25
-        total_page = int((total_count - 1) / page_size + 1)
-
-        #   构建查询语句
-        query = f'''
-        aggregate().match({{'orderInfo.orderState': 'SUCCESS', 'payInfo.tradeState': 'SUCCESS',
-        'goodsInfo.shopInfo.cID':'{cid}',
-        'orderInfo.timeInfo.confirmTime':_.and(_.gte('{begin_date + '0000'}'), _.lte('{end_date + '2400'}'))
-        }})'''
-
-        query += '''
-        %%skip_limit_words%%
-        .replaceRoot({newRoot: {record: '$goodsInfo.record',}}).end()
-        '''
-
-        #   查询
-        out = []
-        for page_num in range(total_page):
-            new_query = query.replace('%%skip_limit_words%%', f'.skip({page_num * page_size}).limit({page_size})')
-            res = Database.aggregate('orders', new_query)
-            out += res['data']
+            'goodsInfo.shopInfo.cID': cid,
+            'orderInfo.timeInfo.confirmTime': _.and_(_.gte(begin_date + '0000'), _.lte(end_date + '2400'))
+        }).project(
+            'goodsInfo.record.num', 'goodsInfo.record.price', 'goodsInfo.record.typeName'
+        )
 
-        return out
+    @staticmethod
+    def get_order_data(cid: str, begin_date: str, end_date: str) -> Cursor:
+        """
+        获取商家统计订单数据库内容，返回游标，async for 逐条读取
+        """
+        query = OrderStatistics.__match(cid, begin_date, end_date).replace_root({'record': '$goodsInfo.record'})
+
+        return AsyncDatabase.cursor('orders', query.build())
+
+    @staticmethod
+    async def cal_by_class_aggregate(cid: str, begin_date: str, end_date: str) -> dict:
+        """
+        云端聚合：展开商品记录后按类别分组求和，只返回每个类别一条结果，格式同cal_by_class
+        云端以浮点数计算，金额按分四舍五入
+        """
+        query = OrderStatistics.__match(cid, begin_date, end_date).unwind('$goodsInfo.record').group({
+            '_id': '$goodsInfo.record.typeName',
+            'income': S.sum(S.multiply(['$goodsInfo.record.num', '$goodsInfo.record.price'])),
+            'salesAmount': S.sum('$goodsInfo.record.num')
+        }).sort({'_id': 1})
+
+        out_dict = {}
+        async for group in AsyncDatabase.cursor('orders', query.build(), page_size=100):
+            out_dict[group['_id']] = {
+                'income': Decimal(str(group['income'])).quantize(OrderStatistics.CENT, ROUND_HALF_UP),
+                'salesAmount': group['salesAmount']
+            }
+        return out_dict
+
+    @staticmethod
+    def same_result(a: dict, b: dict) -> bool:
+        """
+        比较两种方式的统计结果：类别相同，销量相等，营业额按分四舍五入后相等
+        """
+        if a.keys() != b.keys():
+            return False
+        for type_name, x in a.items():
+            y = b[type_name]
+            if x['salesAmount'] != y['salesAmount']:
+                return False
+            if Decimal(x['income']).quantize(OrderStatistics.CENT, ROUND_HALF_UP) != \
+                    Decimal(y['income']).quantize(OrderStatistics.CENT, ROUND_HALF_UP):
+                return False
+        return True
+
+    @staticmethod
+    async def cal_range(cid: str, begin_date: str, end_date: str) -> dict:
+        """
+        实时计算日期范围内按类别的营业额、销量
+        订单镜像可用时读取镜像，否则云端聚合（失败则回退到本地逐条计算）
+        """
+        global_setting = GlobalSettings.get()
+        cal_dict = None
+        #   镜像可用时读取本地订单镜像
+        if await OrderMirror.usable(begin_date + '0000'):
+            #   计算出错时立即关闭游标并归还连接
+            async with aclosing(OrderMirror.shop_records(cid=cid, begin_time=begin_date + '0000',
+                                                         end_time=end_date + '2400')) as order_data:
+                cal_dict = await OrderStatistics.cal_by_class(order_data)
+        elif global_setting.statistics_server_aggregate:
+            #   云端聚合，失败则回退到本地计算
+            try:
+                cal_dict = await OrderStatistics.cal_by_class_aggregate(cid=cid, begin_date=begin_date,
+                                                                        end_date=end_date)
+            except Exception as e:
+                logger.warning(f'[商店统计]-云端聚合失败，回退到本地计算-{e}-cID:{cid}')
+            else:
+                if global_setting.statistics_verify_aggregate:
+                    order_data = OrderStatistics.get_order_data(cid=cid, begin_date=begin_date, end_date=end_date)
+                    local_dict = await OrderStatistics.cal_by_class(order_data)
+                    if not OrderStatistics.same_result(cal_dict, local_dict):
+                        logger.error(f'[商店统计]-云端聚合与本地计算结果不一致，使用本地结果-cID:{cid} '
+                                     f'-云端:{cal_dict} -本地:{local_dict}')
+                        cal_dict = local_dict
+
+        if cal_dict is None:
+            order_data = OrderStatistics.get_order_data(cid=cid, begin_date=begin_date, end_date=end_date)
+            cal_dict = await OrderStatistics.cal_by_class(order_data)
+        return cal_dict
+
+    @staticmethod
+    def merge(a: dict, b: dict) -> dict:
+        """
+        合并两个按类别的统计结果，营业额、销量分别相加
+        """
+        out_dict = {k: dict(v) for k, v in a.items()}
+        for type_name, x in b.items():
+            if type_name not in out_dict:
+                out_dict[type_name] = dict(x)
+            else:
+                out_dict[type_name]['income'] += x['income']
+                out_dict[type_name]['salesAmount'] += x['salesAmount']
+        return out_dict
 
     @staticmethod
-    def cal_by_class(orders_list: list[str]) -> dict:
+    async def cal_by_class(orders: AsyncIterable[dict]) -> dict:
         """
-        根据类别计算商品价格
+        根据类别计算商品价格，边读取边计算
         """
         out_dict = {}
         try:
-            for record in orders_list:
-                record_dict = json.loads(record)
-                for index, data in enumerate(record_dict['record']):
+            async for record in orders:
+                for index, data in enumerate(record['record']):
                     #   计算
-                    num = int(data['num']['$numberInt'])
-                    price = num * Decimal(data['price']['$numberDouble'])
+                    num = data['num']
+                    price = num * Decimal(data['price'])
                     type_name = data['typeName']
                     #   记录
                     if type_name not in out_dict.keys():
@@ -1,13 +1,24 @@
+from typing import Optional
+
 from fastapi import APIRouter, HTTPException, Depends
+from pydantic import BaseModel
 
 from .. import dependencies
 from ..logger import Logger
 from ..weixin.database import UpdateDataBase
+from ..weixin.mirror import OrderMirror
 
 router = APIRouter()
 logger: Logger
 
 
+class BackfillOrderMirrorModel(BaseModel):
+    """
+    订单镜像回填接口模板
+    """
+    begin_date: Optional[str] = None  # 起始日期，如20220401，为空则回填全部订单
+
+
 @router.on_event("startup")
 async def __init():
     #   获取默认日志
@@ -21,12 +32,31 @@ async def update_canteen_table(verify=Depends(dependencies.code_verify_aes_depen
     通过微信数据库刷新同步canteen表
     """
     try:
-        UpdateDataBase.update_canteen_table()
-        logger.success(f'请求成功 -canteen 已刷新')
+        report = await UpdateDataBase.update_canteen_table()
+        logger.success(f'请求成功 -canteen 已刷新 {report}')
         return {
             'success': True,
-            'msg': '刷新成功'
+            'msg': '刷新成功',
+            'data': report
         }
     except Exception as e:
         logger.error(f'请求失败 -canteen 刷新失败 -{e}')
         raise HTTPException(status_code=400, detail='刷新失败')
+
+
+@router.post("/orderMirror")
+async def backfill_order_mirror(data: BackfillOrderMirrorModel, verify=Depends(dependencies.code_verify_aes_depend)):
+    """
+    通过微信数据库导出任务批量回填订单镜像(order_mirror表)
+    """
+    try:
+        report = await OrderMirror.backfill(data.begin_date)
+        logger.success(f'请求成功 -order_mirror 已回填 {report}')
+        return {
+            'success': True,
+            'msg': '回填成功',
+            'data': report
+        }
+    except Exception as e:
+        logger.error(f'请求失败 -order_mirror 回填失败 -{e}')
+        raise HTTPException(status_code=400, detail='回填失败')
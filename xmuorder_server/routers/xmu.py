@@ -7,7 +7,7 @@ from pydantic import BaseModel
 
 from .. import dependencies
 from ..common import SuccessInfo, ErrorInfo, XMUORDERException
-from ..database import Mysql
+from ..database import AsyncMysql, RoutingConnection
 from ..logger import Logger
 from ..security import AES
 
@@ -41,7 +41,8 @@ async def __init():
 
 
 @router.post("/bind")
-async def xmu_bind(data: BindModel, verify=Depends(dependencies.code_verify_aes_depend)):
+async def xmu_bind(data: BindModel, verify=Depends(dependencies.code_verify_aes_depend),
+                   conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     """
     通过统一身份认证账号密码绑定用户信息，储存至数据库，并返回基本信息
     """
@@ -80,7 +81,7 @@ async def xmu_bind(data: BindModel, verify=Depends(dependencies.code_verify_aes_
         info['pw'] = en_pw
 
         # 储存需要的信息到数据库
-        store_info(info)
+        await store_info(conn, info)
 
         # 退出登录
         session_logout(session)
@@ -102,7 +103,8 @@ async def xmu_bind(data: BindModel, verify=Depends(dependencies.code_verify_aes_
 
 
 @router.post("/login")
-async def xmu_login(data: LoginModel, verify=Depends(dependencies.code_verify_aes_depend)):
+async def xmu_login(data: LoginModel, verify=Depends(dependencies.code_verify_aes_depend),
+                    conn: RoutingConnection = Depends(dependencies.mysql_depend)):
     """
     通过openid读取数据库，返回用户信息
     """
@@ -111,7 +113,7 @@ async def xmu_login(data: LoginModel, verify=Depends(dependencies.code_verify_ae
         iv = 're_' + data.ts[0:11] + 'dro'
         openid = AES.decrypt_aes(key, iv, en_src=data.uid)
 
-        user_data = read_info(openid)
+        user_data = await read_info(conn, openid)
         logger.success(f"{user_data['name']}:{user_data['user_id']} 获取本地信息成功!")
         return SuccessInfo('login success', data=user_data).to_dict()
 
@@ -120,45 +122,38 @@ async def xmu_login(data: LoginModel, verify=Depends(dependencies.code_verify_ae
         raise HTTPException(status_code=400, detail=ErrorInfo('login failed').to_dict())
 
 
-def read_info(openid: str) -> dict:
+async def read_info(conn: RoutingConnection, openid: str) -> dict:
     """
     读取本地用户信息
     """
-    conn = Mysql.connect()
-    try:
-        sql = "select user_id, name, college, grade from user where openid = %(openid)s;"
-        res = Mysql.execute_fetchone(conn, sql, openid=openid)
-        return {
-            'user_id': res[0],
-            'name': res[1],
-            'college': res[2],
-            'grade': res[3]
-        }
-    finally:
-        conn.close()
+    sql = "select user_id, name, college, grade from user where openid = %(openid)s;"
+    async with conn:
+        res = await AsyncMysql.execute_fetchone(conn, sql, openid=openid)
+    return {
+        'user_id': res[0],
+        'name': res[1],
+        'college': res[2],
+        'grade': res[3]
+    }
 
 
-def store_info(info: dict) -> None:
+async def store_info(conn: RoutingConnection, info: dict) -> None:
     """
     储存用户信息到数据库，若openid或学号存在则更新，否则insert
+    :param conn: 连接
     :param info: 信息字典
     """
-    conn = Mysql.connect()
-    try:
-        sql = '''
-        insert into user (openid, user_id, account, pw, name, college, phone, grade)
-        VALUES (%(openid)s, %(user_id)s, %(account)s, %(pw)s, %(name)s, %(college)s, %(phone)s, %(grade)s)
-        ON DUPLICATE KEY UPDATE
-        user_id=%(user_id)s,
-        account=%(account)s, pw=%(pw)s,
-        name=%(name)s, college=%(college)s,
-        phone=%(phone)s, grade=%(grade)s;
-        '''
-
-        Mysql.execute_fetchall(conn, sql, **info)
-    finally:
-        conn.commit()
-        conn.close()
+    sql = '''
+    insert into user (openid, user_id, account, pw, name, college, phone, grade)
+    VALUES (%(openid)s, %(user_id)s, %(account)s, %(pw)s, %(name)s, %(college)s, %(phone)s, %(grade)s)
+    ON DUPLICATE KEY UPDATE
+    user_id=%(user_id)s,
+    account=%(account)s, pw=%(pw)s,
+    name=%(name)s, college=%(college)s,
+    phone=%(phone)s, grade=%(grade)s;
+    '''
+    async with conn:
+        await AsyncMysql.execute_only(conn, sql, **info)
 
 
 def get_basic_info(session: requests.Session) -> dict:
@@ -1,9 +1,14 @@
+from datetime import datetime, timezone
+
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.job import Job
 
+from .config import GlobalSettings
 from .database import Mysql
 from .logger import Logger
 from .weixin.database import UpdateDataBase
+from .weixin.mirror import OrderMirror
+from .weixin.rollup import SalesRollup
 
 #   当前模块日志
 logger: Logger
@@ -28,6 +33,17 @@ class Scheduler:
         Scheduler.add(Task.refresh_database_task, job_name='同步数据库',
                       trigger='cron', minute="0", second='0')
 
+        # 订单镜像增量同步任务
+        global_setting = GlobalSettings.get()
+        if global_setting.orders_mirror_enabled:
+            Scheduler.add(Task.mirror_orders_task, job_name='同步订单镜像', trigger='interval',
+                          seconds=global_setting.orders_mirror_interval, max_instances=1, coalesce=True)
+
+        # 销售日汇总任务（启动时补齐缺少的日期）
+        if SalesRollup.enabled:
+            Scheduler.add(Task.rollup_sales_task, job_name='销售日汇总', trigger='cron', hour='0', minute='10',
+                          second='0', next_run_time=datetime.now(timezone.utc), max_instances=1, coalesce=True)
+
     @classmethod
     def add(cls, func: callable, job_name: str, **kwargs):
         """
@@ -63,28 +79,65 @@ class Scheduler:
 
 class Task:
     @staticmethod
-    def clear_phone_verification_task(job_name: str):
+    def clear_phone_verification_task(job_name: str, batch_size: int = 1000):
         """
-        定时任务，清理过期验证码，重置剩余验证码次数
+        定时任务，分批清理今日之前且已过期的验证码记录
+        发送次数在发送验证码时按日期重置，无需全表更新
+        :param job_name: 任务名
+        :param batch_size: 每批删除行数，每批单独提交，避免长时间持有锁
         """
         try:
-            sql1 = 'DELETE FROM phone_verification WHERE NOW() > expiration;'
-            sql2 = 'UPDATE phone_verification SET sendTimes = 0 WHERE sendTimes!=0;'
+            sql = '''
+            DELETE FROM phone_verification
+            WHERE sendDate < CURDATE() AND expiration < NOW()
+            LIMIT %(limit)s;
+            '''
+            total = 0
             with Mysql.connect() as conn:
-                Mysql.execute_only(conn, sql1)
-                Mysql.execute_only(conn, sql2)
-                conn.commit()
-            logger.success(f'定时任务[{job_name}]已完成')
+                while True:
+                    count = Mysql.execute_only(conn, sql, limit=batch_size)
+                    conn.commit()
+                    total += count
+                    if count < batch_size:
+                        break
+            logger.success(f'定时任务[{job_name}]已完成 清理{total}条')
         except Exception as e:
             logger.error(f'定时任务[{job_name}]发生错误:{e}')
 
     @staticmethod
-    def refresh_database_task(job_name: str):
+    async def refresh_database_task(job_name: str):
         """
         定时任务 通过获取微信数据库同步本地mysql数据库
         """
         try:
-            UpdateDataBase.update_canteen_table()
-            logger.success(f'定时任务[{job_name}]已完成')
+            report = await UpdateDataBase.update_canteen_table()
+            written = report['inserted'] + report['updated'] + report['deleted']
+            logger.success(f'定时任务[{job_name}]已完成 读取{report["scanned"]}条 写入{written}条 {report}')
+        except Exception as e:
+            logger.error(f'定时任务[{job_name}]发生错误:{e}')
+
+    @staticmethod
+    async def mirror_orders_task(job_name: str):
+        """
+        定时任务 增量同步云数据库orders集合到本地order_mirror表
+        """
+        try:
+            report = await OrderMirror.sync()
+            #   增量同步只覆盖回溯窗口，之后状态变化的订单（如配送完成）通过对账更新
+            reconcile = await OrderMirror.reconcile()
+            logger.debug(f'定时任务[{job_name}]已完成 读取{report["scanned"]}条 写入{report["upserted"]}条 '
+                         f'检查点{report["checkpoint"]} 对账{reconcile["keys"]}条')
+        except Exception as e:
+            logger.error(f'定时任务[{job_name}]发生错误:{e}')
+
+    @staticmethod
+    async def rollup_sales_task(job_name: str):
+        """
+        定时任务 汇总检查点之后至昨天的餐厅销售数据
+        """
+        try:
+            report = await SalesRollup.refresh()
+            logger.success(f'定时任务[{job_name}]已完成 汇总{report["days"]}天 写入{report["rows"]}条 '
+                           f'已汇总{report["rolled_from"]}~{report["rolled_until"]}')
         except Exception as e:
             logger.error(f'定时任务[{job_name}]发生错误:{e}')
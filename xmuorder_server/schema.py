@@ -0,0 +1,337 @@
+"""
+数据库结构管理
+1. 版本化迁移：建表、主键、二级索引，已执行的版本记录在 schema_version 表
+2. 热点查询检查：EXPLAIN 每条热点查询，无可用索引的全表扫描视为失败
+"""
+from typing import Callable, Union
+
+import pymysql
+from pymysql.constants import ER
+
+from .common import XMUORDERException
+from .database import Mysql
+from .logger import Logger
+
+#   当前模块日志
+logger: Logger
+
+
+def ensure_index(table: str, index_name: str, columns: list[str], unique: bool = False) -> Callable:
+    """
+    生成迁移步骤：若表中没有以columns开头的索引则创建（兼容已存在但缺少索引的旧表）
+    :param table: 表名
+    :param index_name: 索引名
+    :param columns: 索引列
+    :param unique: 是否唯一索引
+    """
+
+    def step(conn: pymysql.connections.Connection):
+        sql = '''
+        select index_name, seq_in_index, column_name from information_schema.statistics
+        where table_schema = database() and table_name = %(table)s
+        order by index_name, seq_in_index;
+        '''
+        indexes = {}
+        for name, _, column in Mysql.execute_fetchall(conn, sql, table=table):
+            indexes.setdefault(name, []).append(column.lower())
+        target = [x.lower() for x in columns]
+        if any(cols[:len(target)] == target for cols in indexes.values()):
+            return
+        Mysql.execute_only(conn, 'create {unique}index `{name}` on `{table}` ({columns});'.format(
+            unique='unique ' if unique else '', name=index_name, table=table,
+            columns=', '.join(f'`{x}`' for x in columns)))
+        logger.info(f'已创建索引 {table}.{index_name}')
+
+    return step
+
+
+def ensure_column(table: str, column: str, definition: str) -> Callable:
+    """
+    生成迁移步骤：若表中没有该列则添加
+    :param table: 表名
+    :param column: 列名
+    :param definition: 列定义，如 "date not null default '2000-01-01'"
+    """
+
+    def step(conn: pymysql.connections.Connection):
+        sql = '''
+        select count(*) from information_schema.columns
+        where table_schema = database() and table_name = %(table)s and column_name = %(column)s;
+        '''
+        if Mysql.execute_fetchone(conn, sql, table=table, column=column)[0] > 0:
+            return
+        Mysql.execute_only(conn, f'alter table `{table}` add column `{column}` {definition};')
+        logger.info(f'已添加列 {table}.{column}')
+
+    return step
+
+
+#   迁移列表 [(版本号, 说明, [sql语句 或 step(conn)]), ...]，只能追加，不能修改已发布的版本
+MIGRATIONS: list[tuple[int, str, list[Union[str, Callable]]]] = [
+    (1, '创建基础表及热点查询索引', [
+        '''
+        create table if not exists canteen (
+            cID varchar(64) not null,
+            name varchar(128) not null default '',
+            lastSendMsgTime datetime not null default '2000-01-01 00:00:00',
+            primary key (cID)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''',
+        '''
+        create table if not exists phone (
+            cID varchar(64) not null,
+            phone varchar(20) not null,
+            primary key (cID, phone)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''',
+        '''
+        create table if not exists printer (
+            sn varchar(32) not null,
+            cID varchar(64) not null,
+            `key` varchar(32) not null,
+            primary key (sn),
+            key idx_printer_cID (cID)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''',
+        '''
+        create table if not exists phone_verification (
+            phone varchar(20) not null,
+            code char(6) not null,
+            expiration datetime not null,
+            lastSendTime datetime not null,
+            sendTimes int not null default 0,
+            primary key (phone)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''',
+        '''
+        create table if not exists `user` (
+            openid varchar(64) not null,
+            user_id varchar(32) not null,
+            account varchar(64) not null,
+            pw varchar(255) not null,
+            name varchar(64) not null default '',
+            college varchar(128) not null default '',
+            phone varchar(32) not null default '',
+            grade varchar(32) not null default '',
+            primary key (openid),
+            unique key uk_user_user_id (user_id)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''',
+        #   旧库中表已存在时补充索引
+        ensure_index('canteen', 'idx_canteen_cID', ['cID']),
+        ensure_index('phone', 'idx_phone_cID', ['cID']),
+        ensure_index('printer', 'idx_printer_cID', ['cID']),
+        ensure_index('phone_verification', 'idx_phone_verification_phone', ['phone']),
+        ensure_index('user', 'idx_user_openid', ['openid']),
+    ]),
+    (2, '验证码发送次数按日期记录，添加过期记录清理索引', [
+        ensure_column('phone_verification', 'sendDate', "date not null default '2000-01-01'"),
+        ensure_index('phone_verification', 'idx_phone_verification_sendDate', ['sendDate']),
+    ]),
+    (3, '创建云数据库同步检查点表', [
+        '''
+        create table if not exists sync_checkpoint (
+            name varchar(64) not null,
+            mark varchar(255) not null default '',
+            updated_at datetime not null default current_timestamp on update current_timestamp,
+            primary key (name)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''',
+    ]),
+    (4, '创建云数据库订单镜像表', [
+        '''
+        create table if not exists order_mirror (
+            outTradeNo varchar(64) not null,
+            cID varchar(64) null,
+            shopName varchar(128) null,
+            orderState varchar(32) null,
+            tradeState varchar(32) null,
+            confirmTime char(14) null,
+            isDelivery tinyint(1) null,
+            isDelivered tinyint(1) null,
+            riderId varchar(64) null,
+            deliverFee int null,
+            userName varchar(64) null,
+            userPhone varchar(32) null,
+            place varchar(255) null,
+            record json null,
+            synced_at datetime not null default current_timestamp on update current_timestamp,
+            primary key (outTradeNo),
+            key idx_order_mirror_cID_confirmTime (cID, confirmTime),
+            key idx_order_mirror_riderId_confirmTime (riderId, confirmTime)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''',
+    ]),
+    (5, '创建餐厅销售日汇总表', [
+        '''
+        create table if not exists sales_rollup (
+            cID varchar(64) not null,
+            day date not null,
+            typeName varchar(128) not null,
+            income decimal(12, 2) not null default 0,
+            salesAmount int not null default 0,
+            primary key (cID, day, typeName),
+            key idx_sales_rollup_day (day)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''',
+    ]),
+    (6, '订单镜像对账索引', [
+        ensure_index('order_mirror', 'idx_order_mirror_confirmTime', ['confirmTime']),
+    ]),
+    (7, 'canteen表记录同步写入的内容摘要', [
+        #   null: 非同步写入（如绑定餐厅时插入），'': 同步写入后名称被本地改写
+        ensure_column('canteen', 'syncHash', 'char(32) null default null'),
+    ]),
+]
+
+#   热点查询 [(名称, sql, 示例参数), ...]
+HOT_QUERIES: list[tuple[str, str, dict]] = [
+    ('打印机列表', 'select sn from printer where cID = %(cID)s;', {'cID': '0'}),
+    ('餐厅绑定手机号', 'select phone from phone where cID=%(cID)s;', {'cID': '0'}),
+    ('餐厅名称', 'select name from canteen where cID = %(cID)s limit 1;', {'cID': '0'}),
+    ('验证码记录', '''
+        select phone, code, expiration, lastSendTime, sendTimes
+        from phone_verification where phone=%(phone)s;
+        ''', {'phone': '0'}),
+    ('清理过期验证码', '''
+        delete from phone_verification
+        where sendDate < CURDATE() and expiration < NOW()
+        limit %(limit)s;
+        ''', {'limit': 1000}),
+    ('用户信息', 'select user_id, name, college, grade from user where openid = %(openid)s;', {'openid': '0'}),
+    ('餐厅通知手机号', '''
+        select c.cID, p.phone, c.lastSendMsgTime
+        from canteen c
+                 left join phone p on c.cID = p.cID
+        where c.cID in %(cid_list)s
+            and TIMESTAMPDIFF(minute, c.lastSendMsgTime, NOW()) > 30;
+        ''', {'cid_list': ('0', '1')}),
+    ('镜像商家统计订单', '''
+        select record from order_mirror
+        where cID = %(cid)s and confirmTime between %(begin)s and %(end)s
+            and orderState = 'SUCCESS' and tradeState = 'SUCCESS';
+        ''', {'cid': '0', 'begin': '202001010000', 'end': '202001012400'}),
+    ('镜像骑手统计订单', '''
+        select shopName, coalesce(sum(deliverFee), 0), count(*) from order_mirror
+        where riderId = %(rider_id)s and confirmTime between %(begin)s and %(end)s
+            and orderState = 'SUCCESS' and isDelivered = 1
+        group by shopName;
+        ''', {'rider_id': '0', 'begin': '202001010000', 'end': '202001012400'}),
+    ('镜像未完成订单', '''
+        select outTradeNo from order_mirror
+        where confirmTime >= %(since)s
+            and (orderState is null or orderState <> 'SUCCESS' or tradeState is null or tradeState <> 'SUCCESS'
+                or (isDelivery = 1 and (isDelivered is null or isDelivered = 0)));
+        ''', {'since': '20200101000000'}),
+    ('餐厅销售日汇总', '''
+        select typeName, sum(income), sum(salesAmount) from sales_rollup
+        where cID = %(cid)s and day between %(begin)s and %(end)s
+        group by typeName;
+        ''', {'cid': '0', 'begin': '20200101', 'end': '20200130'}),
+    ('移除餐厅绑定手机号', 'delete from phone where cID=%(cID)s and phone=%(phone)s;', {'cID': '0', 'phone': '0'}),
+]
+
+
+class Schema:
+    """
+    数据库结构迁移及热点查询检查
+    """
+
+    @classmethod
+    def init(cls):
+        global logger
+        logger = Logger('数据库结构模块')
+
+    @classmethod
+    def run(cls):
+        """
+        执行迁移并检查热点查询
+        """
+        cls.migrate()
+        cls.check_hot_queries()
+
+    @classmethod
+    def current_version(cls, conn: pymysql.connections.Connection) -> int:
+        Mysql.execute_only(conn, '''
+        create table if not exists schema_version (
+            version int not null,
+            description varchar(255) not null,
+            applied_at datetime not null default current_timestamp,
+            primary key (version)
+        ) engine = InnoDB default charset = utf8mb4;
+        ''')
+        res = Mysql.execute_fetchone(conn, 'select max(version) from schema_version;')
+        return res[0] or 0
+
+    @classmethod
+    def migrate(cls) -> int:
+        """
+        按版本号顺序执行未执行的迁移
+        :return: 迁移后的版本号
+        """
+        with Mysql.connect() as conn:
+            version = cls.current_version(conn)
+            for target, description, steps in MIGRATIONS:
+                if target <= version:
+                    continue
+                logger.info(f'开始迁移 v{target} {description}')
+                try:
+                    for step in steps:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            Mysql.execute_only(conn, step)
+                    Mysql.execute_only(conn, '''
+                    insert into schema_version (version, description) values (%(version)s, %(description)s);
+                    ''', version=target, description=description)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    raise XMUORDERException(f'迁移 v{target} 失败-{e}')
+                version = target
+                logger.success(f'迁移 v{target} 已完成')
+        return version
+
+    @classmethod
+    def explain(cls, conn: pymysql.connections.Connection, sql: str, params: dict) -> list[dict]:
+        """
+        返回sql的执行计划
+        """
+        with Mysql.get_cursor(conn) as cur:
+            cur.execute('explain ' + sql.strip(), params)
+            columns = [x[0] for x in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    @classmethod
+    def check_hot_queries(cls) -> None:
+        """
+        检查热点查询的执行计划，无可用索引的全表扫描(type=ALL 且 possible_keys为空)则抛出异常
+        查询涉及的表不存在（尚未执行对应迁移）时跳过并记录警告
+        type=ALL 但有可用索引时（表数据过少，优化器选择扫描）只记录警告
+        """
+        failed = []
+        skipped = []
+        with Mysql.connect() as conn:
+            for name, sql, params in HOT_QUERIES:
+                try:
+                    plan = cls.explain(conn, sql, params)
+                except pymysql.MySQLError as e:
+                    #   表不存在（数据库版本低于创建该表的迁移）时跳过，其他错误视为失败
+                    if e.args and e.args[0] == ER.NO_SUCH_TABLE:
+                        skipped.append(name)
+                        logger.warning(f'热点查询[{name}] 表不存在，已跳过（请先执行迁移）-{e.args[-1]}')
+                    else:
+                        failed.append(f'{name}(执行计划获取失败:{e})')
+                    continue
+                for row in plan:
+                    if row.get('type') != 'ALL':
+                        continue
+                    if row.get('possible_keys'):
+                        logger.warning(f'热点查询[{name}] 表{row.get("table")}当前为全表扫描（可用索引:{row["possible_keys"]}）')
+                    else:
+                        failed.append(f'{name}({row.get("table")})')
+
+        if failed:
+            raise XMUORDERException(f'热点查询全表扫描: {", ".join(failed)}')
+        logger.success(f'热点查询检查通过 共{len(HOT_QUERIES) - len(skipped)}条'
+                       + (f' 跳过{len(skipped)}条: {", ".join(skipped)}' if skipped else ''))
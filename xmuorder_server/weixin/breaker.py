@@ -0,0 +1,95 @@
+"""
+微信接口熔断器
+接口异常（网络错误、超时、5xx、系统繁忙）连续达到阈值后熔断，熔断期间请求直接失败，不再等待超时
+"""
+import random
+import threading
+import time
+
+from ..common import XMUORDERException
+
+
+class CircuitBreaker:
+    """
+    closed --连续失败failure_threshold次--> open --recovery_timeout秒后--> half_open（只放行一个试探请求）
+    试探成功则恢复closed，失败则重新open
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30):
+        """
+        :param name: 名称，用于异常信息
+        :param failure_threshold: 连续失败次数阈值
+        :param recovery_timeout: 熔断后多久放行试探请求(s)
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.__failures = 0
+        self.__opened_at = 0.0
+        self.__probing = False
+        self.__probe_at = 0.0
+        #   统计
+        self.__open_count = 0
+        self.__rejected = 0
+        #   同步代码在线程中调用，需加锁
+        self.__lock = threading.Lock()
+
+    def check(self) -> None:
+        """
+        请求前调用，熔断中则抛出异常
+        """
+        with self.__lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.__opened_at < self.recovery_timeout:
+                    self.__rejected += 1
+                    raise XMUORDERException(f'{self.name}熔断中，请稍后再试')
+                self.state = self.HALF_OPEN
+                self.__probing = False
+            if self.state == self.HALF_OPEN:
+                #   试探请求被取消等未回报结果时，超时后允许新的试探
+                if self.__probing and time.monotonic() - self.__probe_at < self.recovery_timeout:
+                    self.__rejected += 1
+                    raise XMUORDERException(f'{self.name}熔断恢复中，请稍后再试')
+                self.__probing = True
+                self.__probe_at = time.monotonic()
+
+    def on_success(self) -> None:
+        with self.__lock:
+            self.__failures = 0
+            self.__probing = False
+            self.state = self.CLOSED
+
+    def on_failure(self) -> None:
+        with self.__lock:
+            self.__failures += 1
+            self.__probing = False
+            if self.state == self.HALF_OPEN or self.__failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.__open_count += 1
+                self.state = self.OPEN
+                self.__opened_at = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.__failures,
+            'open_count': self.__open_count,
+            'rejected': self.__rejected
+        }
+
+
+def backoff_delay(attempt: int, base: float) -> float:
+    """
+    指数退避等待时间（带随机抖动，避免多个请求同时重试）
+    :param attempt: 第几次重试，从0开始
+    :param base: 首次重试的基础等待时间(s)
+    """
+    return base * (2 ** attempt) * random.uniform(0.5, 1.0)
@@ -1,10 +1,92 @@
+import asyncio
+import hashlib
+import importlib.util
 import json
+import time
+from collections import deque, defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Optional, AsyncIterator, Any, Callable
 
+import httpx
 import requests
 
-from ..common import XMUORDERException
+from ..common import XMUORDERException, percentile
+from ..config import GlobalSettings
 from ..database import Mysql
+from ..logger import Logger
 from ..weixin.weixin import WeiXin
+from .breaker import CircuitBreaker, backoff_delay
+from .query import Aggregate, Query, _
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger: Logger
+
+
+class TransientRequestError(XMUORDERException):
+    """
+    临时失败：请求重试后仍为网络错误、5xx、系统繁忙，或接口熔断中，稍后重试可能成功
+    """
+
+
+class ExtJson:
+    """
+    云数据库返回结果解码，结果为 MongoDB Extended JSON 字符串列表
+    解码为python原生类型：$numberInt/$numberLong -> int，$numberDouble/$numberDecimal -> Decimal，
+    $date -> datetime，$oid -> str
+    已安装orjson时使用orjson解析，否则使用json（object_hook在解析时一并解包）
+    """
+
+    @staticmethod
+    def unwrap(obj: dict) -> Any:
+        """
+        解包单个Extended JSON对象，非包装对象原样返回（子对象需已解包）
+        """
+        if len(obj) != 1:
+            return obj
+        key, value = next(iter(obj.items()))
+        if key in ('$numberInt', '$numberLong'):
+            return int(value)
+        if key in ('$numberDouble', '$numberDecimal'):
+            #   由字符串构造，保留精确值（金额计算）
+            return Decimal(value)
+        if key == '$date':
+            if isinstance(value, str):
+                return datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return datetime.fromtimestamp(int(value) / 1000, tz=timezone.utc)
+        if key == '$oid':
+            return value
+        return obj
+
+    @classmethod
+    def __walk(cls, value) -> Any:
+        if isinstance(value, dict):
+            return cls.unwrap({k: cls.__walk(v) for k, v in value.items()})
+        if isinstance(value, list):
+            return [cls.__walk(x) for x in value]
+        return value
+
+    @classmethod
+    def loads(cls, data: str) -> Any:
+        """
+        解码一条结果
+        """
+        if orjson is not None:
+            return cls.__walk(orjson.loads(data))
+        return json.loads(data, object_hook=cls.unwrap)
+
+    @classmethod
+    def loads_page(cls, page: list[str]) -> list:
+        """
+        解码一页结果，拼接为一个json数组后一次解析
+        """
+        if not page:
+            return []
+        return cls.loads('[' + ','.join(page) + ']')
 
 
 class Database:
@@ -171,39 +253,693 @@ class Database:
         return cls.__request(url=url, post_data=post_data)
 
 
+class AsyncDatabase:
+    """
+    异步数据库相关操作封装，接口与Database保持一致
+    所有请求共用一个长期存在的httpx.AsyncClient（keep-alive连接池），不必每次重新建立TCP/TLS连接，也不阻塞事件循环
+    """
+    client: Optional[httpx.AsyncClient] = None
+    #   游标预读：同时进行的分页请求数上限
+    page_concurrency: int = 5
+
+    #   access_token无效或过期的errcode，刷新access_token后重放请求
+    TOKEN_ERRCODES = (40001, 40014, 42001)
+    #   网络错误、5xx、系统繁忙(errcode=-1)时的重试次数及首次重试等待(s)，只对只读请求重试
+    max_retries: int = 2
+    retry_delay: float = 0.2
+    #   云数据库接口熔断器及重试统计
+    breaker: CircuitBreaker = CircuitBreaker('微信云数据库接口')
+    retries: dict = {'token': 0, 'network': 0, 'busy': 0, 'page': 0}
+    #   游标单页临时失败（TransientRequestError）时整页重试的次数及首次重试等待(s)，已读取的页不重新读取
+    page_retries: int = 1
+    page_retry_delay: float = 1
+
+    #   对冲请求：只读请求超过近期耗时的hedge_percentile分位仍未返回时再发一次，先返回的结果生效
+    hedge: bool = False
+    hedge_percentile: float = 95
+    #   额外请求数不超过只读请求总数的比例
+    hedge_budget: float = 0.05
+    #   样本数不足时不对冲，对冲等待时间下限(s)
+    hedge_min_samples: int = 20
+    hedge_min_delay: float = 0.05
+    #   各接口近期耗时(s)
+    __latency: dict = defaultdict(lambda: deque(maxlen=200))
+    hedge_stats: dict = {'requests': 0, 'hedged': 0, 'wins': 0, 'skipped': 0}
+
+    #   导出任务：查询状态间隔(s)及最长等待时间(s)
+    export_poll_interval: float = 2
+    export_timeout: float = 600
+
+    @classmethod
+    def init(cls):
+        """
+        初始化HTTP客户端，需在WeiXin.init之后调用
+        """
+        global logger
+        logger = Logger('微信数据库模块')
+
+        global_setting = GlobalSettings.get()
+        cls.page_concurrency = global_setting.weixin_page_concurrency
+        cls.page_retries = global_setting.weixin_page_retries
+        cls.max_retries = global_setting.weixin_retries
+        cls.breaker = CircuitBreaker('微信云数据库接口', global_setting.weixin_breaker_threshold,
+                                     global_setting.weixin_breaker_recovery)
+        cls.hedge = global_setting.weixin_hedge
+        cls.hedge_percentile = global_setting.weixin_hedge_percentile
+        cls.hedge_budget = global_setting.weixin_hedge_budget
+        cls.export_poll_interval = global_setting.weixin_export_poll_interval
+        cls.export_timeout = global_setting.weixin_export_timeout
+
+        http2 = global_setting.weixin_http2
+        if http2 and importlib.util.find_spec('h2') is None:
+            logger.warning('未安装h2，HTTP/2已关闭')
+            http2 = False
+
+        cls.client = httpx.AsyncClient(
+            base_url='https://api.weixin.qq.com/tcb/',
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=global_setting.weixin_http_max_connections,
+                max_keepalive_connections=global_setting.weixin_http_max_keepalive,
+                keepalive_expiry=global_setting.weixin_http_keepalive_expiry
+            ),
+            timeout=httpx.Timeout(global_setting.weixin_http_timeout,
+                                  connect=global_setting.weixin_http_connect_timeout)
+        )
+
+    @classmethod
+    async def close(cls):
+        if cls.client is not None:
+            await cls.client.aclose()
+            cls.client = None
+
+    @classmethod
+    async def __request(cls, api: str, post_data: dict, idempotent: bool = True) -> dict:
+        """
+        发送请求
+        1. errcode为40001/40014/42001时刷新access_token后重放一次（请求未被执行，写入也可重放）
+        2. 网络错误、5xx、errcode=-1时退避重试，写入请求可能已执行，不重试
+        3. 接口持续异常时熔断，直接失败
+        :param idempotent: 是否为只读请求
+        """
+        token_replayed = False
+        attempt = 0
+        while True:
+            try:
+                cls.breaker.check()
+            except XMUORDERException as e:
+                raise TransientRequestError(e.msg)
+            access_token = await WeiXin.async_get_access_token()
+            try:
+                res = await cls.client.post(api, params={'access_token': access_token}, json=post_data)
+                res_json = res.json() if res.status_code == 200 else {}
+            except (httpx.HTTPError, ValueError) as e:
+                retry_type, error = 'network', e
+            else:
+                errcode = res_json.get('errcode')
+                if res.status_code < 500 and errcode != -1:
+                    cls.breaker.on_success()
+                    if res.status_code != 200:
+                        raise XMUORDERException('requests failed')
+                    if errcode in cls.TOKEN_ERRCODES and not token_replayed:
+                        token_replayed = True
+                        cls.retries['token'] += 1
+                        logger.warning(f'access_token无效(errcode:{errcode})，刷新后重试')
+                        await WeiXin.refresh_access_token(stale=access_token)
+                        continue
+                    if errcode != 0:
+                        raise XMUORDERException(res_json.get('errmsg', 'requests failed'))
+                    return res_json
+                retry_type, error = 'busy', f'status_code:{res.status_code} errcode:{errcode}'
+
+            cls.breaker.on_failure()
+            if not idempotent:
+                raise XMUORDERException(f'requests failed-{error}')
+            if attempt >= cls.max_retries:
+                raise TransientRequestError(f'requests failed-{error}')
+            cls.retries[retry_type] += 1
+            await asyncio.sleep(backoff_delay(attempt, cls.retry_delay))
+            attempt += 1
+
+    @classmethod
+    async def __hedged_request(cls, api: str, post_data: dict) -> dict:
+        """
+        只读请求对冲：等待近期耗时的hedge_percentile分位后仍未返回则再发一次，先成功返回的结果生效，另一个取消
+        额外请求数受hedge_budget限制
+        """
+        latency = cls.__latency[api]
+        cls.hedge_stats['requests'] += 1
+        start = time.perf_counter()
+        if not cls.hedge or len(latency) < cls.hedge_min_samples:
+            res = await cls.__request(api, post_data)
+            latency.append(time.perf_counter() - start)
+            return res
+
+        delay = max(percentile(latency, cls.hedge_percentile), cls.hedge_min_delay)
+        primary = asyncio.ensure_future(cls.__request(api, post_data))
+
+        def record(task: asyncio.Future):
+            #   只记录首次请求自身的耗时：对冲获胜的耗时已被缩短，记录后分位会逐渐下降，越来越多请求被对冲
+            #   首次请求因对冲获胜被取消时，其耗时至少为当前耗时（不低于对冲等待时间）
+            if task.cancelled() or task.exception() is None:
+                latency.append(time.perf_counter() - start)
+
+        primary.add_done_callback(record)
+        tasks = {primary}
+        try:
+            done, _pending = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                if cls.hedge_stats['hedged'] < cls.hedge_budget * cls.hedge_stats['requests']:
+                    cls.hedge_stats['hedged'] += 1
+                    tasks.add(asyncio.ensure_future(cls.__request(api, post_data)))
+                else:
+                    cls.hedge_stats['skipped'] += 1
+            #   第一个成功的结果生效，全部失败则抛出最后一个异常
+            while True:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        if task is not primary:
+                            cls.hedge_stats['wins'] += 1
+                        return task.result()
+                    if not tasks:
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @classmethod
+    async def __operation_request(cls, api: str, collection_name: str, query: str, idempotent: bool = True) -> dict:
+        post_data = {
+            'env': WeiXin.app_env,
+            'query': 'db.collection("{collection_name}").{query}'.format(
+                collection_name=collection_name, query=query.replace('\n', ''))
+        }
+        if idempotent:
+            return await cls.__hedged_request(api, post_data)
+        return await cls.__request(api, post_data, idempotent)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        云数据库接口熔断器状态、重试次数及对冲请求统计
+        """
+        return {
+            'breaker': cls.breaker.stats(),
+            'retries': dict(cls.retries),
+            'hedge': {
+                'enabled': cls.hedge,
+                **cls.hedge_stats,
+                #   各接口当前的对冲等待时间(ms)
+                'delay_ms': {api: round(max(percentile(x, cls.hedge_percentile), cls.hedge_min_delay) * 1000, 2)
+                             for api, x in cls.__latency.items()}
+            }
+        }
+
+    @classmethod
+    async def collection_get(cls, limit: int = 10, offset: int = 0) -> dict:
+        """
+        获取特定云环境下集合信息，同Database.collection_get
+        """
+        return await cls.__request('databasecollectionget', {
+            'env': WeiXin.app_env,
+            'limit': limit,
+            'offset': offset
+        })
+
+    @classmethod
+    async def count(cls, collection_name: str, query: str) -> dict:
+        """
+        微信云开发数据库计数，同Database.count
+        :param collection_name: 集合名称
+        :param query: 查询语句（不包括db.collection(xxx).）
+        """
+        return await cls.__operation_request('databasecount', collection_name, query)
+
+    @classmethod
+    async def query(cls, collection_name: str, query: str) -> dict:
+        """
+        微信云开发数据库查询，同Database.query
+        :param collection_name: 集合名称
+        :param query: 查询语句（不包括db.collection(xxx).）
+        """
+        return await cls.__operation_request('databasequery', collection_name, query)
+
+    @classmethod
+    async def aggregate(cls, collection_name: str, query: str) -> dict:
+        """
+        微信云开发数据库聚合操作，同Database.aggregate
+        :param collection_name: 集合名称
+        :param query: 查询语句（不包括db.collection(xxx).）
+        """
+        return await cls.__operation_request('databaseaggregate', collection_name, query)
+
+    @classmethod
+    async def update(cls, collection_name: str, query: str) -> dict:
+        """
+        微信云开发数据库更新记录，同Database.update
+        :param collection_name: 集合名称
+        :param query: 查询语句（不包括db.collection(xxx).）
+        """
+        return await cls.__operation_request('databaseupdate', collection_name, query, idempotent=False)
+
+    @classmethod
+    async def delete(cls, collection_name: str, query: str) -> dict:
+        """
+        微信云开发数据库删除记录，同Database.delete
+        :param collection_name: 集合名称
+        :param query: 查询语句（不包括db.collection(xxx).）
+        """
+        return await cls.__operation_request('databasedelete', collection_name, query, idempotent=False)
+
+    @classmethod
+    async def add(cls, collection_name: str, query: str) -> dict:
+        """
+        微信云开发数据库插入记录，同Database.add
+        :param collection_name: 集合名称
+        :param query: 查询语句（不包括db.collection(xxx).）
+        """
+        return await cls.__operation_request('databaseadd', collection_name, query, idempotent=False)
+
+    @classmethod
+    async def collection_delete(cls, collection_name: str) -> dict:
+        """
+        微信云开发数据库删除集合，同Database.collection_delete
+        :param collection_name: 集合名称
+        """
+        return await cls.__request('databasecollectiondelete', {
+            'env': WeiXin.app_env,
+            'collection_name': collection_name
+        }, idempotent=False)
+
+    @classmethod
+    async def collection_add(cls, collection_name: str) -> dict:
+        """
+        微信云开发数据库新增集合，同Database.collection_add
+        :param collection_name: 集合名称
+        """
+        return await cls.__request('databasecollectionadd', {
+            'env': WeiXin.app_env,
+            'collection_name': collection_name
+        }, idempotent=False)
+
+    @classmethod
+    async def migrate_export(cls, collection_name: str, query: str, file_path: str, file_type: int = 1) -> str:
+        """
+        微信云开发数据库导出，创建导出任务
+        :param collection_name: 集合名称
+        :param query: 导出条件（不包括db.collection(xxx).），如 where({...}).field({...}).get()
+        :param file_path: 导出文件在云存储中的路径
+        :param file_type: 1: JSON(每行一条记录); 2: CSV
+        :return: 导出任务job_id
+        """
+        res = await cls.__request('databasemigrateexport', {
+            'env': WeiXin.app_env,
+            'file_path': file_path,
+            'file_type': file_type,
+            'query': 'db.collection("{collection_name}").{query}'.format(
+                collection_name=collection_name, query=query.replace('\n', ''))
+        }, idempotent=False)
+        return res['job_id']
+
+    @classmethod
+    async def migrate_query_info(cls, job_id: int) -> dict:
+        """
+        微信云开发数据库迁移(导入/导出)任务状态查询
+        :param job_id: 任务id
+        :return: status(waiting/reading/writing/success/fail)、record_success、record_fail、err_msg、file_url
+        """
+        return await cls.__request('databasemigratequeryinfo', {
+            'env': WeiXin.app_env,
+            'job_id': job_id
+        })
+
+    @classmethod
+    async def export(cls, collection_name: str, query: str, file_path: str = None) -> str:
+        """
+        创建导出任务并等待完成
+        :param collection_name: 集合名称
+        :param query: 导出条件（不包括db.collection(xxx).）
+        :param file_path: 导出文件路径，默认为 export/{集合名称}_{时间}.json
+        :return: 导出文件下载地址
+        """
+        if file_path is None:
+            file_path = f'export/{collection_name}_{datetime.now().strftime("%Y%m%d%H%M%S")}.json'
+        job_id = await cls.migrate_export(collection_name, query, file_path)
+        logger.info(f'导出任务已创建 job_id:{job_id} -{collection_name}')
+
+        deadline = time.monotonic() + cls.export_timeout
+        while True:
+            info = await cls.migrate_query_info(job_id)
+            status = info.get('status')
+            if status == 'success':
+                logger.info(f'导出任务已完成 job_id:{job_id} -共{info.get("record_success")}条')
+                return info['file_url']
+            if status == 'fail':
+                raise XMUORDERException(f'导出任务失败 job_id:{job_id}-{info.get("err_msg")}')
+            if time.monotonic() >= deadline:
+                raise XMUORDERException(f'导出任务超时 job_id:{job_id} status:{status}')
+            await asyncio.sleep(cls.export_poll_interval)
+
+    @classmethod
+    async def download_lines(cls, url: str) -> AsyncIterator[str]:
+        """
+        流式下载导出文件，逐行返回（跳过空行），内存占用与文件大小无关
+        :param url: 导出文件下载地址
+        """
+        async with cls.client.stream('GET', url) as res:
+            if res.status_code != 200:
+                raise XMUORDERException(f'下载导出文件失败 status_code:{res.status_code}')
+            async for line in res.aiter_lines():
+                #   部分httpx版本返回的行包含换行符
+                line = line.rstrip('\r\n')
+                if line.strip():
+                    yield line
+
+    @classmethod
+    async def fetch_page(cls, collection_name: str, query: str, method: str = 'aggregate') -> list[str]:
+        """
+        获取一页数据；网络错误、5xx、系统繁忙等临时失败已在请求中退避重试，仍失败时抛出TransientRequestError，由游标整页重试
+        :param collection_name: 集合名称
+        :param query: 完整的分页查询语句
+        :param method: aggregate 或 query
+        :return: 该页data
+        """
+        fetch = {'aggregate': cls.aggregate, 'query': cls.query}[method]
+        try:
+            return (await fetch(collection_name, query))['data']
+        except TransientRequestError as e:
+            raise TransientRequestError(f'分页获取失败-{e.msg}')
+        except Exception as e:
+            raise XMUORDERException(f'分页获取失败-{e}')
+
+    @classmethod
+    def cursor(cls, collection_name: str, query: str, page_size: int = 25, method: str = 'aggregate') -> 'Cursor':
+        """
+        获取游标，async for 逐条读取，无需count()
+        :param collection_name: 集合名称
+        :param query: 查询语句，不包括分页及结尾的 .end()/.get()
+        :param page_size: 每页数量
+        :param method: aggregate 或 query
+        """
+        return Cursor(collection_name, query, page_size, method, prefetch=cls.page_concurrency,
+                      retries=cls.page_retries)
+
+
+class Cursor:
+    """
+    云数据库游标，async for 逐条返回解码后的记录(ExtJson)，读取到不满一页即结束，无需先count()
+    预读窗口从1页开始，每读到一整页翻倍，不超过prefetch页：结果少时只请求一次，结果多时多页并发
+    内存中最多保留窗口内的页，不随记录总数增长
+    单页临时失败时只重试该页，已读取的页不重新读取
+    """
+
+    def __init__(self, collection_name: str, query: str, page_size: int = 25, method: str = 'aggregate',
+                 prefetch: int = 5, retries: int = 1):
+        """
+        :param collection_name: 集合名称
+        :param query: 查询语句，不包括分页及结尾的 .end()/.get()
+        :param page_size: 每页数量
+        :param method: aggregate 或 query
+        :param prefetch: 最多同时预读的页数
+        :param retries: 单页临时失败(TransientRequestError)时整页重试的次数
+        """
+        self.collection_name = collection_name
+        self.query = query.strip()
+        self.page_size = page_size
+        self.method = method
+        self.prefetch = max(1, prefetch)
+        self.retries = retries
+
+    def __page_query(self, skip: int) -> str:
+        end = '.end()' if self.method == 'aggregate' else '.get()'
+        return f'{self.query}.skip({skip}).limit({self.page_size}){end}'
+
+    async def __fetch(self, skip: int) -> list[str]:
+        """
+        获取一页，临时失败时退避后重试该页；errcode错误等不会因重试而成功，直接抛出
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return await AsyncDatabase.fetch_page(self.collection_name, self.__page_query(skip), self.method)
+            except TransientRequestError as e:
+                if attempt == self.retries:
+                    raise
+                AsyncDatabase.retries['page'] += 1
+                logger.warning(f'分页获取失败，重试第{attempt + 1}次 -{self.collection_name} skip:{skip}-{e.msg}')
+                await asyncio.sleep(backoff_delay(attempt, AsyncDatabase.page_retry_delay))
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self.__iterate()
+
+    async def __iterate(self) -> AsyncIterator[Any]:
+        pending: deque[asyncio.Future] = deque()
+        skip = 0
+        window = 1
+        try:
+            while True:
+                while len(pending) < window:
+                    pending.append(asyncio.ensure_future(self.__fetch(skip)))
+                    skip += self.page_size
+                data = await pending.popleft()
+                for record in ExtJson.loads_page(data):
+                    yield record
+                if len(data) < self.page_size:
+                    break
+                window = min(window * 2, self.prefetch)
+        finally:
+            #   已读到末尾或提前退出，取消多余的预读
+            for task in pending:
+                task.cancel()
+
+
+class BatchLoader:
+    """
+    按键查询合并：max_wait_ms内到达的查询合并为一次 where({key: _.in([...])}) 查询，各调用方取回各自的记录
+    一批最多max_batch个键，达到上限立即发出
+    """
+
+    def __init__(self, collection_name: str, key_field: str, fields: tuple[str, ...] = (),
+                 max_batch: int = 20, max_wait_ms: float = 5):
+        """
+        :param collection_name: 集合名称
+        :param key_field: 查询的键字段，如 orderInfo.outTradeNo
+        :param fields: 只返回的字段，为空则返回全部字段
+        :param max_batch: 一批最多合并的键数
+        :param max_wait_ms: 第一个键到达后最多等待的时间(ms)
+        """
+        self.collection_name = collection_name
+        self.key_field = key_field
+        self.fields = fields
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.__pending: dict[str, list[asyncio.Future]] = {}
+        self.__timer: Optional[asyncio.TimerHandle] = None
+        #   进行中的批次，保留引用避免任务在执行中被垃圾回收
+        self.__running: set[asyncio.Task] = set()
+        #   统计：调用次数、实际请求次数
+        self.__loads = 0
+        self.__batches = 0
+
+    async def load(self, key: str) -> Optional[dict]:
+        """
+        查询一条记录
+        :param key: 键值
+        :return: 解码后的记录，不存在则返回None
+        """
+        self.__loads += 1
+        future = asyncio.get_running_loop().create_future()
+        self.__pending.setdefault(key, []).append(future)
+        if len(self.__pending) >= self.max_batch:
+            self.__flush()
+        elif self.__timer is None:
+            self.__timer = asyncio.get_running_loop().call_later(self.max_wait_ms / 1000, self.__flush)
+        return await future
+
+    def __flush(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if not self.__pending:
+            return
+        pending, self.__pending = self.__pending, {}
+        self.__batches += 1
+        task = asyncio.ensure_future(self.__run(pending))
+        self.__running.add(task)
+        task.add_done_callback(self.__running.discard)
+
+    def __key_of(self, record: dict):
+        for name in self.key_field.split('.'):
+            if not isinstance(record, dict):
+                return None
+            record = record.get(name)
+        return record
+
+    async def __run(self, pending: dict[str, list[asyncio.Future]]):
+        keys = list(pending)
+        query = Query().where({self.key_field: _.in_(keys)})
+        if self.fields:
+            query.field(self.key_field, *self.fields)
+        try:
+            res = await AsyncDatabase.query(self.collection_name, query.limit(len(keys)).get())
+            records = {self.__key_of(x): x for x in ExtJson.loads_page(res['data'])}
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for key, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(records.get(key))
+
+    def stats(self) -> dict:
+        return {
+            'loads': self.__loads,
+            'batches': self.__batches,
+            'pending': len(self.__pending),
+            'running': len(self.__running)
+        }
+
+
+class BulkIngest:
+    """
+    批量导入：创建云数据库导出任务 -> 流式下载JSON文件 -> 逐行解码 -> mysql大批量写入
+    回填大量历史记录时使用，代替逐页aggregate（每页最多100条，需上千次请求）
+    写入在线程中执行，与下一批的下载解析并行，同时最多一批在写入
+    """
+
+    @staticmethod
+    def __write(sql: str, rows: list[dict]) -> None:
+        with Mysql.connect() as conn:
+            Mysql.execute_many(conn, sql, rows)
+            conn.commit()
+
+    @classmethod
+    async def ingest(cls, collection_name: str, query: str, sql: str, to_row: Callable[[Any], Optional[dict]],
+                     batch_size: int = 2000, file_path: str = None) -> dict:
+        """
+        导出并写入mysql
+        :param collection_name: 集合名称
+        :param query: 导出条件（不包括db.collection(xxx).），如 where({...}).field({...}).get()
+        :param sql: 写入语句，使用 %(列名)s 占位，建议为幂等的 insert ... ON DUPLICATE KEY UPDATE
+        :param to_row: 解码后的记录 -> sql参数字典，返回None则跳过该记录
+        :param batch_size: 每批写入行数，每批单独提交
+        :param file_path: 导出文件路径
+        :return: {'scanned': 读取数, 'written': 写入数, 'skipped': 跳过数}
+        """
+        url = await AsyncDatabase.export(collection_name, query, file_path)
+
+        scanned = written = skipped = 0
+        batch = []
+        writing: Optional[asyncio.Future] = None
+        try:
+            async for line in AsyncDatabase.download_lines(url):
+                scanned += 1
+                row = to_row(ExtJson.loads(line))
+                if row is None:
+                    skipped += 1
+                    continue
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    if writing is not None:
+                        await writing
+                    writing = asyncio.ensure_future(asyncio.to_thread(cls.__write, sql, batch))
+                    written += len(batch)
+                    batch = []
+            if writing is not None:
+                await writing
+                writing = None
+            if batch:
+                await asyncio.to_thread(cls.__write, sql, batch)
+                written += len(batch)
+        finally:
+            #   异常时等待已开始的写入结束，避免线程中的写入与调用方后续操作交错
+            if writing is not None:
+                await asyncio.gather(writing, return_exceptions=True)
+        return {'scanned': scanned, 'written': written, 'skipped': skipped}
+
+
+class SyncCheckpoint:
+    """
+    云数据库同步检查点（sync_checkpoint表），记录各同步任务的高水位
+    """
+
+    @staticmethod
+    def get(conn, name: str) -> Optional[str]:
+        res = Mysql.execute_fetchone(conn, 'select mark from sync_checkpoint where name = %(name)s;', name=name)
+        return None if res is None else res[0]
+
+    @staticmethod
+    def set(conn, name: str, mark: str) -> None:
+        Mysql.execute_only(conn, '''
+        insert into sync_checkpoint (name, mark) values (%(name)s, %(mark)s)
+        ON DUPLICATE KEY UPDATE mark=values(mark);
+        ''', name=name, mark=mark)
+
+
 class UpdateDataBase:
+    #   删除只限于同步写入（syncHash不为null）且没有绑定手机号、打印机的餐厅
+    CANTEEN_DELETE_SQL = '''
+    delete from canteen
+    where cID in %(cid_list)s and syncHash is not null
+        and not exists (select 1 from phone p where p.cID = canteen.cID)
+        and not exists (select 1 from printer pr where pr.cID = canteen.cID);
+    '''
+
     @staticmethod
-    def update_canteen_table():
-        #   分页
-        total_count = Database.count('canteen', 'count()')['count']
-        page_size = 25
-        total_page = int((total_count - 1) / page_size + 1)
+    def canteen_hash(name: str) -> str:
+        """
+        canteen记录的内容摘要，同步写入时记录在syncHash列
+        """
+        return hashlib.md5(name.encode('utf-8')).hexdigest()
 
+    @staticmethod
+    async def update_canteen_table() -> dict:
+        """
+        增量同步canteen表：按cID比较云数据库记录的内容摘要与mysql中上次同步写入的摘要(syncHash)，只写入新增、修改及删除的行
+        云数据库canteen集合没有更新时间字段，只能读取全部记录（仅cID、name两个字段）；mysql只读取cID及摘要，不读取其他列
+        本地名称被bindCanteen改写时摘要置为''，下次同步恢复为云数据库中的名称
+        :return: 读取及写入行数 {'scanned', 'inserted', 'updated', 'deleted'}
+        """
         #   构建查询语句
-        query = '''
-         aggregate()
-         %%skip_limit_words%%
-         .replaceRoot({newRoot: {cID: '$cID',name:'$name'}}).end()
-         '''
-
-        #   查询
-        out = []
-        for page_num in range(total_page):
-            new_query = query.replace('%%skip_limit_words%%', f'.skip({page_num * page_size}).limit({page_size})')
-            res = Database.aggregate('canteen', new_query)
-            out += res['data']
-
-        #   用cur.executemany()
-        params = [json.loads(x) for x in out]
-        #   executemany的ON DUPLICATE KEY UPDATE后必须用values(name)来代替%(name)s
-        sql = '''
-         insert into canteen (cID, name)
-             VALUES (%(cID)s, %(name)s)
-         ON DUPLICATE KEY UPDATE
-         name=values(name);
-         '''
+        query = Aggregate().replace_root({'cID': '$cID', 'name': '$name'}).build()
+
+        #   游标分页查询
+        cloud = {x['cID']: x['name'] async for x in AsyncDatabase.cursor('canteen', query)}
+
+        #   同步写入放到线程中执行
+        return await asyncio.to_thread(UpdateDataBase.__sync_canteen, cloud)
 
+    @staticmethod
+    def __sync_canteen(cloud: dict[str, str]) -> dict:
+        report = {'scanned': len(cloud), 'inserted': 0, 'updated': 0, 'deleted': 0}
         with Mysql.connect() as conn:
-            cur = Mysql.get_cursor(conn)
-            cur.executemany(sql, params)
+            local = dict(Mysql.execute_fetchall(conn, 'select cID, syncHash from canteen;'))
+            inserts, updates = [], []
+            for cid, name in cloud.items():
+                row = {'cID': cid, 'name': name, 'syncHash': UpdateDataBase.canteen_hash(name)}
+                if cid not in local:
+                    inserts.append(row)
+                elif local[cid] != row['syncHash']:
+                    updates.append(row)
+            #   云数据库读取为空时视为异常，不删除
+            deletes = [k for k, v in local.items() if k not in cloud and v is not None] if cloud else []
+
+            #   读取后可能被bind_canteen_sms插入，使用upsert避免主键冲突导致整个同步失败
+            Mysql.execute_many(conn, '''
+            insert into canteen (cID, name, syncHash) VALUES (%(cID)s, %(name)s, %(syncHash)s)
+            ON DUPLICATE KEY UPDATE name=values(name), syncHash=values(syncHash);
+            ''', inserts)
+            Mysql.execute_many(conn, '''
+            update canteen set name = %(name)s, syncHash = %(syncHash)s where cID = %(cID)s;
+            ''', updates)
+            deleted = 0
+            if deletes:
+                deleted = Mysql.execute_only(conn, UpdateDataBase.CANTEEN_DELETE_SQL, cid_list=tuple(deletes))
             conn.commit()
+
+        report.update(inserted=len(inserts), updated=len(updates), deleted=deleted)
+        return report
@@ -0,0 +1,498 @@
+"""
+云数据库集合镜像
+按游标字段增量读取云数据库集合，幂等写入(upsert)本地mysql表，同步进度(检查点)记录在sync_checkpoint表
+统计、订单查询可选择读取本地镜像，减少对微信接口的请求
+"""
+import asyncio
+import json
+import time
+from contextlib import aclosing
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Optional, AsyncIterator, Any
+
+from ..config import GlobalSettings
+from ..database import Mysql, AsyncMysql
+from ..logger import Logger
+from .database import AsyncDatabase, SyncCheckpoint, BulkIngest, ExtJson
+from .query import Aggregate, Query, _
+
+logger: Logger
+
+
+def _json_default(value):
+    #   Decimal写为数值，读取时用 parse_float=Decimal 还原
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def load_json(data: Optional[str]) -> Any:
+    """
+    读取镜像表中的json列，小数还原为Decimal
+    """
+    return None if data is None else json.loads(data, parse_float=Decimal)
+
+
+class Mirror:
+    """
+    云数据库集合到mysql表的镜像
+    1. 按cursor_field升序增量读取，检查点为已写入记录中cursor_field的最大值
+    2. 每次从检查点往前回溯lookback秒，重新读取这段时间内状态可能变化的记录
+    3. 以key_column为主键upsert，重复读取同一记录不会产生重复数据
+    4. 游标字段之后才变化的记录（如配送完成），通过refresh_keys按主键重新读取
+    5. 镜像覆盖范围的下界（mirror:{name}:from）及上次成功同步时间（mirror:{name}:synced）同样记录在sync_checkpoint表，
+       不运行同步任务的进程也能判断镜像是否可用
+    """
+
+    def __init__(self, name: str, collection_name: str, table: str, key_column: str, cursor_field: str,
+                 columns: dict[str, str], json_columns: tuple[str, ...] = (), cursor_format: str = None,
+                 lookback: int = 0, page_size: int = 100, batch_size: int = 500, state_ttl: float = 10):
+        """
+        :param name: 镜像名称，检查点名称为 mirror:{name}
+        :param collection_name: 云数据库集合名称
+        :param table: mysql表名
+        :param key_column: 主键列
+        :param cursor_field: 增量读取的游标字段（云数据库字段路径）
+        :param columns: {mysql列名: 云数据库字段路径}
+        :param json_columns: 以json格式存储的列
+        :param cursor_format: 游标字段的时间格式，用于计算回溯，为None则不回溯
+        :param lookback: 回溯秒数
+        :param page_size: 云数据库每页读取数量
+        :param batch_size: mysql每批写入行数，每批写入后保存检查点
+        :param state_ttl: 覆盖范围下界及上次同步时间的本地缓存时间(s)
+        """
+        self.name = name
+        self.collection_name = collection_name
+        self.table = table
+        self.key_column = key_column
+        self.cursor_field = cursor_field
+        self.columns = columns
+        self.json_columns = json_columns
+        self.cursor_format = cursor_format
+        self.lookback = lookback
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.state_ttl = state_ttl
+        #   游标字段对应的mysql列，用于推算旧版本（未记录下界）镜像的下界
+        self.cursor_column = next((x for x, path in columns.items() if path == cursor_field), None)
+
+        names = list(columns)
+        self.__upsert_sql = 'insert into `{table}` ({columns}) values ({values}) ON DUPLICATE KEY UPDATE {updates};'.format(
+            table=table,
+            columns=', '.join(f'`{x}`' for x in names),
+            values=', '.join(f'%({x})s' for x in names),
+            updates=', '.join(f'`{x}`=values(`{x}`)' for x in names if x != key_column))
+
+        #   覆盖范围下界（''表示从第一条记录开始）及上次成功同步开始时间，从sync_checkpoint表读取后缓存state_ttl秒
+        self.__from: Optional[str] = None
+        self.__last_sync: Optional[datetime] = None
+        self.__state_time: Optional[float] = None
+
+        #   统计
+        self.__checkpoint: Optional[str] = None
+        self.__last_report: dict = {}
+        self.__last_error: Optional[str] = None
+        self.__last_refresh: dict = {}
+
+    @property
+    def checkpoint_name(self) -> str:
+        return f'mirror:{self.name}'
+
+    @property
+    def from_checkpoint_name(self) -> str:
+        return f'mirror:{self.name}:from'
+
+    @property
+    def synced_checkpoint_name(self) -> str:
+        return f'mirror:{self.name}:synced'
+
+    @staticmethod
+    def __get(record: dict, path: str):
+        for name in path.split('.'):
+            if not isinstance(record, dict):
+                return None
+            record = record.get(name)
+        return record
+
+    def __row(self, record: dict) -> dict:
+        row = {}
+        for column, path in self.columns.items():
+            value = self.__get(record, path)
+            if column in self.json_columns:
+                value = None if value is None else json.dumps(value, ensure_ascii=False, default=_json_default)
+            elif isinstance(value, (dict, list)):
+                value = json.dumps(value, ensure_ascii=False, default=_json_default)
+            row[column] = value
+        return row
+
+    def __since(self, mark: Optional[str]) -> Optional[str]:
+        if mark is None or not self.cursor_format or not self.lookback:
+            return mark
+        try:
+            return (datetime.strptime(mark, self.cursor_format) - timedelta(seconds=self.lookback)).strftime(
+                self.cursor_format)
+        except ValueError:
+            return mark
+
+    def __query(self, since: Optional[str]) -> str:
+        query = Aggregate()
+        if since is not None:
+            query.match({self.cursor_field: _.gte(since)})
+        #   游标字段不唯一，以主键作为第二排序字段，保证分页(skip/limit)顺序稳定，不会在页边界漏读或重复读取
+        return query.sort({self.cursor_field: 1, self.columns[self.key_column]: 1}).project(
+            *self.columns.values(), _id=0).build()
+
+    def __load_checkpoint(self) -> Optional[str]:
+        with Mysql.connect() as conn:
+            return SyncCheckpoint.get(conn, self.checkpoint_name)
+
+    def __lower(self, conn) -> Optional[str]:
+        """
+        覆盖范围下界，None表示尚未同步
+        记录下界之前已开始同步：取镜像表中游标字段的最小值（偏晚但不会少算）并写入
+        """
+        lower = SyncCheckpoint.get(conn, self.from_checkpoint_name)
+        if lower is not None or self.cursor_column is None or \
+                SyncCheckpoint.get(conn, self.checkpoint_name) is None:
+            return lower
+        res = Mysql.execute_fetchone(conn, f'select min(`{self.cursor_column}`) from `{self.table}`;')
+        if res is None or res[0] is None:
+            return None
+        SyncCheckpoint.set(conn, self.from_checkpoint_name, res[0])
+        conn.commit()
+        return res[0]
+
+    def __load_state(self) -> tuple[Optional[str], Optional[datetime]]:
+        with Mysql.connect() as conn:
+            lower = self.__lower(conn)
+            synced = SyncCheckpoint.get(conn, self.synced_checkpoint_name)
+        return lower, None if synced is None else datetime.strptime(synced, '%Y-%m-%d %H:%M:%S')
+
+    async def __state(self) -> tuple[Optional[str], Optional[datetime]]:
+        """
+        (覆盖范围下界, 上次成功同步开始时间)，缓存state_ttl秒
+        """
+        if self.__state_time is None or time.monotonic() - self.__state_time > self.state_ttl:
+            self.__from, self.__last_sync = await asyncio.to_thread(self.__load_state)
+            self.__state_time = time.monotonic()
+        return self.__from, self.__last_sync
+
+    def __save(self, rows: list[dict], mark: Optional[str], lower: Optional[str] = None,
+               synced: Optional[datetime] = None) -> None:
+        with Mysql.connect() as conn:
+            Mysql.execute_many(conn, self.__upsert_sql, rows)
+            if mark is not None:
+                SyncCheckpoint.set(conn, self.checkpoint_name, mark)
+            if lower is not None:
+                SyncCheckpoint.set(conn, self.from_checkpoint_name, lower)
+            if synced is not None:
+                SyncCheckpoint.set(conn, self.synced_checkpoint_name, synced.strftime('%Y-%m-%d %H:%M:%S'))
+            conn.commit()
+        self.__checkpoint = mark
+        if lower is not None:
+            self.__from = lower
+
+    async def sync(self) -> dict:
+        """
+        增量同步一次
+        :return: {'since': 本次起点, 'checkpoint': 新检查点, 'scanned': 读取数, 'upserted': 写入数}
+        """
+        started = datetime.now()
+        try:
+            mark = await asyncio.to_thread(self.__load_checkpoint)
+            since = self.__since(mark)
+            #   首次同步从第一条记录开始读取，覆盖范围下界为''（全部记录）
+            lower = '' if since is None else None
+            scanned = upserted = 0
+            batch = []
+            async for record in AsyncDatabase.cursor(self.collection_name, self.__query(since),
+                                                     page_size=self.page_size):
+                scanned += 1
+                row = self.__row(record)
+                #   缺少主键的记录无法幂等写入，跳过
+                if row[self.key_column] is None:
+                    continue
+                batch.append(row)
+                value = self.__get(record, self.cursor_field)
+                if value is not None and (mark is None or value > mark):
+                    mark = value
+                #   按游标字段升序读取，每批写入后保存检查点，中断后从检查点继续
+                if len(batch) >= self.batch_size:
+                    await asyncio.to_thread(self.__save, batch, mark, lower)
+                    upserted += len(batch)
+                    batch = []
+            #   本次同步开始之前的云端数据均已写入镜像，与最后一批数据一起提交
+            await asyncio.to_thread(self.__save, batch, mark, lower, started)
+            upserted += len(batch)
+        except Exception as e:
+            self.__last_error = f'{started.strftime("%Y-%m-%d %H:%M:%S")} {e}'
+            raise
+
+        self.__last_sync = started
+        self.__state_time = time.monotonic()
+        self.__last_error = None
+        self.__last_report = {'since': since, 'checkpoint': mark, 'scanned': scanned, 'upserted': upserted}
+        return self.__last_report
+
+    def __advance(self, mark: str, since: Optional[str]) -> str:
+        """
+        回填[since, mark]后前移检查点并更新覆盖范围下界
+        回填起点晚于原检查点时，原检查点与起点之间的记录未写入，下界只能取回填起点
+        """
+        begin = '' if since is None else since
+        with Mysql.connect() as conn:
+            lower = self.__lower(conn)
+            current = SyncCheckpoint.get(conn, self.checkpoint_name)
+            if lower is not None and current is not None and begin <= current:
+                lower = min(lower, begin)
+            else:
+                lower = begin
+            if current is None or mark > current:
+                SyncCheckpoint.set(conn, self.checkpoint_name, mark)
+                current = mark
+            SyncCheckpoint.set(conn, self.from_checkpoint_name, lower)
+            conn.commit()
+        self.__checkpoint = current
+        self.__from = lower
+        return current
+
+    async def backfill(self, since: Optional[str] = None, batch_size: int = 2000) -> dict:
+        """
+        通过云数据库导出任务批量回填（首次同步、大量历史记录），写入后检查点前移到已写入记录游标字段的最大值
+        :param since: 游标字段起点，为None则回填全部记录
+        :param batch_size: mysql每批写入行数
+        :return: {'scanned': 读取数, 'written': 写入数, 'skipped': 跳过数, 'checkpoint': 检查点, 'from': 覆盖范围下界}
+        """
+        query = Query()
+        if since is not None:
+            query.where({self.cursor_field: _.gte(since)})
+        query.field(*self.columns.values())
+
+        mark = None
+
+        def to_row(record: dict) -> Optional[dict]:
+            nonlocal mark
+            row = self.__row(record)
+            if row[self.key_column] is None:
+                return None
+            value = self.__get(record, self.cursor_field)
+            if value is not None and (mark is None or value > mark):
+                mark = value
+            return row
+
+        report = await BulkIngest.ingest(self.collection_name, query.get(), self.__upsert_sql, to_row,
+                                         batch_size=batch_size)
+        report['checkpoint'] = None if mark is None else await asyncio.to_thread(self.__advance, mark, since)
+        report['from'] = self.__from
+        return report
+
+    def __upsert(self, rows: list[dict]) -> None:
+        with Mysql.connect() as conn:
+            Mysql.execute_many(conn, self.__upsert_sql, rows)
+            conn.commit()
+
+    async def refresh_keys(self, keys: list[str], chunk_size: int = 100) -> dict:
+        """
+        按主键从云数据库重新读取记录并写入（不改变检查点），用于更新游标字段之后状态仍会变化的记录
+        :param keys: 主键列表
+        :param chunk_size: 每次查询的主键数
+        :return: {'keys': 主键数, 'found': 云端读取到的记录数}
+        """
+        key_path = self.columns[self.key_column]
+        found = 0
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            query = Query().where({key_path: _.in_(chunk)}).field(*self.columns.values()).limit(len(chunk))
+            res = await AsyncDatabase.query(self.collection_name, query.get())
+            rows = [row for row in map(self.__row, ExtJson.loads_page(res['data']))
+                    if row[self.key_column] is not None]
+            await asyncio.to_thread(self.__upsert, rows)
+            found += len(rows)
+        self.__last_refresh = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'keys': len(keys),
+                               'found': found}
+        return {'keys': len(keys), 'found': found}
+
+    async def lag(self) -> Optional[float]:
+        """
+        镜像延迟(s)：距上次成功同步（任一进程）开始的时间，此前的云端数据均已写入镜像；从未同步则为None
+        """
+        _, last_sync = await self.__state()
+        if last_sync is None:
+            return None
+        return (datetime.now() - last_sync).total_seconds()
+
+    async def covers(self, begin: str) -> bool:
+        """
+        游标字段不早于begin的记录是否均已写入镜像（begin不早于覆盖范围下界）
+        """
+        lower, _ = await self.__state()
+        return lower is not None and begin >= lower
+
+    async def stats(self) -> dict:
+        lag = await self.lag()
+        return {
+            'name': self.name,
+            'checkpoint': self.__checkpoint,
+            'from': self.__from,
+            'last_sync': None if self.__last_sync is None else self.__last_sync.strftime('%Y-%m-%d %H:%M:%S'),
+            'lag_seconds': lag,
+            'last_report': self.__last_report,
+            'last_refresh': self.__last_refresh,
+            'last_error': self.__last_error
+        }
+
+
+class OrderMirror:
+    """
+    orders集合镜像（order_mirror表），只同步统计及打印需要的字段
+    """
+    mirror: Mirror
+    #   统计、订单查询是否读取镜像
+    read: bool = False
+    #   镜像延迟超过该值(s)时不读取镜像，直接请求云数据库
+    max_lag: float = 600
+    #   对账：重新读取confirmTime在最近reconcile_days天内、尚未完成的订单
+    reconcile_days: int = 3
+
+    COLUMNS = {
+        'outTradeNo': 'orderInfo.outTradeNo',
+        'cID': 'goodsInfo.shopInfo.cID',
+        'shopName': 'goodsInfo.shopInfo.name',
+        'orderState': 'orderInfo.orderState',
+        'tradeState': 'payInfo.tradeState',
+        'confirmTime': 'orderInfo.timeInfo.confirmTime',
+        'isDelivery': 'deliverInfo.isDelivery',
+        'isDelivered': 'deliverInfo.isDelivered',
+        'riderId': 'deliverInfo.id',
+        'deliverFee': 'payInfo.feeInfo.deliverFee',
+        'userName': 'userInfo.name',
+        'userPhone': 'userInfo.phone',
+        'place': 'getFoodInfo.place',
+        'record': 'goodsInfo.record',
+    }
+
+    @classmethod
+    def init(cls):
+        global logger
+        logger = Logger('订单镜像模块')
+
+        global_setting = GlobalSettings.get()
+        cls.read = global_setting.orders_mirror_read
+        cls.max_lag = global_setting.orders_mirror_max_lag
+        cls.reconcile_days = global_setting.orders_mirror_reconcile_days
+        cls.mirror = Mirror(
+            name='orders', collection_name='orders', table='order_mirror', key_column='outTradeNo',
+            cursor_field='orderInfo.timeInfo.confirmTime', columns=cls.COLUMNS, json_columns=('record',),
+            cursor_format='%Y%m%d%H%M%S', lookback=global_setting.orders_mirror_lookback
+        )
+
+    @classmethod
+    async def sync(cls) -> dict:
+        return await cls.mirror.sync()
+
+    @staticmethod
+    def __unfinished(since: str) -> list[str]:
+        sql = '''
+        select outTradeNo from order_mirror
+        where confirmTime >= %(since)s
+            and (orderState is null or orderState <> 'SUCCESS' or tradeState is null or tradeState <> 'SUCCESS'
+                or (isDelivery = 1 and (isDelivered is null or isDelivered = 0)));
+        '''
+        with Mysql.connect() as conn:
+            return [x[0] for x in Mysql.execute_fetchall(conn, sql, since=since)]
+
+    @classmethod
+    async def reconcile(cls) -> dict:
+        """
+        对账：配送完成、支付状态等在确认订单很久之后才变化，增量同步的回溯窗口无法覆盖
+        重新读取最近reconcile_days天内尚未完成（未成功或外卖未送达）的订单
+        """
+        since = (datetime.now() - timedelta(days=cls.reconcile_days)).strftime('%Y%m%d%H%M%S')
+        keys = await asyncio.to_thread(cls.__unfinished, since)
+        return await cls.mirror.refresh_keys(keys)
+
+    @classmethod
+    async def backfill(cls, begin_date: str = None) -> dict:
+        """
+        批量回填订单镜像
+        :param begin_date: 起始日期(如20220401)，为None则回填全部订单
+        """
+        return await cls.mirror.backfill(None if begin_date is None else begin_date + '000000')
+
+    @classmethod
+    async def usable(cls, begin_time: str = None) -> bool:
+        """
+        是否读取镜像：已开启、镜像延迟不超过max_lag，且查询范围的起点不早于镜像覆盖范围的下界
+        :param begin_time: 查询的confirmTime起点(如202204010000)，为None则不检查（如按outTradeNo查询，镜像中没有时再请求云数据库）
+        """
+        if not cls.read:
+            return False
+        lag = await cls.mirror.lag()
+        if lag is None or lag > cls.max_lag:
+            return False
+        #   confirmTime为14位(%Y%m%d%H%M%S)，补齐后再比较
+        return begin_time is None or await cls.mirror.covers(begin_time.ljust(14, '0'))
+
+    @staticmethod
+    async def shop_records(cid: str, begin_time: str, end_time: str) -> AsyncIterator[dict]:
+        """
+        商家统计订单的商品记录，格式与云数据库查询结果一致 {'record': [...]}
+        遍历结束前占用数据库连接，提前退出遍历时需配合contextlib.aclosing使用，保证立即关闭游标并归还连接
+        """
+        sql = '''
+        select record from order_mirror
+        where cID = %(cid)s and confirmTime between %(begin)s and %(end)s
+            and orderState = 'SUCCESS' and tradeState = 'SUCCESS';
+        '''
+        conn = await AsyncMysql.connect()
+        async with conn:
+            async with aclosing(AsyncMysql.execute_stream(conn, sql, cid=cid, begin=begin_time,
+                                                          end=end_time)) as chunks:
+                async for chunk in chunks:
+                    for row in chunk:
+                        yield {'record': load_json(row[0]) or []}
+
+    @staticmethod
+    async def rider_groups(rider_id: str, begin_time: str, end_time: str) -> list[dict]:
+        """
+        骑手配送统计，格式与云数据库聚合结果一致 [{'_id': 商店名, 'totalFee': 配送费, 'count': 单数}]
+        """
+        sql = '''
+        select shopName, coalesce(sum(deliverFee), 0), count(*) from order_mirror
+        where riderId = %(rider_id)s and confirmTime between %(begin)s and %(end)s
+            and orderState = 'SUCCESS' and isDelivered = 1
+        group by shopName;
+        '''
+        conn = await AsyncMysql.connect()
+        async with conn:
+            res = await AsyncMysql.execute_fetchall(conn, sql, rider_id=rider_id, begin=begin_time, end=end_time)
+        return [{'_id': x[0], 'totalFee': x[1], 'count': x[2]} for x in res]
+
+    @staticmethod
+    async def get_order(out_trade_no: str) -> Optional[dict]:
+        """
+        按outTradeNo读取订单，格式与云数据库查询结果一致（只包含镜像的字段），不存在则返回None
+        """
+        sql = f'''
+        select {', '.join(f'`{x}`' for x in OrderMirror.COLUMNS)} from order_mirror
+        where outTradeNo = %(out_trade_no)s;
+        '''
+        conn = await AsyncMysql.connect()
+        async with conn:
+            res = await AsyncMysql.execute_fetchone(conn, sql, out_trade_no=out_trade_no)
+        if res is None:
+            return None
+
+        order = {}
+        for (column, path), value in zip(OrderMirror.COLUMNS.items(), res):
+            if column == 'record':
+                value = load_json(value) or []
+            elif column in ('isDelivery', 'isDelivered') and value is not None:
+                value = bool(value)
+            node = order
+            *parents, name = path.split('.')
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[name] = value
+        return order
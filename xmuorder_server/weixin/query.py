@@ -0,0 +1,265 @@
+"""
+微信云数据库查询语句构造
+生成 AsyncDatabase/Database 使用的查询语句（不包括db.collection(xxx).），值统一经过转义，避免拼接字符串带来的注入问题
+例：
+    Aggregate().match({'cID': cid, 'time': _.and_(_.gte(begin), _.lte(end))}).project('name', 'price').end()
+    Query().where({'orderInfo.outTradeNo': no}).field('userInfo.name').limit(1).get()
+"""
+import json
+import math
+from typing import Union
+
+from ..common import XMUORDERException
+
+
+class Expr(str):
+    """
+    已生成的查询表达式，渲染时原样输出
+    """
+
+
+def render(value) -> str:
+    """
+    将python值转为查询语句中的js字面量
+    :param value: str/int/float/bool/None/dict/list/tuple/Expr
+    """
+    if isinstance(value, Expr):
+        return value
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if value is None:
+        return 'null'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise XMUORDERException(f'查询语句不支持的数值:{value}')
+        return repr(value)
+    if isinstance(value, str):
+        #   json字符串即合法的js字符串，引号、反斜杠、换行等均已转义
+        return json.dumps(value)
+    if isinstance(value, dict):
+        return '{' + ', '.join(f'{json.dumps(str(k))}: {render(v)}' for k, v in value.items()) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(render(x) for x in value) + ']'
+    raise XMUORDERException(f'查询语句不支持的类型:{type(value).__name__}')
+
+
+def _call(prefix: str, name: str, *args) -> Expr:
+    return Expr(f'{prefix}.{name}({", ".join(render(x) for x in args)})')
+
+
+class Command:
+    """
+    查询指令，对应查询语句中的 _（db.command）
+    """
+
+    @staticmethod
+    def eq(value) -> Expr:
+        return _call('_', 'eq', value)
+
+    @staticmethod
+    def neq(value) -> Expr:
+        return _call('_', 'neq', value)
+
+    @staticmethod
+    def gt(value) -> Expr:
+        return _call('_', 'gt', value)
+
+    @staticmethod
+    def gte(value) -> Expr:
+        return _call('_', 'gte', value)
+
+    @staticmethod
+    def lt(value) -> Expr:
+        return _call('_', 'lt', value)
+
+    @staticmethod
+    def lte(value) -> Expr:
+        return _call('_', 'lte', value)
+
+    @staticmethod
+    def in_(values: Union[list, tuple]) -> Expr:
+        return _call('_', 'in', list(values))
+
+    @staticmethod
+    def nin(values: Union[list, tuple]) -> Expr:
+        return _call('_', 'nin', list(values))
+
+    @staticmethod
+    def and_(*exprs: Expr) -> Expr:
+        return _call('_', 'and', *exprs)
+
+    @staticmethod
+    def or_(*exprs: Expr) -> Expr:
+        return _call('_', 'or', *exprs)
+
+
+class AggregateCommand:
+    """
+    聚合操作符，对应查询语句中的 $（db.command.aggregate）
+    参数中的字段引用写作 '$字段路径'
+    """
+
+    @staticmethod
+    def sum(value) -> Expr:
+        return _call('$', 'sum', value)
+
+    @staticmethod
+    def avg(value) -> Expr:
+        return _call('$', 'avg', value)
+
+    @staticmethod
+    def min(value) -> Expr:
+        return _call('$', 'min', value)
+
+    @staticmethod
+    def max(value) -> Expr:
+        return _call('$', 'max', value)
+
+    @staticmethod
+    def first(value) -> Expr:
+        return _call('$', 'first', value)
+
+    @staticmethod
+    def last(value) -> Expr:
+        return _call('$', 'last', value)
+
+    @staticmethod
+    def push(value) -> Expr:
+        return _call('$', 'push', value)
+
+    @staticmethod
+    def multiply(values: Union[list, tuple]) -> Expr:
+        return _call('$', 'multiply', list(values))
+
+
+#   简写，与云开发查询语句中的写法一致
+_ = Command
+S = AggregateCommand
+
+
+def _count(n: int) -> int:
+    n = int(n)
+    if n < 0:
+        raise XMUORDERException(f'skip/limit不能为负数:{n}')
+    return n
+
+
+class Query:
+    """
+    普通查询构造 where().field().orderBy().skip().limit().get()
+    """
+
+    def __init__(self):
+        self.__parts: list[str] = []
+
+    def where(self, condition: dict) -> 'Query':
+        self.__parts.append(f'where({render(condition)})')
+        return self
+
+    def field(self, *fields: str) -> 'Query':
+        """
+        只返回指定字段（支持 a.b 形式的嵌套字段）
+        """
+        self.__parts.append(f'field({render({x: True for x in fields})})')
+        return self
+
+    def order_by(self, field: str, order: str = 'asc') -> 'Query':
+        if order not in ('asc', 'desc'):
+            raise XMUORDERException(f'排序方式错误:{order}')
+        self.__parts.append(f'orderBy({render(field)}, {render(order)})')
+        return self
+
+    def skip(self, n: int) -> 'Query':
+        self.__parts.append(f'skip({_count(n)})')
+        return self
+
+    def limit(self, n: int) -> 'Query':
+        self.__parts.append(f'limit({_count(n)})')
+        return self
+
+    def build(self) -> str:
+        """
+        不含结尾的查询语句（可用于 AsyncDatabase.cursor）
+        """
+        return '.'.join(self.__parts)
+
+    def get(self) -> str:
+        return self.build() + '.get()'
+
+    def count(self) -> str:
+        return self.build() + '.count()'
+
+    def __str__(self):
+        return self.build()
+
+
+class Aggregate:
+    """
+    聚合查询构造 aggregate().match().project().replaceRoot().group().skip().limit().end()
+    """
+
+    def __init__(self):
+        self.__parts: list[str] = ['aggregate()']
+
+    def match(self, condition: dict) -> 'Aggregate':
+        self.__parts.append(f'match({render(condition)})')
+        return self
+
+    def project(self, *fields: str, **spec) -> 'Aggregate':
+        """
+        投影，只保留需要的字段以减少返回数据量
+        :param fields: 保留的字段（支持 a.b 形式的嵌套字段）
+        :param spec: 其他投影，如 _id=0 或 新字段='$字段路径'
+        """
+        projection = {x: 1 for x in fields}
+        projection.update(spec)
+        self.__parts.append(f'project({render(projection)})')
+        return self
+
+    def replace_root(self, new_root: Union[dict, str]) -> 'Aggregate':
+        self.__parts.append(f'replaceRoot({render({"newRoot": new_root})})')
+        return self
+
+    def group(self, spec: dict) -> 'Aggregate':
+        """
+        分组，spec中需包含_id
+        """
+        if '_id' not in spec:
+            raise XMUORDERException('group需指定_id')
+        self.__parts.append(f'group({render(spec)})')
+        return self
+
+    def unwind(self, path: str) -> 'Aggregate':
+        self.__parts.append(f'unwind({render(path)})')
+        return self
+
+    def sort(self, spec: dict) -> 'Aggregate':
+        """
+        排序，spec为 {字段: 1/-1}
+        """
+        self.__parts.append(f'sort({render(spec)})')
+        return self
+
+    def skip(self, n: int) -> 'Aggregate':
+        self.__parts.append(f'skip({_count(n)})')
+        return self
+
+    def limit(self, n: int) -> 'Aggregate':
+        self.__parts.append(f'limit({_count(n)})')
+        return self
+
+    def build(self) -> str:
+        """
+        不含结尾的查询语句（可用于 AsyncDatabase.cursor）
+        """
+        return '.'.join(self.__parts)
+
+    def end(self) -> str:
+        return self.build() + '.end()'
+
+    def __str__(self):
+        return self.build()
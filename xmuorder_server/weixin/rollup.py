@@ -0,0 +1,185 @@
+"""
+餐厅销售日汇总
+每个餐厅、每天、每个类别一行（营业额、销量），记录在sales_rollup表
+已过去的日期不再变化，统计时汇总表只需一次索引查询，当天（及汇总范围以外的日期）实时计算
+"""
+import asyncio
+from datetime import date, datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Optional
+
+from ..config import GlobalSettings
+from ..database import Mysql, AsyncMysql
+from ..logger import Logger
+from .database import AsyncDatabase, SyncCheckpoint
+from .query import Aggregate, _, S
+
+logger: Logger
+
+
+class SalesRollup:
+    """
+    销售日汇总，已汇总的日期范围(YYYYMMDD)记录在sync_checkpoint表
+    rollup:sales:from 为已汇总的第一天（首次汇总时写入），rollup:sales 为已汇总的最后一天
+    """
+    CHECKPOINT = 'rollup:sales'
+    CHECKPOINT_FROM = 'rollup:sales:from'
+    CENT = Decimal('0.01')
+
+    enabled: bool = False
+    #   首次汇总时回溯的天数
+    backfill_days: int = 90
+    #   已汇总的日期范围 (第一天, 最后一天)，None表示尚未汇总
+    __rolled: Optional[tuple[str, str]] = None
+    __loaded: bool = False
+
+    @classmethod
+    def init(cls):
+        global logger
+        logger = Logger('销售汇总模块')
+
+        global_setting = GlobalSettings.get()
+        cls.enabled = global_setting.statistics_rollup_enabled
+        cls.backfill_days = global_setting.statistics_rollup_days
+
+    @classmethod
+    def __load_checkpoint(cls) -> Optional[tuple[str, str]]:
+        with Mysql.connect() as conn:
+            until = SyncCheckpoint.get(conn, cls.CHECKPOINT)
+            if until is None:
+                return None
+            begin = SyncCheckpoint.get(conn, cls.CHECKPOINT_FROM)
+            if begin is None:
+                #   记录第一天之前已开始汇总：取汇总表中最早的一天（没有销售的日期没有记录，偏晚但不会少算）
+                res = Mysql.execute_fetchone(conn, 'select min(day) from sales_rollup;')
+                begin = until if res is None or res[0] is None else res[0]
+                SyncCheckpoint.set(conn, cls.CHECKPOINT_FROM, begin)
+                conn.commit()
+            return begin, until
+
+    @classmethod
+    async def rolled_range(cls) -> Optional[tuple[str, str]]:
+        """
+        已汇总的日期范围 (第一天, 最后一天)(YYYYMMDD)，首次调用时读取检查点，之后由refresh更新
+        """
+        if not cls.__loaded:
+            cls.__rolled = await asyncio.to_thread(cls.__load_checkpoint)
+            cls.__loaded = True
+        return cls.__rolled
+
+    @staticmethod
+    def split(begin_date: str, end_date: str, rolled: Optional[tuple[str, str]]) \
+            -> tuple[Optional[tuple[str, str]], list[tuple[str, str]]]:
+        """
+        将统计日期范围拆分为读取汇总表的部分及实时计算的部分
+        :param begin_date: 起始日期 YYYYMMDD
+        :param end_date: 终止日期 YYYYMMDD
+        :param rolled: 已汇总的日期范围 (第一天, 最后一天)，None表示尚未汇总
+        :return: (读取汇总表的范围，无交集则为None, [实时计算的范围, ...])
+        """
+        if rolled is None or end_date < rolled[0] or begin_date > rolled[1]:
+            return None, [(begin_date, end_date)]
+
+        def shift(day: str, days: int) -> str:
+            return (datetime.strptime(day, '%Y%m%d') + timedelta(days=days)).strftime('%Y%m%d')
+
+        live = []
+        if begin_date < rolled[0]:
+            live.append((begin_date, shift(rolled[0], -1)))
+        if end_date > rolled[1]:
+            live.append((shift(rolled[1], 1), end_date))
+        return (max(begin_date, rolled[0]), min(end_date, rolled[1])), live
+
+    @staticmethod
+    async def __aggregate_day(day: str) -> list[dict]:
+        """
+        云端聚合一天内所有餐厅按类别的营业额、销量，筛选条件与商店统计一致
+        group结果无序且每页单独执行聚合，分页前需排序，否则页之间可能重复或遗漏
+        """
+        query = Aggregate().match({
+            'orderInfo.orderState': 'SUCCESS', 'payInfo.tradeState': 'SUCCESS',
+            'orderInfo.timeInfo.confirmTime': _.and_(_.gte(day + '0000'), _.lte(day + '2400'))
+        }).project(
+            'goodsInfo.shopInfo.cID', 'goodsInfo.record.num', 'goodsInfo.record.price', 'goodsInfo.record.typeName'
+        ).unwind('$goodsInfo.record').group({
+            '_id': {'cID': '$goodsInfo.shopInfo.cID', 'typeName': '$goodsInfo.record.typeName'},
+            'income': S.sum(S.multiply(['$goodsInfo.record.num', '$goodsInfo.record.price'])),
+            'salesAmount': S.sum('$goodsInfo.record.num')
+        }).sort({'_id.cID': 1, '_id.typeName': 1})
+
+        rows = []
+        async for group in AsyncDatabase.cursor('orders', query.build(), page_size=100):
+            rows.append({
+                'cID': group['_id']['cID'],
+                'day': day,
+                'typeName': group['_id']['typeName'],
+                'income': Decimal(str(group['income'])).quantize(SalesRollup.CENT, ROUND_HALF_UP),
+                'salesAmount': group['salesAmount']
+            })
+        return rows
+
+    @classmethod
+    def __save_day(cls, day: str, rows: list[dict], first: bool) -> None:
+        """
+        替换一天的汇总并前移检查点，同一事务提交
+        :param first: 是否为首次汇总的第一天，是则同时记录已汇总的第一天
+        """
+        with Mysql.connect() as conn:
+            try:
+                Mysql.execute_only(conn, 'delete from sales_rollup where day = %(day)s;', day=day)
+                Mysql.execute_many(conn, '''
+                insert into sales_rollup (cID, day, typeName, income, salesAmount)
+                values (%(cID)s, %(day)s, %(typeName)s, %(income)s, %(salesAmount)s);
+                ''', rows)
+                if first:
+                    SyncCheckpoint.set(conn, cls.CHECKPOINT_FROM, day)
+                SyncCheckpoint.set(conn, cls.CHECKPOINT, day)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    @classmethod
+    async def refresh(cls) -> dict:
+        """
+        汇总检查点之后至昨天的每一天（首次汇总回溯backfill_days天）
+        :return: {'days': 汇总天数, 'rows': 写入行数, 'rolled_from': 已汇总的第一天, 'rolled_until': 已汇总的最后一天}
+        """
+        rolled = await asyncio.to_thread(cls.__load_checkpoint)
+        yesterday = date.today() - timedelta(days=1)
+        if rolled is None:
+            day = yesterday - timedelta(days=cls.backfill_days - 1)
+        else:
+            day = datetime.strptime(rolled[1], '%Y%m%d').date() + timedelta(days=1)
+
+        days = rows = 0
+        while day <= yesterday:
+            day_str = day.strftime('%Y%m%d')
+            day_rows = await cls.__aggregate_day(day_str)
+            await asyncio.to_thread(cls.__save_day, day_str, day_rows, rolled is None)
+            rolled = (day_str if rolled is None else rolled[0], day_str)
+            cls.__rolled, cls.__loaded = rolled, True
+            days += 1
+            rows += len(day_rows)
+            day += timedelta(days=1)
+
+        cls.__rolled, cls.__loaded = rolled, True
+        return {'days': days, 'rows': rows, 'rolled_from': None if rolled is None else rolled[0],
+                'rolled_until': None if rolled is None else rolled[1]}
+
+    @staticmethod
+    async def query(cid: str, begin_date: str, end_date: str) -> dict:
+        """
+        汇总表中餐厅在日期范围内按类别的营业额、销量（一次索引查询），格式同 OrderStatistics.cal_by_class
+        :param begin_date: 起始日期 YYYYMMDD，需不早于已汇总的第一天
+        :param end_date: 终止日期 YYYYMMDD，需不晚于已汇总的最后一天
+        """
+        sql = '''
+        select typeName, sum(income), sum(salesAmount) from sales_rollup
+        where cID = %(cid)s and day between %(begin)s and %(end)s
+        group by typeName;
+        '''
+        conn = await AsyncMysql.connect()
+        async with conn:
+            res = await AsyncMysql.execute_fetchall(conn, sql, cid=cid, begin=begin_date, end=end_date)
+        return {x[0]: {'income': x[1], 'salesAmount': int(x[2])} for x in res}
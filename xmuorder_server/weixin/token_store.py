@@ -0,0 +1,177 @@
+"""
+access_token 共享存储
+多进程部署(多个uvicorn/gunicorn worker)时，各进程共享同一个access_token，只有获得刷新锁的进程请求微信接口，
+其余进程从共享存储读取，避免互相使对方的access_token失效
+1. MemoryTokenStore: 进程内存储（默认，单进程部署）
+2. FileTokenStore: 文件锁 + mmap共享内存，同一主机的多进程，无需外部服务
+跨主机部署可继承TokenStore实现其他后端（如Redis：SET NX PX 作为刷新锁）
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    #   Windows
+    fcntl = None
+    import msvcrt
+
+
+class TokenStore(ABC):
+    """
+    access_token 共享存储接口
+    新的存储后端实现以下抽象方法即可，写入只会在持有刷新锁时进行
+    """
+
+    @abstractmethod
+    def read(self) -> Optional[tuple[str, float]]:
+        """
+        读取共享的access_token
+        :return: (access_token, 过期时间戳)，无记录则返回None
+        """
+
+    @abstractmethod
+    def write(self, token: str, expires_at: float) -> None:
+        """
+        写入access_token
+        :param token: access_token
+        :param expires_at: 过期时间戳
+        """
+
+    @abstractmethod
+    def acquire(self, timeout: float) -> bool:
+        """
+        获取刷新锁（同一时间只有一个进程/线程持有）
+        :param timeout: 最长等待时间(s)
+        :return: 是否获取成功
+        """
+
+    @abstractmethod
+    def release(self) -> None:
+        """
+        释放刷新锁
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    进程内存储，仅用于单进程部署
+    """
+
+    def __init__(self):
+        self.__value: Optional[tuple[str, float]] = None
+        self.__lock = threading.Lock()
+
+    def read(self) -> Optional[tuple[str, float]]:
+        return self.__value
+
+    def write(self, token: str, expires_at: float) -> None:
+        self.__value = (token, expires_at)
+
+    def acquire(self, timeout: float) -> bool:
+        return self.__lock.acquire(timeout=timeout)
+
+    def release(self) -> None:
+        self.__lock.release()
+
+
+def _try_lock(fd: int) -> bool:
+    """
+    非阻塞获取文件排他锁
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _unlock(fd: int) -> None:
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class FileTokenStore(TokenStore):
+    """
+    文件锁 + mmap 共享内存存储，同一主机的多个进程共享
+    数据布局: [序号 uint64][过期时间戳 double][长度 uint32][access_token]
+    写入时序号先变为奇数，写完变为偶数（seqlock），读取无需加锁，读到奇数或前后序号不一致则重读
+    刷新锁使用单独的 .lock 文件
+    """
+    SIZE = 1024
+    HEADER = struct.Struct('<QdI')
+    #   读取重试次数
+    READ_RETRY = 100
+
+    def __init__(self, path: str):
+        """
+        :param path: 共享文件路径，同一主机上的各进程需使用相同路径
+        """
+        self.path = path
+        self.__data_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.__data_fd).st_size < self.SIZE:
+            os.ftruncate(self.__data_fd, self.SIZE)
+        self.__mmap = mmap.mmap(self.__data_fd, self.SIZE)
+        self.__lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        #   文件锁以进程为单位，同一进程内的线程还需线程锁
+        self.__thread_lock = threading.Lock()
+
+    def read(self) -> Optional[tuple[str, float]]:
+        for _ in range(self.READ_RETRY):
+            seq, expires_at, length = self.HEADER.unpack_from(self.__mmap, 0)
+            if seq & 1:
+                #   正在写入
+                time.sleep(0.001)
+                continue
+            if length == 0 or length > self.SIZE - self.HEADER.size:
+                return None
+            token = self.__mmap[self.HEADER.size:self.HEADER.size + length]
+            if self.HEADER.unpack_from(self.__mmap, 0)[0] == seq:
+                return token.decode(), expires_at
+        return None
+
+    def write(self, token: str, expires_at: float) -> None:
+        data = token.encode()
+        if len(data) > self.SIZE - self.HEADER.size:
+            raise ValueError('access_token过长')
+        seq = self.HEADER.unpack_from(self.__mmap, 0)[0]
+        struct.pack_into('<Q', self.__mmap, 0, seq + 1)
+        self.__mmap[self.HEADER.size:self.HEADER.size + len(data)] = data
+        self.HEADER.pack_into(self.__mmap, 0, seq + 1, expires_at, len(data))
+        struct.pack_into('<Q', self.__mmap, 0, seq + 2)
+        self.__mmap.flush()
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        if not self.__thread_lock.acquire(timeout=timeout):
+            return False
+        while not _try_lock(self.__lock_fd):
+            if time.monotonic() >= deadline:
+                self.__thread_lock.release()
+                return False
+            time.sleep(0.05)
+        return True
+
+    def release(self) -> None:
+        _unlock(self.__lock_fd)
+        self.__thread_lock.release()
+
+    def close(self) -> None:
+        self.__mmap.close()
+        os.close(self.__data_fd)
+        os.close(self.__lock_fd)
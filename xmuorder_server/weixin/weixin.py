@@ -1,10 +1,16 @@
+import asyncio
+import os
+import tempfile
 from datetime import datetime, timedelta
+from typing import Optional
 
-import requests
+import httpx
 
 from ..config import GlobalSettings
 from ..common import XMUORDERException
 from ..logger import Logger
+from .breaker import CircuitBreaker, backoff_delay
+from .token_store import TokenStore, MemoryTokenStore, FileTokenStore
 
 logger: Logger
 
@@ -18,6 +24,28 @@ class WeiXin:
     expiration: datetime = datetime.fromtimestamp(0)
     __access_token: str
 
+    #   后台提前刷新时间(s)，在过期前该时间内刷新，请求路径上无需等待获取access_token
+    refresh_ahead: int = 300
+    #   后台刷新失败后的重试间隔(s)
+    refresh_retry_interval: int = 10
+    #   等待跨进程刷新锁的最长时间(s)
+    refresh_lock_timeout: float = 10
+
+    #   access_token共享存储，多进程部署时只有一个进程刷新，其余进程读取
+    store: TokenStore = MemoryTokenStore()
+
+    #   网络错误、5xx、系统繁忙(errcode=-1)时的重试次数及首次重试等待(s)
+    max_retries: int = 2
+    retry_delay: float = 0.5
+    #   access_token接口熔断器及重试统计
+    breaker: CircuitBreaker = CircuitBreaker('access_token接口')
+    retries: dict = {'network': 0, 'busy': 0}
+
+    #   正在进行的异步刷新（single-flight，同一时间只有一个刷新请求，其余调用等待其结果）
+    __refresh_future: Optional[asyncio.Future] = None
+    #   后台刷新任务
+    __refresh_task: Optional[asyncio.Task] = None
+
     @classmethod
     def init(cls):
         #   获取默认日志
@@ -30,31 +58,215 @@ class WeiXin:
         cls.app_secret = global_setting.app_secret
         cls.app_env = global_setting.app_env
 
+        #   access_token共享存储
+        if global_setting.weixin_token_store == 'file':
+            path = global_setting.weixin_token_store_path or os.path.join(
+                tempfile.gettempdir(), f'xmuorder_access_token_{cls.app_id}')
+            cls.store = FileTokenStore(path)
+        elif global_setting.weixin_token_store != 'memory':
+            raise XMUORDERException(f'不支持的access_token存储:{global_setting.weixin_token_store}')
+
+        cls.max_retries = global_setting.weixin_retries
+        cls.breaker = CircuitBreaker('access_token接口', global_setting.weixin_breaker_threshold,
+                                     global_setting.weixin_breaker_recovery)
+
     @classmethod
-    def get_access_token(cls) -> str:
+    def start(cls):
+        """
+        启动后台刷新任务（需在事件循环中调用）
         """
-        返回微信access_token，若过期则先更新
-        """
-        if datetime.now() > cls.expiration:
-            url = 'https://api.weixin.qq.com/cgi-bin/token'
-            data = {
-                'appid': cls.app_id,
-                'secret': cls.app_secret,
-                'grant_type': 'client_credential'
-            }
-            res = requests.get(url=url, params=data)
-            if res.status_code != 200:
-                raise XMUORDERException('access_token获取失败')
-            res_json = res.json()
-            if 'access_token' in res_json and 'expires_in' in res_json:
-                cls.__access_token = res_json['access_token']
-                #   过期时间设置 预计超时时间-180s
-                sec = int(res_json['expires_in']) - 180
-                if sec <= 0:
-                    sec = int(res_json['expires_in'])
-                cls.expiration = datetime.now() + timedelta(seconds=sec)
-            else:
-                raise XMUORDERException('access_token获取失败')
-            logger.debug('access_token已刷新')
+        if cls.__refresh_task is None or cls.__refresh_task.done():
+            cls.__refresh_task = asyncio.create_task(cls.__refresh_loop())
 
+    @classmethod
+    async def stop(cls):
+        """
+        停止后台刷新任务
+        """
+        if cls.__refresh_task is not None:
+            cls.__refresh_task.cancel()
+            try:
+                await cls.__refresh_task
+            except asyncio.CancelledError:
+                pass
+            cls.__refresh_task = None
+        cls.store.close()
+
+    @classmethod
+    def __is_valid(cls) -> bool:
+        return datetime.now() <= cls.expiration
+
+    @classmethod
+    def __expiring(cls, ahead: float) -> bool:
+        """
+        access_token是否将在ahead秒内过期
+        """
+        return (cls.expiration - datetime.now()).total_seconds() <= ahead
+
+    @classmethod
+    def __load(cls) -> None:
+        """
+        从共享存储读取其他进程刷新的access_token（比本地的更新才使用）
+        """
+        res = cls.store.read()
+        if res is None:
+            return
+        token, expires_at = res
+        expiration = datetime.fromtimestamp(expires_at)
+        if expiration > cls.expiration:
+            cls.__access_token = token
+            cls.expiration = expiration
+
+    @classmethod
+    def __save(cls) -> None:
+        cls.store.write(cls.__access_token, cls.expiration.timestamp())
+
+    @classmethod
+    def __request_params(cls) -> tuple[str, dict]:
+        url = 'https://api.weixin.qq.com/cgi-bin/token'
+        data = {
+            'appid': cls.app_id,
+            'secret': cls.app_secret,
+            'grant_type': 'client_credential'
+        }
+        return url, data
+
+    @classmethod
+    def __update(cls, status_code: int, res_json: dict) -> str:
+        """
+        根据接口返回结果更新access_token及过期时间
+        """
+        if status_code != 200:
+            raise XMUORDERException('access_token获取失败')
+        if 'access_token' in res_json and 'expires_in' in res_json:
+            cls.__access_token = res_json['access_token']
+            #   过期时间设置 预计超时时间-180s
+            sec = int(res_json['expires_in']) - 180
+            if sec <= 0:
+                sec = int(res_json['expires_in'])
+            cls.expiration = datetime.now() + timedelta(seconds=sec)
+        else:
+            raise XMUORDERException('access_token获取失败')
+        logger.debug('access_token已刷新')
         return cls.__access_token
+
+    @classmethod
+    def get_access_token(cls) -> str:
+        """
+        返回微信access_token（同步版本，供Database等同步代码使用）
+        只读取本地及共享存储，不请求微信接口（在事件循环中调用时不会阻塞），刷新由后台任务及async_get_access_token完成
+        """
+        if cls.__is_valid():
+            return cls.__access_token
+        cls.__load()
+        if cls.__is_valid():
+            return cls.__access_token
+        raise XMUORDERException('access_token已过期，等待后台刷新')
+
+    @classmethod
+    async def async_get_access_token(cls) -> str:
+        """
+        返回微信access_token，若过期则等待刷新（并发调用只触发一次刷新）
+        """
+        if cls.__is_valid():
+            return cls.__access_token
+        return await cls.refresh_access_token()
+
+    @classmethod
+    async def refresh_access_token(cls, ahead: float = 0, stale: Optional[str] = None) -> str:
+        """
+        刷新access_token，已有刷新进行中则等待其结果
+        :param ahead: 共享存储中的access_token在ahead秒后才过期则直接使用，不请求微信接口
+        :param stale: 已被微信判定无效的access_token（40001/42001），即使未到过期时间也需刷新
+        """
+        while True:
+            started = cls.__refresh_future is None
+            if started:
+                cls.__refresh_future = asyncio.ensure_future(cls.__fetch_access_token(ahead, stale))
+                cls.__refresh_future.add_done_callback(cls.__on_refresh_done)
+            #   shield 防止某个调用方被取消时取消共享的刷新
+            token = await asyncio.shield(cls.__refresh_future)
+            #   加入的刷新可能在stale被判定无效之前开始，返回的仍是stale，需再发起一次刷新
+            if started or stale is None or token != stale:
+                return token
+
+    @classmethod
+    def __on_refresh_done(cls, _future: asyncio.Future):
+        cls.__refresh_future = None
+
+    @classmethod
+    async def __fetch_access_token(cls, ahead: float, stale: Optional[str]) -> str:
+        #   其他进程可能已刷新
+        cls.__load()
+        if not cls.__expiring(ahead) and cls.__access_token != stale:
+            return cls.__access_token
+
+        #   跨进程刷新锁可能阻塞，在线程中等待
+        if not await asyncio.to_thread(cls.store.acquire, cls.refresh_lock_timeout):
+            raise XMUORDERException('access_token刷新锁获取超时')
+        try:
+            cls.__load()
+            if not cls.__expiring(ahead) and cls.__access_token != stale:
+                return cls.__access_token
+            token = await cls.__request_access_token()
+            cls.__save()
+            return token
+        finally:
+            cls.store.release()
+
+    @classmethod
+    async def __request_access_token(cls) -> str:
+        """
+        请求微信接口获取access_token，网络错误、5xx、系统繁忙时退避重试，接口持续异常时熔断
+        """
+        url, data = cls.__request_params()
+        for attempt in range(cls.max_retries + 1):
+            cls.breaker.check()
+            try:
+                async with httpx.AsyncClient(timeout=10) as client:
+                    res = await client.get(url, params=data)
+                res_json = res.json() if res.status_code == 200 else {}
+                retry_type = 'busy' if res.status_code >= 500 or res_json.get('errcode') == -1 else None
+                error = f'status_code:{res.status_code} errcode:{res_json.get("errcode")}'
+            except (httpx.HTTPError, ValueError) as e:
+                retry_type, error = 'network', e
+
+            if retry_type is None:
+                cls.breaker.on_success()
+                return cls.__update(res.status_code, res_json)
+
+            cls.breaker.on_failure()
+            if attempt == cls.max_retries:
+                raise XMUORDERException(f'access_token获取失败-{error}')
+            cls.retries[retry_type] += 1
+            logger.warning(f'access_token获取失败，重试第{attempt + 1}次-{error}')
+            await asyncio.sleep(backoff_delay(attempt, cls.retry_delay))
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        access_token接口熔断器状态及重试次数
+        """
+        return {
+            'expiration': cls.expiration.strftime('%Y-%m-%d %H:%M:%S'),
+            'breaker': cls.breaker.stats(),
+            'retries': dict(cls.retries)
+        }
+
+    @classmethod
+    async def __refresh_loop(cls):
+        """
+        后台任务：在过期前 refresh_ahead 秒刷新access_token，失败则间隔重试
+        多进程时各进程都会唤醒，只有获得刷新锁且共享存储中仍将过期的进程请求微信接口
+        """
+        while True:
+            wait = (cls.expiration - datetime.now()).total_seconds() - cls.refresh_ahead
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await cls.refresh_access_token(cls.refresh_ahead)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'access_token后台刷新失败:{e}')
+                await asyncio.sleep(cls.refresh_retry_interval)